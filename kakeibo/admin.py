@@ -1,56 +1,207 @@
-from django.contrib import admin
-from .models import Payment, Income, PaymentCategory, IncomeCategory
+import datetime
+from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
+from django.db.models import Max, Min
+from .models import Payment, Income, PaymentCategory, IncomeCategory, Budget, RecurringRule, ChangeLog, ReportJob
 from import_export import resources
 from import_export.admin import ImportExportModelAdmin
+from register.models import Household
+from .categorizer import suggest_category
+from .dedupe import find_near_duplicates, DEFAULT_WINDOW_DAYS
 
 
-class PaymentResource(resources.ModelResource):
+class HouseholdResource(resources.ModelResource):
+    """世帯の列が空欄の行を、取り込んだユーザーの世帯のものとして取り込む
+
+    restrict_owner の場合は、他の世帯の行を取り込ませない。
+    取り込む行は Model.clean で検証し、他の世帯のカテゴリを指す行はエラーにする。
+    """
+
     class Meta:
-        model = Payment
+        clean_model_instances = True
+
+    def __init__(self, owner=None, restrict_owner=False):
+        super().__init__()
+        self.owner = owner
+        self.restrict_owner = restrict_owner
+
+    def before_import_row(self, row, row_number=None, **kwargs):
+        if not row.get('owner') and self.owner is not None:
+            row['owner'] = self.owner.pk
+        if self.restrict_owner and str(row.get('owner')) != str(self.owner.pk):
+            raise ValidationError({'owner': '他の世帯の行は取り込めません'})
+
+
+class HouseholdImportMixin:
+    """取り込み用のリソースに、ログイン中のユーザーの世帯を渡す"""
+
+    def get_import_resource_kwargs(self, request, *args, **kwargs):
+        resource_kwargs = super().get_import_resource_kwargs(request, *args, **kwargs)
+        resource_kwargs['owner'] = request.user.get_household()
+        resource_kwargs['restrict_owner'] = not request.user.is_superuser
+        return resource_kwargs
 
 
-class PaymentAdmin(ImportExportModelAdmin):
+class HouseholdAdminMixin:
+    """スーパーユーザー以外には、自分の世帯の行だけを見せ、世帯とカテゴリの選択肢も自分の世帯に絞る"""
+    category_models = (PaymentCategory, IncomeCategory)
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if request.user.is_superuser:
+            return queryset
+        return queryset.filter(owner=request.user.get_household())
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if request.user.is_superuser:
+            return list_filter
+        return [item for item in list_filter if item != 'owner']
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if not request.user.is_superuser:
+            household = request.user.get_household()
+            if db_field.related_model is Household:
+                kwargs['queryset'] = Household.objects.filter(pk=household.pk)
+            elif db_field.related_model in self.category_models:
+                kwargs['queryset'] = db_field.related_model.objects.filter(owner=household)
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+
+class PaymentResource(HouseholdResource):
+    class Meta:
+        model = Payment
+        # 取り込み済みの明細は、指紋で既存の行と突き合わせて二重に作らない
+        import_id_fields = ('owner', 'fingerprint')
+        skip_unchanged = True
+        report_skipped = True
+
+    def before_import_row(self, row, row_number=None, **kwargs):
+        super().before_import_row(row, row_number, **kwargs)
+        # カテゴリが空欄の行は、摘要から自動分類する
+        if not row.get('category') and row.get('description') and row.get('owner'):
+            category_id = suggest_category(int(row['owner']), row['description'])
+            if category_id is not None:
+                row['category'] = category_id
+        date = self.fields['date'].clean(row)
+        price = self.fields['price'].clean(row)
+        if date and price is not None:
+            row['fingerprint'] = Payment.build_fingerprint(date, price, row.get('description'))
+
+    def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
+        super().after_import(dataset, result, using_transactions, dry_run, **kwargs)
+        # 取り込んだ行と日付の近い同額の行を、重複の候補として結果に添える
+        imported = {row.object_id for row in result.rows if row.import_type == row.IMPORT_TYPE_NEW}
+        result.near_duplicates = []
+        if not imported:
+            return
+        imported_rows = Payment.objects.filter(pk__in=imported)
+        dates = imported_rows.aggregate(start=Min('date'), end=Max('date'))
+        window = datetime.timedelta(days=DEFAULT_WINDOW_DAYS)
+        queryset = Payment.objects.filter(owner__in=imported_rows.values('owner'),
+                                          date__range=(dates['start'] - window, dates['end'] + window))
+        result.near_duplicates = [group for group in find_near_duplicates(queryset) if imported & set(group)]
+
+
+class PaymentAdmin(HouseholdImportMixin, HouseholdAdminMixin, ImportExportModelAdmin):
     search_fields = ('description',)
-    list_display = ['date', 'category', 'price', 'description']
-    list_filter = ('category',)
+    list_display = ['date', 'category', 'price', 'description', 'owner']
+    list_filter = ('owner', ('category', admin.RelatedOnlyFieldListFilter))
     ordering = ('-date',)
 
     resource_class = PaymentResource
 
+    def process_result(self, result, request):
+        near_duplicates = getattr(result, 'near_duplicates', [])
+        if near_duplicates:
+            messages.warning(request,
+                             f'重複と思われる支出が{len(near_duplicates)}組あります: '
+                             + ', '.join('/'.join(f'#{pk}' for pk in group) for group in near_duplicates))
+        return super().process_result(result, request)
 
-class PaymentCategoryResource(resources.ModelResource):
+
+class PaymentCategoryResource(HouseholdResource):
     class Meta:
         model = PaymentCategory
 
 
-class PaymentCategoryAdmin(ImportExportModelAdmin):
+class PaymentCategoryAdmin(HouseholdImportMixin, HouseholdAdminMixin, ImportExportModelAdmin):
+    list_display = ['name', 'owner']
+    list_filter = ('owner',)
     resource_class = PaymentCategoryResource
 
 
-class IncomeResource(resources.ModelResource):
+class IncomeResource(HouseholdResource):
     class Meta:
         model = Income
 
 
-class IncomeAdmin(ImportExportModelAdmin):
+class IncomeAdmin(HouseholdImportMixin, HouseholdAdminMixin, ImportExportModelAdmin):
     search_fields = ('description',)
-    list_display = ['date', 'category', 'price', 'description']
-    list_filter = ('category',)
+    list_display = ['date', 'category', 'price', 'description', 'owner']
+    list_filter = ('owner', ('category', admin.RelatedOnlyFieldListFilter))
     ordering = ('-date',)
 
     resource_class = IncomeResource
 
 
-class IncomeCategoryResource(resources.ModelResource):
+class IncomeCategoryResource(HouseholdResource):
     class Meta:
         model = IncomeCategory
 
 
-class IncomeCategoryAdmin(ImportExportModelAdmin):
+class IncomeCategoryAdmin(HouseholdImportMixin, HouseholdAdminMixin, ImportExportModelAdmin):
+    list_display = ['name', 'owner']
+    list_filter = ('owner',)
     resource_class = IncomeCategoryResource
 
 
+class BudgetResource(HouseholdResource):
+    class Meta:
+        model = Budget
+
+
+class BudgetAdmin(HouseholdImportMixin, HouseholdAdminMixin, ImportExportModelAdmin):
+    list_display = ['month', 'category', 'limit', 'owner']
+    list_filter = ('owner', ('category', admin.RelatedOnlyFieldListFilter))
+    ordering = ('-month', 'category')
+
+    resource_class = BudgetResource
+
+
+class RecurringRuleAdmin(HouseholdAdminMixin, admin.ModelAdmin):
+    list_display = ['kind', 'description', 'price', 'interval', 'day', 'start_date', 'end_date', 'last_generated',
+                    'owner']
+    list_filter = ('owner', 'kind')
+    readonly_fields = ('last_generated',)
+
+
+class ChangeLogAdmin(HouseholdAdminMixin, admin.ModelAdmin):
+    list_display = ['created_at', 'kind', 'object_id', 'action', 'user', 'owner']
+    list_filter = ('owner', 'kind', 'action')
+    search_fields = ('=object_id',)
+    ordering = ('-created_at',)
+
+    # 変更履歴は追記のみとし、管理画面からは編集させない
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class ReportJobAdmin(HouseholdAdminMixin, admin.ModelAdmin):
+    list_display = ['created_at', 'kind', 'file_format', 'start_year', 'end_year', 'status', 'progress', 'owner']
+    list_filter = ('owner', 'status')
+    ordering = ('-created_at',)
+    readonly_fields = ('status', 'progress', 'file_name', 'error', 'started_at', 'finished_at')
+
+
 admin.site.register(PaymentCategory, PaymentCategoryAdmin)
 admin.site.register(IncomeCategory, IncomeCategoryAdmin)
 admin.site.register(Payment, PaymentAdmin)
 admin.site.register(Income, IncomeAdmin)
+admin.site.register(Budget, BudgetAdmin)
+admin.site.register(RecurringRule, RecurringRuleAdmin)
+admin.site.register(ChangeLog, ChangeLogAdmin)
+admin.site.register(ReportJob, ReportJobAdmin)
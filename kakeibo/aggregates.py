@@ -0,0 +1,161 @@
+"""ダッシュボード・推移グラフの集計とキャッシュ
+
+ビューとバックグラウンドの事前計算ワーカー(precompute.py)の両方から呼び出される。
+"""
+from django.core.cache import cache
+from django.utils import timezone
+from .models import PaymentCategory
+from .plugin_plotly import GraphGenerator
+from .columns import month_range
+from .snapshot import get_snapshot, new_version
+from .compression import fragment
+from .forecast import month_forecast
+
+MONTH_SUMMARY_KEY = 'kakeibo:month_summary:{owner}:{year}-{month}'
+TRANSITION_VERSION_KEY = 'kakeibo:transition_version:{owner}'
+TRANSITION_SERIES_KEY = 'kakeibo:transition_series:{owner}:v{version}:{kind}:{category}'
+TRANSITION_PLOT_KEY = ('kakeibo:transition_plot:{owner}:v{version}:{as_of}:'
+                       '{payment_category}:{income_category}:{graph_visible}')
+
+# 書き込み時に明示的に無効化するため、期限は設けない
+CACHE_TIMEOUT = None
+
+
+def compute_month_summary(owner_id, year, month, today=None):
+    """世帯の月間支出ダッシュボードの集計とグラフを作成する
+
+    今月の場合は月末・年末の見込み(forecast.py)を加える。見込みは日付で変わるため、見込みを作成した日を as_of に持つ。
+    """
+    today = today or timezone.localdate()
+    columns = get_snapshot('Payment', owner_id)
+    mask = columns.mask(*month_range(year, month))
+    # 支出が何もない月はグラフを作らず、空の辞書を返す
+    if not columns.any(mask):
+        return {}
+
+    gen = GraphGenerator()
+    summary = {}
+
+    category_totals = columns.totals_by_category(mask)
+    forecast = month_forecast(columns, year, month, today)
+    projections = [] if forecast is None else [item for item in forecast.categories if item.year_end]
+    names = PaymentCategory.objects.in_bulk({*category_totals, *(item.category_id for item in projections)})
+    # 同じ名前のカテゴリは合算する
+    table_set = {}
+    for pk, total in category_totals.items():
+        name = str(names[pk])
+        table_set[name] = table_set.get(name, 0) + total
+    table_set = dict(sorted(table_set.items()))
+    # グラフはキャッシュする前に縮小・圧縮しておく
+    summary['plot_pie'] = fragment(gen.month_pie(labels=list(table_set), values=list(table_set.values())))
+
+    summary['table_set'] = table_set
+
+    summary['total_payment'] = sum(table_set.values())
+
+    dates, heights = columns.totals_by_day(mask)
+    summary['plot_bar'] = fragment(gen.month_daily_bar(x_list=dates, y_list=heights, forecast=forecast))
+
+    if forecast is not None:
+        summary['as_of'] = today
+        summary['forecast_set'] = sorted(((str(names[item.category_id]), item) for item in projections),
+                                         key=lambda pair: pair[0])
+        summary['forecast_total'] = forecast.total
+
+    return summary
+
+
+def get_month_summary(owner_id, year, month):
+    """月間支出ダッシュボードの集計をキャッシュ経由で取得する"""
+    key = MONTH_SUMMARY_KEY.format(owner=owner_id, year=year, month=month)
+    summary = cache.get(key)
+    # 見込みを含む集計は、日付が変わったら作り直す
+    if summary is None or summary.get('as_of', timezone.localdate()) != timezone.localdate():
+        summary = compute_month_summary(owner_id, year, month)
+        cache.set(key, summary, CACHE_TIMEOUT)
+    return summary
+
+
+def refresh_month_summary(owner_id, year, month):
+    """月間支出ダッシュボードの集計を再計算してキャッシュに書き込む"""
+    summary = compute_month_summary(owner_id, year, month)
+    cache.set(MONTH_SUMMARY_KEY.format(owner=owner_id, year=year, month=month), summary, CACHE_TIMEOUT)
+    return summary
+
+
+def invalidate_month_summary(owner_id, year, month):
+    cache.delete(MONTH_SUMMARY_KEY.format(owner=owner_id, year=year, month=month))
+
+
+def get_transition_version(owner_id):
+    key = TRANSITION_VERSION_KEY.format(owner=owner_id)
+    version = cache.get(key)
+    if version is None:
+        # 追い出された後も古いグラフを再び使わないよう、番号ではなく一意な値にする
+        cache.add(key, new_version(), CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_transition(owner_id):
+    """推移グラフのキャッシュをバージョンごと無効化する"""
+    cache.set(TRANSITION_VERSION_KEY.format(owner=owner_id), new_version(), CACHE_TIMEOUT)
+
+
+def compute_transition_series(owner_id, kind, category=None):
+    """月毎の合計金額の系列を作成する"""
+    columns = get_snapshot(kind, owner_id)
+    return columns.totals_by_month(columns.mask(category=category))
+
+
+def get_transition_series(owner_id, kind, category=None):
+    category_id = getattr(category, 'pk', category)
+    key = TRANSITION_SERIES_KEY.format(owner=owner_id,
+                                       version=get_transition_version(owner_id),
+                                       kind=kind,
+                                       category=category_id or 'all')
+    series = cache.get(key)
+    if series is None:
+        series = compute_transition_series(owner_id, kind, category_id)
+        cache.set(key, series, CACHE_TIMEOUT)
+    return series
+
+
+def get_transition_plot(owner_id, payment_category=None, income_category=None, graph_visible=None):
+    """収支推移グラフのhtmlをキャッシュ経由で取得する。支出には今月から年末までの見込みを重ねる"""
+    version = get_transition_version(owner_id)
+    today = timezone.localdate()
+    key = TRANSITION_PLOT_KEY.format(owner=owner_id,
+                                     version=version,
+                                     as_of=today.isoformat(),
+                                     payment_category=getattr(payment_category, 'pk', payment_category) or 'all',
+                                     income_category=getattr(income_category, 'pk', income_category) or 'all',
+                                     graph_visible=graph_visible or 'all')
+    plot = cache.get(key)
+    if plot is not None:
+        return plot
+
+    months_payment = None
+    payments = None
+    months_income = None
+    incomes = None
+    forecast = None
+
+    # forms.pyで表示グラフ名を定義
+    if not graph_visible or graph_visible == 'Payment':
+        months_payment, payments = get_transition_series(owner_id, 'Payment', payment_category)
+        forecast = month_forecast(get_snapshot('Payment', owner_id), today.year, today.month, today)
+        if forecast is not None:
+            forecast = forecast.for_category(getattr(payment_category, 'pk', payment_category))
+
+    if not graph_visible or graph_visible == 'Income':
+        months_income, incomes = get_transition_series(owner_id, 'Income', income_category)
+
+    gen = GraphGenerator()
+    plot = fragment(gen.transition_plot(x_list_payment=months_payment,
+                                        y_list_payment=payments,
+                                        x_list_income=months_income,
+                                        y_list_income=incomes,
+                                        forecast=forecast))
+    cache.set(key, plot, CACHE_TIMEOUT)
+    return plot
@@ -0,0 +1,144 @@
+"""普段と比べて大きく外れた支出の検出
+
+カテゴリごとに金額の件数・平均・偏差平方和(CategoryStats)を持ち、支出の書き込みの度に
+Welford の方法で1件分だけ加える(取り消す場合は逆の計算で除く)。
+支出の外れ度は、保存する時点の統計(その支出自身は含めない)の平均から標準偏差の何倍離れているか(zスコア)。
+判定は統計1行との比較だけなので、支出の件数によらずクエリ1回で済み、登録のリクエスト内で行える。
+
+一括作成した行には外れ度を付けない。差分の更新による誤差の解消も含め、
+managementコマンド rescore_anomalies で統計を作り直し、過去の支出をまとめて採点し直す。
+"""
+import math
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, Value
+from .columns import month_dates
+from .models import CategoryStats, Payment
+
+
+def z_threshold():
+    """外れ値とみなすzスコア(の絶対値)"""
+    return getattr(settings, 'KAKEIBO_ANOMALY_Z', 3.0)
+
+
+def min_count():
+    """判定に必要な、カテゴリの支出の件数"""
+    return getattr(settings, 'KAKEIBO_ANOMALY_MIN_COUNT', 10)
+
+
+def add(count, mean, m2, price):
+    """統計に1件加える"""
+    count += 1
+    delta = price - mean
+    mean += delta / count
+    m2 += delta * (price - mean)
+    return count, mean, m2
+
+
+def remove(count, mean, m2, price):
+    """統計から1件除く(add の逆)"""
+    if count <= 1:
+        return 0, 0.0, 0.0
+    new_mean = (count * mean - price) / (count - 1)
+    m2 -= (price - new_mean) * (price - mean)
+    return count - 1, new_mean, max(m2, 0.0)
+
+
+def merge(a, b):
+    """二つの統計(件数, 平均, 偏差平方和)を合わせる"""
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if not count:
+        return 0, 0.0, 0.0
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta * delta * count_a * count_b / count
+    return count, mean, m2
+
+
+def score(count, mean, m2, price):
+    """zスコア。件数が足りない・ばらつきが無い場合はNone"""
+    if count < min_count() or m2 <= 0:
+        return None
+    return (price - mean) / math.sqrt(m2 / count)
+
+
+def score_payment(payment, original=None):
+    """保存前の支出の外れ度。更新の場合は、統計に含まれている更新前の値を除いて比べる"""
+    stats = (CategoryStats.objects.filter(category_id=payment.category_id)
+             .values_list('count', 'mean', 'm2').first())
+    if stats is None:
+        return None
+    if original and original['deleted_at'] is None and original['category_id'] == payment.category_id:
+        stats = remove(*stats, original['price'])
+    return score(*stats, payment.price)
+
+
+def _merged(count, mean, m2):
+    """統計の行に別の統計を合わせるUPDATEの値(merge をSQLの式にしたもの)"""
+    total = F('count') + count
+    delta = Value(float(mean)) - F('mean')
+    return {
+        'count': total,
+        'mean': F('mean') + delta * count / total,
+        'm2': F('m2') + float(m2) + delta * delta * F('count') * count / total,
+    }
+
+
+def _removed(price):
+    """統計の行から1件除くUPDATEの値(remove をSQLの式にしたもの)。件数が2件以上の行に使う"""
+    delta = Value(float(price)) - F('mean')
+    return {
+        'count': F('count') - 1,
+        'mean': (F('count') * F('mean') - float(price)) / (F('count') - 1),
+        'm2': F('m2') - delta * delta * F('count') / (F('count') - 1),
+    }
+
+
+def merge_into(owner_id, category_id, stats):
+    """カテゴリの統計に、別の統計(件数, 平均, 偏差平方和)を合わせる
+
+    読み出さずに一つのUPDATEで計算するため、同時に書き込まれても取りこぼさない。
+    """
+    if not stats[0]:
+        return
+    updated = CategoryStats.objects.filter(category_id=category_id).update(**_merged(*stats))
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            CategoryStats.objects.create(owner_id=owner_id, category_id=category_id,
+                                         count=stats[0], mean=stats[1], m2=stats[2])
+    except IntegrityError:
+        # 同時に作成された場合は合わせる方に切り替える
+        CategoryStats.objects.filter(category_id=category_id).update(**_merged(*stats))
+
+
+def add_price(owner_id, category_id, price):
+    merge_into(owner_id, category_id, (1, price, 0.0))
+
+
+def remove_price(owner_id, category_id, price):
+    updated = CategoryStats.objects.filter(category_id=category_id, count__gt=1).update(**_removed(price))
+    if not updated:
+        CategoryStats.objects.filter(category_id=category_id).update(count=0, mean=0, m2=0)
+
+
+def batch_stats(prices):
+    """金額のリストの統計"""
+    stats = (0, 0.0, 0.0)
+    for price in prices:
+        stats = add(*stats, price)
+    return stats
+
+
+def month_anomalies(owner_id, year, month, limit=10):
+    """その月の外れた支出。外れ度の大きい順"""
+    start, end = month_dates(year, month)
+    threshold = z_threshold()
+    return list(Payment.objects
+                .filter(Q(anomaly_score__gte=threshold) | Q(anomaly_score__lte=-threshold),
+                        owner_id=owner_id, date__gte=start, date__lt=end)
+                .select_related('category')
+                .order_by('-anomaly_score')[:limit])
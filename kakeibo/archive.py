@@ -0,0 +1,185 @@
+"""凍結済みの年の台帳アーカイブ
+
+過去の年は編集されないため、managementコマンド archive_ledger で年ごとに
+固定長のバイナリ(.npy)に書き出し、読み込み時はメモリマップする。
+メモリマップしたファイルはOSのページキャッシュを通じてワーカープロセス間で共有される。
+凍結後に過去の年の行が書き込まれた場合は、その年の凍結を解除して(thaw_year)データベースから読むように戻す。
+解除した年は、次に archive_ledger を実行した時に凍結し直される。
+
+マニフェストの更新と、凍結・解除は、ロックファイル(fcntl.flock)でプロセスをまたいで1つずつ行う。
+凍結中に書き込まれた行を取りこぼさないよう、凍結はロックを取ってから行を読み、
+書き込み後の解除(thaw_dates)もロックを取ってからマニフェストを確かめる。
+"""
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from django.conf import settings
+from django.db.models import Q
+import numpy as np
+from .columns import LedgerColumns, EMPTY_COLUMNS, to_day
+
+MANIFEST_NAME = 'manifest.json'
+LOCK_NAME = 'manifest.lock'
+
+
+def archive_dir():
+    return Path(settings.KAKEIBO_ARCHIVE_DIR)
+
+
+def manifest_path():
+    return archive_dir() / MANIFEST_NAME
+
+
+def manifest_mtime():
+    """マニフェストの更新時刻。凍結し直されたかどうかの判定に使う"""
+    try:
+        return os.stat(manifest_path()).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def load_manifest():
+    """世帯のpk(文字列) -> 種類('Payment'/'Income') -> 凍結済みの年のリスト"""
+    try:
+        with open(manifest_path(), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@contextmanager
+def manifest_lock():
+    """マニフェストを読んで書き戻す間、他のスレッド・プロセスの更新を待たせる。入れ子にはできない"""
+    archive_dir().mkdir(parents=True, exist_ok=True)
+    with open(archive_dir() / LOCK_NAME, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _write_manifest(manifest):
+    """manifest_lock を取った状態で呼ぶ。一時ファイルは書き手ごとに別の名前にする"""
+    fd, tmp_path = tempfile.mkstemp(dir=archive_dir(), prefix=MANIFEST_NAME, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path())
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def archived_years(kind, owner_id):
+    return load_manifest().get(str(owner_id), {}).get(kind, [])
+
+
+def year_dir(kind, owner_id, year):
+    return archive_dir() / str(owner_id) / kind.lower() / str(year)
+
+
+def freeze_year(model, owner_id, year):
+    """世帯の1年分の行を列ごとの.npyファイルに書き出し、マニフェストに登録する
+
+    行を読んでから登録するまでロックを取り続ける。その間にコミットされた書き込みの解除はロックを待ち、
+    登録後に凍結を解除するため、古い内容のアーカイブが残ることはない。
+    """
+    with manifest_lock():
+        return _freeze_year(model, owner_id, year)
+
+
+def _freeze_year(model, owner_id, year):
+    kind = model.__name__
+    rows = list(model.objects.filter(owner_id=owner_id, date__year=year)
+                .order_by('id').values_list('id', 'date', 'price', 'category_id'))
+
+    category_ids = sorted({row[3] for row in rows})
+    codes = {category_id: code for code, category_id in enumerate(category_ids)}
+    columns = {
+        'ids': np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)),
+        'days': np.fromiter((to_day(row[1]) for row in rows), dtype=np.int32, count=len(rows)),
+        'prices': np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows)),
+        'categories': np.fromiter((codes[row[3]] for row in rows), dtype=np.int16, count=len(rows)),
+        'category_ids': np.array(category_ids, dtype=np.int64),
+    }
+
+    # 書き込み途中のファイルを読まれないよう、一時ディレクトリに書いてから入れ替える
+    target = year_dir(kind, owner_id, year)
+    tmp_target = target.with_name(f'{year}.tmp')
+    shutil.rmtree(tmp_target, ignore_errors=True)
+    tmp_target.mkdir(parents=True)
+    for name, values in columns.items():
+        np.save(tmp_target / f'{name}.npy', values)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp_target, target)
+
+    manifest = load_manifest()
+    owner_manifest = manifest.setdefault(str(owner_id), {})
+    owner_manifest[kind] = sorted(set(owner_manifest.get(kind, [])) | {year})
+    _write_manifest(manifest)
+    return len(rows)
+
+
+def thaw_year(kind, owner_id, year):
+    """凍結を解除する。マニフェストから外すと、スナップショットはその年をデータベースから読み直す"""
+    with manifest_lock():
+        _thaw_year(kind, owner_id, year)
+
+
+def _thaw_year(kind, owner_id, year):
+    manifest = load_manifest()
+    owner_manifest = manifest.get(str(owner_id), {})
+    if year not in owner_manifest.get(kind, []):
+        return
+    owner_manifest[kind] = [archived for archived in owner_manifest[kind] if archived != year]
+    _write_manifest(manifest)
+    # メモリマップ中のプロセスがあっても、削除したファイルはマップを解除するまで読める
+    shutil.rmtree(year_dir(kind, owner_id, year), ignore_errors=True)
+
+
+def thaw_dates(kind, owner_id, dates):
+    """書き込んだ行の日付のうち、凍結済みの年の凍結を解除する
+
+    凍結中の年かもしれないため、ロックを取ってからマニフェストを確かめる。
+    アーカイブのディレクトリが無ければ、凍結したことも凍結中の年も無い。
+    """
+    years = {date.year for date in dates if date}
+    if not years or not archive_dir().is_dir():
+        return
+    with manifest_lock():
+        for year in sorted(years & set(archived_years(kind, owner_id))):
+            _thaw_year(kind, owner_id, year)
+
+
+def load_year(kind, owner_id, year):
+    """凍結済みの1年分をメモリマップして列にする"""
+    path = year_dir(kind, owner_id, year)
+    ids = np.load(path / 'ids.npy', mmap_mode='r')
+    if not len(ids):
+        return EMPTY_COLUMNS
+    return LedgerColumns(ids,
+                         np.load(path / 'days.npy', mmap_mode='r'),
+                         np.load(path / 'prices.npy', mmap_mode='r'),
+                         np.load(path / 'categories.npy', mmap_mode='r'),
+                         [int(category_id) for category_id in np.load(path / 'category_ids.npy')])
+
+
+def load_archive(kind, owner_id):
+    segments = []
+    for year in archived_years(kind, owner_id):
+        try:
+            segments.append(load_year(kind, owner_id, year))
+        except FileNotFoundError:
+            # マニフェストを読んだ後に凍結が解除された年。マニフェストから外れているため、データベースから読まれる
+            continue
+    return segments
+
+
+def live_filter(kind, owner_id):
+    """凍結されていない年の行だけを取り出す条件"""
+    condition = Q(owner_id=owner_id)
+    for year in archived_years(kind, owner_id):
+        condition &= ~Q(date__gte=f'{year}-01-01', date__lt=f'{year + 1}-01-01')
+    return condition
@@ -0,0 +1,29 @@
+"""静的ファイル(グラフ描画用のPlotly.jsなど)の配信
+
+Plotly.jsは static/kakeibo/vendor に同梱し、CDNには依存しない。
+Pythonのplotlyが生成するグラフと同じバージョンのものを置き、plotlyを更新した場合は、
+plotlyパッケージ同梱の package_data/plotly.min.js をバージョン付きの名前で置き換える(テストで確かめる)。
+静的ファイルはハッシュ付きのファイル名(ManifestStaticFilesStorage)で collectstatic し、
+STATIC_ROOT をWebサーバーから配信する。ハッシュ付きの名前は長期間キャッシュさせる(設定例は README.md)。
+"""
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.templatetags.static import static
+
+PLOTLY_VERSION = '2.35.2'
+PLOTLY_BUNDLE = f'kakeibo/vendor/plotly-{PLOTLY_VERSION}.min.js'
+
+
+class StaticFilesStorage(ManifestStaticFilesStorage):
+    """collectstatic前(開発・テスト)でも動くよう、未収集のファイルはハッシュ無しの名前で返す"""
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+
+def plotly_js_url():
+    """グラフのあるページで読み込むPlotly.jsのURL"""
+    return static(PLOTLY_BUNDLE)
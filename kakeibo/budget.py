@@ -0,0 +1,64 @@
+"""予算と、カテゴリ別の月間支出額の集計表
+
+集計表(MonthlyCategorySpend)は支出の書き込みの度に差分で更新するため、
+予算の消化状況の表示は月の支出を合計し直さず、カテゴリ数に比例する手間で済む。
+"""
+import datetime
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .models import Budget, MonthlyCategorySpend, PaymentCategory
+
+
+def apply_spend(owner_id, category_id, date, price, count=1):
+    """集計表に金額と件数を加算する。取り消す場合は負の値を渡す"""
+    month = date.replace(day=1)
+    updated = MonthlyCategorySpend.objects.filter(category_id=category_id, month=month).update(
+        total=F('total') + price, count=F('count') + count)
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            MonthlyCategorySpend.objects.create(owner_id=owner_id, category_id=category_id, month=month,
+                                                total=price, count=count)
+    except IntegrityError:
+        # 同時に作成された場合は加算に切り替える
+        MonthlyCategorySpend.objects.filter(category_id=category_id, month=month).update(
+            total=F('total') + price, count=F('count') + count)
+
+
+def budget_status(owner_id, year, month):
+    """世帯のその月の全カテゴリについて、予算額と支出額を返す"""
+    month = datetime.date(year, month, 1)
+    limits = dict(Budget.objects.filter(owner_id=owner_id, month=month).values_list('category_id', 'limit'))
+    spends = dict(MonthlyCategorySpend.objects.filter(owner_id=owner_id, month=month)
+                  .values_list('category_id', 'total'))
+
+    rows = []
+    for category in PaymentCategory.objects.filter(owner_id=owner_id).order_by('name'):
+        limit = limits.get(category.pk)
+        spent = spends.get(category.pk, 0)
+        rows.append({
+            'category': category,
+            'limit': limit,
+            'spent': spent,
+            'remaining': None if limit is None else limit - spent,
+            'rate': None if not limit else round(spent / limit * 100),
+        })
+    return rows
+
+
+def crossed_thresholds(payment):
+    """この支出によって超えた予算の閾値(割合)のリストを返す
+
+    集計表は支出の保存時に更新済みなので、今回の金額を引いた値と比較する。
+    """
+    month = payment.date.replace(day=1)
+    limit = Budget.objects.filter(category_id=payment.category_id, month=month).values_list('limit', flat=True).first()
+    if not limit:
+        return []
+    spent = MonthlyCategorySpend.objects.filter(
+        category_id=payment.category_id, month=month).values_list('total', flat=True).first() or 0
+    before = spent - payment.price
+    thresholds = getattr(settings, 'KAKEIBO_BUDGET_ALERT_THRESHOLDS', (0.8, 1.0))
+    return [threshold for threshold in thresholds if before < limit * threshold <= spent]
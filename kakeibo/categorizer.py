@@ -0,0 +1,218 @@
+"""摘要からの支出カテゴリの自動分類
+
+登録済みの支出の (摘要, カテゴリ) の組からキーワードとカテゴリの出現回数を学習し、
+新しい摘要に含まれるキーワードを Aho-Corasick 法でまとめて検出してカテゴリを推定する。
+キーワードが一つも見つからない場合は、最も件数の多いカテゴリを返す。
+学習は世帯ごとに行う。学習結果はプロセス内に保持し、スナップショットと同じく書き込みのあった分だけ差分で取り込む。
+"""
+import threading
+from collections import Counter, defaultdict, deque
+from django.conf import settings
+from django.core.cache import cache
+from .models import Payment
+from .lru import LRU
+from .normalize import normalize
+from .snapshot import VERSION_KEY, GENERATION_KEY, changed_since
+
+# これより短いキーワードは誤検出が多いため学習しない
+MIN_KEYWORD_LENGTH = 2
+# 同じ摘要の推定結果を使い回す件数の上限
+RESULT_CACHE_SIZE = 10000
+
+
+def keywords(text):
+    """摘要から学習するキーワード(空白区切りの語と、摘要全体)"""
+    text = normalize(text)
+    words = {word for word in text.split() if len(word) >= MIN_KEYWORD_LENGTH}
+    if len(text) >= MIN_KEYWORD_LENGTH:
+        words.add(text)
+    return words
+
+
+class AhoCorasick:
+    """複数のキーワードを一度の走査で検出するオートマトン"""
+
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for word in words:
+            node = 0
+            for char in word:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = self.goto[node][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                node = next_node
+            self.output[node] += (word,)
+
+        # 幅優先で失敗遷移を張り、失敗先の出力を引き継ぐ
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] += self.output[self.fail[child]]
+
+    def find(self, text):
+        """text に含まれるキーワードの集合"""
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            if self.output[node]:
+                found.update(self.output[node])
+        return found
+
+
+class Categorizer:
+    """ある世帯の支出カテゴリの推定器"""
+
+    def __init__(self, owner_id):
+        self.owner_id = owner_id
+        self._reset()
+        self.loaded = False
+        self.version = None
+        self.generation = None
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def _reset(self):
+        # キーワード -> カテゴリのpk -> 件数
+        self.keyword_counts = defaultdict(Counter)
+        self.category_counts = Counter()
+        # 支出のpk -> (キーワード, カテゴリのpk)。更新・削除の際に学習済みの件数を差し引くために持つ
+        self.rows = {}
+        self.automaton = AhoCorasick([])
+        self.max_id = 0
+        self.watermark = None
+        self.results = {}
+
+    def _learn(self, rows):
+        """(pk, 摘要, カテゴリのpk, 更新日時, 削除日時) を取り込み、新しいキーワードがあったかを返す"""
+        new_keyword = False
+        for pk, description, category_id, updated_at, deleted_at in rows:
+            self._forget(pk)
+            self.max_id = max(self.max_id, pk)
+            self.watermark = max(self.watermark, updated_at) if self.watermark else updated_at
+            # ゴミ箱に移された行は学習から除く
+            if deleted_at is not None:
+                continue
+            words = keywords(description)
+            for word in words:
+                if word not in self.keyword_counts:
+                    new_keyword = True
+                self.keyword_counts[word][category_id] += 1
+            self.category_counts[category_id] += 1
+            # 行の数だけ持つため、集合より小さいタプルにする
+            self.rows[pk] = (tuple(words), category_id)
+        return new_keyword
+
+    def _forget(self, pk):
+        learned = self.rows.pop(pk, None)
+        if learned is None:
+            return
+        words, category_id = learned
+        for word in words:
+            self.keyword_counts[word][category_id] -= 1
+        self.category_counts[category_id] -= 1
+
+    def _fetch(self, queryset):
+        return queryset.order_by('id').values_list('id', 'description', 'category_id', 'updated_at', 'deleted_at')
+
+    def refresh(self):
+        """書き込みがあった場合のみ、データベースから差分を学習する"""
+        version = cache.get(VERSION_KEY.format(owner=self.owner_id, kind='Payment'))
+        generation = cache.get(GENERATION_KEY.format(owner=self.owner_id, kind='Payment'))
+        if self.loaded and version == self.version and generation == self.generation:
+            return self
+        with self._lock:
+            if self.loaded and version == self.version and generation == self.generation:
+                return self
+            if not self.loaded or generation != self.generation:
+                self._reset()
+                self._learn(self._fetch(Payment.objects.filter(owner_id=self.owner_id)))
+                rebuild = True
+            else:
+                condition = changed_since(self.max_id, self.watermark)
+                rebuild = self._learn(self._fetch(Payment.all_objects.filter(condition, owner_id=self.owner_id)))
+            if rebuild:
+                self.automaton = AhoCorasick(self.keyword_counts)
+            self.results = {}
+            self.loaded = True
+            self.version = version
+            self.generation = generation
+        return self
+
+    def suggest(self, description):
+        """摘要からカテゴリのpkと推定方法('rule' / 'fallback')を返す。推定できなければ (None, None)"""
+        text = normalize(description)
+        with self._lock:
+            result = self.results.get(text)
+            if result is None:
+                result = self._score(text)
+                if len(self.results) < RESULT_CACHE_SIZE:
+                    self.results[text] = result
+            self.stats[result[1] or 'none'] += 1
+        return result
+
+    def _score(self, text, exclude=None):
+        scores = Counter()
+        for word in self.automaton.find(text) if text else ():
+            counts = self.keyword_counts[word]
+            # 評価時は、評価対象の行自身の学習分を差し引く
+            own = exclude[1] if exclude and word in exclude[0] else None
+            total = sum(counts.values()) - (own is not None)
+            for category_id, count in counts.items():
+                count -= category_id == own
+                if count > 0:
+                    # 長いキーワードほど、また特定のカテゴリに偏っているキーワードほど重視する
+                    scores[category_id] += len(word) * count / total
+        if scores:
+            return scores.most_common(1)[0][0], 'rule'
+        fallback = self.category_counts.copy()
+        if exclude:
+            fallback[exclude[1]] -= 1
+        fallback = +fallback
+        if fallback:
+            return fallback.most_common(1)[0][0], 'fallback'
+        return None, None
+
+    def evaluate(self):
+        """登録済みの支出を一件ずつ除いて推定し直し、的中率を集計する"""
+        result = Counter()
+        for words, category_id in self.rows.values():
+            suggested, source = self._score(max(words, key=len, default=''), exclude=(words, category_id))
+            result['total'] += 1
+            result[source or 'none'] += 1
+            if suggested == category_id:
+                result['correct'] += 1
+                result[f'{source}_correct'] += 1
+        return result
+
+    def hit_rate(self):
+        """これまでの推定のうち、キーワードで分類できた割合"""
+        total = sum(self.stats.values())
+        return self.stats['rule'] / total if total else 0.0
+
+
+# 世帯のpk -> 推定器。世帯の数だけメモリが増えないよう、使われていないものから捨てる
+categorizers = LRU(getattr(settings, 'KAKEIBO_CATEGORIZER_CACHE_SIZE', 128))
+
+
+def get_categorizer(owner_id):
+    """世帯の、最新の状態に更新した推定器を返す"""
+    return categorizers.get_or_create(owner_id, lambda: Categorizer(owner_id)).refresh()
+
+
+def suggest_category(owner_id, description):
+    """摘要から世帯の支出カテゴリのpkを推定する"""
+    return get_categorizer(owner_id).suggest(description)[0]
@@ -0,0 +1,169 @@
+"""台帳の列と、列に対する集計
+
+日付は1970-01-01からの通し日数(int32)、金額はint64、カテゴリはint16のコードで持つ。
+集計はブールマスクと np.bincount で行う。
+"""
+import datetime
+from collections import defaultdict
+import numpy as np
+
+EPOCH = datetime.date(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def to_day(date):
+    """日付を1970-01-01からの通し日数にする"""
+    return date.toordinal() - EPOCH_ORDINAL
+
+
+def from_day(day):
+    return datetime.date.fromordinal(int(day) + EPOCH_ORDINAL)
+
+
+def month_dates(year, month):
+    """その月の初日と翌月初日"""
+    return datetime.date(year, month, 1), datetime.date(year + month // 12, month % 12 + 1, 1)
+
+
+def month_range(year, month):
+    """その月の初日と翌月初日の通し日数"""
+    start, end = month_dates(year, month)
+    return to_day(start), to_day(end)
+
+
+class LedgerColumns:
+    """ある時点の台帳の列。作成後は変更しないので、ロックなしで複数スレッドから参照できる"""
+
+    def __init__(self, ids, days, prices, categories, category_ids):
+        self.ids = ids
+        self.days = days
+        self.prices = prices
+        self.categories = categories
+        # カテゴリコード -> カテゴリのpk
+        self.category_ids = category_ids
+        self.category_codes = {category_id: code for code, category_id in enumerate(category_ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.days.nbytes + self.prices.nbytes + self.categories.nbytes
+
+    def mask(self, start=None, end=None, category=None):
+        """通し日数で [start, end) の範囲、カテゴリで絞り込むブールマスク"""
+        mask = np.ones(len(self.ids), dtype=bool)
+        if start is not None:
+            mask &= self.days >= start
+        if end is not None:
+            mask &= self.days < end
+        if category is not None:
+            code = self.category_codes.get(getattr(category, 'pk', category))
+            if code is None:
+                return np.zeros(len(self.ids), dtype=bool)
+            mask &= self.categories == code
+        return mask
+
+    def totals_by_category(self, mask):
+        """カテゴリのpk -> 合計金額"""
+        codes = self.categories[mask]
+        sums = np.bincount(codes, weights=self.prices[mask], minlength=len(self.category_ids))
+        counts = np.bincount(codes, minlength=len(self.category_ids))
+        return {self.category_ids[code]: int(sums[code]) for code in np.flatnonzero(counts)}
+
+    def totals_by_day(self, mask):
+        """行のある日付と、その日の合計金額"""
+        days = self.days[mask]
+        if not len(days):
+            return [], []
+        offset = days.min()
+        sums = np.bincount(days - offset, weights=self.prices[mask])
+        counts = np.bincount(days - offset)
+        present = np.flatnonzero(counts)
+        return [from_day(day + offset) for day in present], [int(total) for total in sums[present]]
+
+    def totals_by_month(self, mask):
+        """行のある年月('YYYY-MM')と、その月の合計金額"""
+        days = self.days[mask]
+        if not len(days):
+            return [], []
+        months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        offset = months.min()
+        sums = np.bincount(months - offset, weights=self.prices[mask])
+        counts = np.bincount(months - offset)
+        present = np.flatnonzero(counts)
+        labels = (present + offset).astype('datetime64[M]').astype(str)
+        return list(labels), [int(total) for total in sums[present]]
+
+    def totals_by_month_and_category(self, start, end):
+        """月の通し番号(1970年1月が0)で [start, end) の各月の、カテゴリ別の合計金額
+
+        (カテゴリのpkのリスト, 月×カテゴリの行列) を返す。
+        """
+        months = self.days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        mask = (months >= start) & (months < end)
+        width = len(self.category_ids)
+        index = (months[mask] - start) * width + self.categories[mask]
+        sums = np.bincount(index, weights=self.prices[mask], minlength=(end - start) * width)
+        return list(self.category_ids), sums.reshape(end - start, width)
+
+
+EMPTY_COLUMNS = LedgerColumns(np.empty(0, dtype=np.int64),
+                              np.empty(0, dtype=np.int32),
+                              np.empty(0, dtype=np.int64),
+                              np.empty(0, dtype=np.int16),
+                              [])
+
+
+class CombinedColumns:
+    """複数の列(凍結済みの年のアーカイブと、未凍結分のスナップショット)をまとめて集計する
+
+    マスクは列ごとのマスクのリストになる。
+    """
+
+    def __init__(self, segments):
+        self.segments = [segment for segment in segments if len(segment)]
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    @property
+    def nbytes(self):
+        return sum(segment.nbytes for segment in self.segments)
+
+    def mask(self, start=None, end=None, category=None):
+        return [segment.mask(start, end, category) for segment in self.segments]
+
+    @staticmethod
+    def any(mask):
+        return any(segment_mask.any() for segment_mask in mask)
+
+    def totals_by_category(self, mask):
+        totals = defaultdict(int)
+        for segment, segment_mask in zip(self.segments, mask):
+            for category_id, total in segment.totals_by_category(segment_mask).items():
+                totals[category_id] += total
+        return dict(totals)
+
+    def _merge_series(self, method, mask):
+        totals = defaultdict(int)
+        for segment, segment_mask in zip(self.segments, mask):
+            for key, total in zip(*getattr(segment, method)(segment_mask)):
+                totals[key] += total
+        keys = sorted(totals)
+        return keys, [totals[key] for key in keys]
+
+    def totals_by_day(self, mask):
+        return self._merge_series('totals_by_day', mask)
+
+    def totals_by_month(self, mask):
+        return self._merge_series('totals_by_month', mask)
+
+    def totals_by_month_and_category(self, start, end):
+        category_ids = sorted({category_id for segment in self.segments for category_id in segment.category_ids})
+        positions = {category_id: position for position, category_id in enumerate(category_ids)}
+        matrix = np.zeros((end - start, len(category_ids)))
+        for segment in self.segments:
+            segment_ids, segment_matrix = segment.totals_by_month_and_category(start, end)
+            matrix[:, [positions[category_id] for category_id in segment_ids]] += segment_matrix
+        return category_ids, matrix
@@ -0,0 +1,112 @@
+"""レスポンスの圧縮とhtmlの縮小
+
+グラフのhtml(plotlyのfig.to_html)は大きく、繰り返しの多いJSONを含む。
+グラフの断片はキャッシュに入れる時点で縮小・圧縮しておき(Fragment)、
+gzipで返す際は、断片の前後だけをその場で圧縮して、圧縮済みの断片とつなぎ合わせる。
+deflateの圧縮データは Z_SYNC_FLUSH で区切るとバイト境界で終わるため、別々に圧縮したものを連結できる。
+"""
+import re
+import struct
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# deflateが参照できる直前のデータの長さ
+WINDOW_SIZE = 32 * 1024
+# 改行を含むタグ間の空白
+TAG_WHITESPACE = re.compile(rb'>\s*\n\s*<')
+# 空白に意味のある要素
+PRESERVE_WHITESPACE = re.compile(rb'<(pre|textarea)[\s>]', re.IGNORECASE)
+
+
+def minify(content):
+    """タグ間の改行とインデントを改行一つにまとめる。表示は変わらない"""
+    if PRESERVE_WHITESPACE.search(content):
+        return content
+    return TAG_WHITESPACE.sub(b'>\n<', content)
+
+
+def deflate_block(data, zdict=None):
+    """他の圧縮データと連結できる、終端の無いdeflateの圧縮データ"""
+    if zdict:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Fragment(str):
+    """縮小済みのhtmlの断片。deflateで圧縮したデータを添えてキャッシュする"""
+    deflated = b''
+
+
+def fragment(html):
+    if not html:
+        return html
+    data = minify(html.encode())
+    result = Fragment(data.decode())
+    result.deflated = deflate_block(data)
+    return result
+
+
+def attach(request, *fragments):
+    """レスポンスに含まれる圧縮済みの断片を、圧縮を行うミドルウェアに知らせる"""
+    attached = request.__dict__.setdefault('_compressed_fragments', [])
+    attached.extend(fragment for fragment in fragments if isinstance(fragment, Fragment))
+
+
+def gzip_compress(content, fragments=()):
+    """gzip形式で圧縮する。fragments に含まれる断片は、圧縮済みのデータをそのまま使う"""
+    blocks = []
+    position = 0
+    located = []
+    for item in fragments:
+        data = item.encode()
+        index = content.find(data)
+        if index >= 0:
+            located.append((index, data, item.deflated))
+    for index, data, deflated in sorted(located, key=lambda located_item: located_item[0]):
+        if index < position:
+            continue
+        if index > position:
+            blocks.append(deflate_block(content[position:index], content[max(0, position - WINDOW_SIZE):position]))
+        blocks.append(deflated)
+        position = index + len(data)
+
+    # 残りを圧縮して終端のブロックを付ける
+    if position:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zdict=content[max(0, position - WINDOW_SIZE):position])
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    blocks.append(compressor.compress(content[position:]) + compressor.flush(zlib.Z_FINISH))
+
+    header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+    trailer = struct.pack('<II', zlib.crc32(content), len(content) & 0xffffffff)
+    return header + b''.join(blocks) + trailer
+
+
+def brotli_compress(content):
+    return brotli.compress(content, quality=BROTLI_QUALITY)
+
+
+def accepted_encodings(header):
+    """Accept-Encoding で受け付けると示された(q=0でない)エンコーディング"""
+    encodings = set()
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            encodings.add(name.strip().lower())
+    return encodings
@@ -0,0 +1,101 @@
+"""支出の重複の検出
+
+完全に同じ明細は Payment.fingerprint の一意制約で防ぐ。
+ここでは銀行明細の取り込み日のずれなどによる「ほぼ同じ」明細を、
+世帯・金額・日付で並べ替えてから前後の近い行だけを比べる方法(ソートマージ)で探す。
+全ての組を比べる O(n^2) にはならず、O(n log n) で済む。
+
+重複は削除に使うため、疑わしい場合は候補にしない。
+移行(0005)で完全な重複として指紋を付けずに残した行は find_unfingerprinted で探す。
+
+- 各行はグループの最初の行とだけ比べ、グループの日付の幅は window_days 以内に収める(候補が連鎖して広がらない)
+- 摘要が空欄の行は、同じ支出かどうかの手がかりが無いため候補にしない
+- 毎日の電車代のように、グループの前後 window_days 以内にも同じ金額の似た支出がある場合は、
+  繰り返しの支出とみなして候補にしない
+"""
+import bisect
+import datetime
+import itertools
+from .models import Payment
+from .normalize import normalize
+
+# 日付がこの日数以内なら重複の候補とみなす
+DEFAULT_WINDOW_DAYS = 3
+# IN句に渡す値の数の上限
+LOOKUP_BATCH_SIZE = 500
+
+
+def similar_description(a, b):
+    """正規化した摘要が同じ、または片方がもう片方を含む。空欄はどの摘要とも似ていないとみなす"""
+    return bool(a) and bool(b) and (a in b or b in a)
+
+
+def _group_run(rows, window_days):
+    """同じ世帯・金額の (pk, 日付, 正規化した摘要) の日付順のリストから、重複のグループを探す"""
+    groups = []
+    open_groups = []
+    for row in rows:
+        _, date, description = row
+        open_groups = [group for group in open_groups if (date - group[0][1]).days <= window_days]
+        for group in open_groups:
+            if similar_description(description, group[0][2]):
+                group.append(row)
+                break
+        else:
+            group = [row]
+            open_groups.append(group)
+            groups.append(group)
+
+    dates = [row[1] for row in rows]
+    duplicates = []
+    for group in groups:
+        if len(group) < 2:
+            continue
+        # グループの前後 window_days 以内に、グループに入らなかった似た支出があれば繰り返しの支出
+        members = {row[0] for row in group}
+        window = datetime.timedelta(days=window_days)
+        start = bisect.bisect_left(dates, group[0][1] - window)
+        end = bisect.bisect_right(dates, group[-1][1] + window)
+        if any(row[0] not in members and similar_description(row[2], group[0][2]) for row in rows[start:end]):
+            continue
+        duplicates.append(sorted(members))
+    return duplicates
+
+
+def find_near_duplicates(queryset=None, window_days=DEFAULT_WINDOW_DAYS):
+    """重複と思われる支出のpkのグループのリスト。各グループはpkの昇順"""
+    if queryset is None:
+        queryset = Payment.objects.all()
+    rows = (queryset.exclude(description__isnull=True).exclude(description='')
+            .order_by('owner', 'price', 'date', 'id')
+            .values_list('owner_id', 'price', 'id', 'date', 'description'))
+
+    groups = []
+    for _, run in itertools.groupby(rows.iterator(), key=lambda row: row[:2]):
+        run = [(pk, date, normalize(description)) for _, _, pk, date, description in run]
+        groups.extend(_group_run(run, window_days))
+    return groups
+
+
+def find_unfingerprinted(queryset=None):
+    """指紋の無い支出のpkと、同じ明細で指紋のある支出のpkの組のリスト
+
+    同じ明細の支出が無い場合(元の行をゴミ箱に移した場合など)はNoneを組にする。
+    同じ明細の指紋の無い支出が複数ある場合は、最初の行をNoneと、残りをその行と組にする。
+    """
+    if queryset is None:
+        queryset = Payment.objects.all()
+    rows = [(pk, (owner_id, Payment.build_fingerprint(date, price, description)))
+            for pk, owner_id, date, price, description in queryset.filter(fingerprint__isnull=True)
+            .order_by('id').values_list('id', 'owner_id', 'date', 'price', 'description').iterator()]
+    fingerprints = sorted({fingerprint for _, (_, fingerprint) in rows})
+    originals = {}
+    for start in range(0, len(fingerprints), LOOKUP_BATCH_SIZE):
+        originals.update(((owner_id, fingerprint), pk) for pk, owner_id, fingerprint in Payment.objects.filter(
+            fingerprint__in=fingerprints[start:start + LOOKUP_BATCH_SIZE]).values_list('id', 'owner_id', 'fingerprint'))
+
+    pairs = []
+    for pk, key in rows:
+        pairs.append((pk, originals.get(key)))
+        originals.setdefault(key, pk)
+    return pairs
@@ -0,0 +1,146 @@
+"""一覧の絞り込み
+
+検索フォームの項目と、インデックスを使える条件の対応を FilterSet に宣言し、
+支出一覧・収入一覧・入出金明細で共通に使う。
+条件は一つのQにまとめて一度の filter() で渡すため、結合やサブクエリは増えない。
+
+- 年・月は date__year のような関数ではなく日付の範囲にし、(owner, date) のインデックスで範囲を読む
+  (年を選ばずに月だけを選んだ場合は範囲にできないため、date__month のまま)
+- 金額は範囲、カテゴリは複数選択を IN で絞る
+- キーワードは空白で区切った語をすべて含む行(AND)。SQLiteには日本語を扱える全文検索が無いため部分一致とし、
+  インデックスで絞った後の行に対して評価される
+
+settings.DEBUG のときは、一覧のURLに explain=1 を付けると、クエリと実行計画(どのインデックスを使ったか)を表示する。
+"""
+import datetime
+from django.db.models import Model, Q
+from .columns import month_dates
+
+
+def _int(value):
+    """選択肢の未選択('0'や空欄)はNone"""
+    try:
+        return int(value) or None
+    except (TypeError, ValueError):
+        return None
+
+
+class Filter:
+    """フォームの項目の値から条件(Q)を作る"""
+
+    def q(self, cleaned_data):
+        """条件。絞り込まない場合はNone"""
+        raise NotImplementedError
+
+
+class PeriodFilter(Filter):
+    """年・月の選択を日付の範囲にする"""
+
+    def __init__(self, field, year='year', month='month'):
+        self.field = field
+        self.year = year
+        self.month = month
+
+    def q(self, cleaned_data):
+        year = _int(cleaned_data.get(self.year))
+        month = _int(cleaned_data.get(self.month))
+        if year and month:
+            start, end = month_dates(year, month)
+        elif year:
+            start = datetime.date(year, 1, 1)
+            end = datetime.date(year + 1, 1, 1)
+        elif month:
+            return Q(**{f'{self.field}__month': month})
+        else:
+            return None
+        return Q(**{f'{self.field}__gte': start, f'{self.field}__lt': end})
+
+
+class RangeFilter(Filter):
+    """下限・上限(どちらも含む)"""
+
+    def __init__(self, field, lower, upper):
+        self.field = field
+        self.lower = lower
+        self.upper = upper
+
+    def q(self, cleaned_data):
+        lookups = {}
+        if cleaned_data.get(self.lower) is not None:
+            lookups[f'{self.field}__gte'] = cleaned_data[self.lower]
+        if cleaned_data.get(self.upper) is not None:
+            lookups[f'{self.field}__lte'] = cleaned_data[self.upper]
+        return Q(**lookups) if lookups else None
+
+
+class KeywordFilter(Filter):
+    """空白で区切った語をすべて含む"""
+
+    def __init__(self, field, name):
+        self.field = field
+        self.name = name
+
+    def q(self, cleaned_data):
+        words = (cleaned_data.get(self.name) or '').split()
+        if not words:
+            return None
+        q = Q()
+        for word in words:
+            q &= Q(**{f'{self.field}__icontains': word})
+        return q
+
+
+class InFilter(Filter):
+    """選択したいずれかに一致する。モデルの選択は、サブクエリにならないようpkの一覧にする"""
+
+    def __init__(self, field, name):
+        self.field = field
+        self.name = name
+
+    def q(self, cleaned_data):
+        values = cleaned_data.get(self.name)
+        if not values:
+            return None
+        if isinstance(values, Model):
+            values = [values]
+        return Q(**{f'{self.field}__in': [value.pk if isinstance(value, Model) else value for value in values]})
+
+
+class FilterSet:
+    """絞り込みの宣言。filters の条件をすべて満たす行に絞る"""
+
+    def __init__(self, *filters):
+        self.filters = filters
+
+    def q(self, cleaned_data):
+        q = Q()
+        for item in self.filters:
+            condition = item.q(cleaned_data)
+            if condition is not None:
+                q &= condition
+        return q
+
+    def apply(self, queryset, cleaned_data):
+        return queryset.filter(self.q(cleaned_data))
+
+
+# 入出金明細。カテゴリは支出と収入で異なるため、絞り込まない
+LEDGER_FILTERS = FilterSet(
+    PeriodFilter('date'),
+    RangeFilter('price', lower='greater_than', upper='less_than'),
+    KeywordFilter('description', 'key_word'),
+)
+
+# 支出一覧・収入一覧
+LIST_FILTERS = FilterSet(
+    *LEDGER_FILTERS.filters,
+    InFilter('category_id', 'category'),
+)
+
+
+def explain(queryset):
+    """クエリと実行計画。実行計画の書式はデータベースごとに異なる"""
+    return {
+        'sql': str(queryset.query),
+        'plan': queryset.explain(),
+    }
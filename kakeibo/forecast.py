@@ -0,0 +1,187 @@
+"""支出の着地見込み(月末・年末)
+
+スナップショットの列(snapshot.py)から、過去の月×カテゴリの合計金額の行列を np.bincount で一度に作り、
+全カテゴリをまとめて配列で計算する。データベースの行は読み直さない。
+
+- 月末の見込み: 今月の支出済み額 + 残りの日数分の見込み。
+  残りは、今月のこれまでのペース(支出済み額 / 経過した割合)と、普段の月の額(直近12か月の平均 × 季節性)を、
+  経過した割合で重み付けして混ぜる。月の後半ほど今月のペースを重く見る。
+- 季節性: 同じ月(例えば過去の12月)の平均 / 全月の平均。同じ月の件数が少ないうちは1に寄せる。
+- 年末の見込み: 今年の先月までの支出額 + 今月の月末の見込み + 来月以降の各月の普段の額。
+- 見込みの幅: 過去の月の額(季節性を除く)の標準偏差から、正規分布を仮定した95%の区間。
+  カテゴリ間は独立とみなして合計の幅を求める。
+
+予測は今月についてだけ行う(過去の月は実績が確定しているため)。
+"""
+import calendar
+import datetime
+from dataclasses import dataclass, field
+import numpy as np
+from django.utils import timezone
+from .columns import month_range, to_day
+
+# 参照する過去の月数
+HISTORY_MONTHS = 36
+# 普段の月の額に使う直近の月数
+LEVEL_MONTHS = 12
+# 95%の区間
+Z_95 = 1.96
+
+
+def month_number(year, month):
+    """1970年1月を0とする月の通し番号(columns.py の月の番号と同じ)"""
+    return (year - 1970) * 12 + month - 1
+
+
+@dataclass
+class Projection:
+    """カテゴリ(category_id がNoneなら全体)の見込み。low, high は95%の区間"""
+    category_id: int
+    spent: int
+    month_end: int
+    month_low: int
+    month_high: int
+    year_spent: int
+    year_end: int
+    year_low: int
+    year_high: int
+
+
+@dataclass
+class Forecast:
+    as_of: datetime.date
+    year: int
+    month: int
+    categories: list
+    total: Projection
+    # 日別のグラフに重ねる、残りの日の1日あたりの見込み
+    daily_dates: list = field(default_factory=list)
+    daily_expected: list = field(default_factory=list)
+    daily_low: list = field(default_factory=list)
+    daily_high: list = field(default_factory=list)
+    # 推移グラフに重ねる、今月から12月までの各月の見込み(カテゴリごとと全体)
+    month_labels: list = field(default_factory=list)
+    monthly: dict = field(default_factory=dict)
+
+    def for_category(self, category_id=None):
+        """推移グラフ用の (年月, 見込み, 下限, 上限)"""
+        expected, low, high = self.monthly.get(category_id, ([], [], []))
+        return self.month_labels, expected, low, high
+
+
+def _seasonal_factors(history, calendar_months, valid):
+    """カテゴリ×暦月(0〜11)の季節性の係数"""
+    overall = history[valid].mean(axis=0)
+    factors = np.ones((12, history.shape[1]))
+    for calendar_month in range(12):
+        rows = valid & (calendar_months == calendar_month)
+        count = rows.sum()
+        if not count:
+            continue
+        with np.errstate(divide='ignore', invalid='ignore'):
+            raw = np.where(overall > 0, history[rows].mean(axis=0) / overall, 1.0)
+        # 同じ月の件数が少ないうちは1に寄せる
+        factors[calendar_month] = 1 + (raw - 1) * count / (count + 1)
+    return factors
+
+
+def month_forecast(columns, year, month, today=None):
+    """今月の月末と年末の見込み。今月以外、または過去の月にも今月にも支出が無い場合はNone"""
+    today = today or timezone.localdate()
+    if (year, month) != (today.year, today.month):
+        return None
+
+    current = month_number(year, month)
+    start = current - HISTORY_MONTHS
+    category_ids, history = columns.totals_by_month_and_category(start, current)
+    month_start, month_end = month_range(year, month)
+    spent_by_category = columns.totals_by_category(columns.mask(month_start, to_day(today) + 1))
+    for category_id in spent_by_category:
+        if category_id not in category_ids:
+            category_ids.append(category_id)
+            history = np.hstack([history, np.zeros((HISTORY_MONTHS, 1))])
+    spent = np.array([spent_by_category.get(category_id, 0) for category_id in category_ids], dtype=float)
+    # 家計簿を付け始めた月より前は、支出が0だったのではなく記録が無いだけなので使わない
+    recorded = np.flatnonzero(history.sum(axis=1))
+    if not len(recorded) and not spent.any():
+        return None
+    valid = np.zeros(HISTORY_MONTHS, dtype=bool)
+    if len(recorded):
+        valid[recorded[0]:] = True
+    calendar_months = (np.arange(start, current)) % 12
+
+    days_in_month = calendar.monthrange(year, month)[1]
+    elapsed = today.day / days_in_month
+    pace = spent / elapsed
+
+    if valid.any():
+        factors = _seasonal_factors(history, calendar_months, valid)
+        level_rows = valid.copy()
+        level_rows[:-LEVEL_MONTHS] = False
+        if not level_rows.any():
+            level_rows = valid
+        deseasonalized = history / factors[calendar_months]
+        level = deseasonalized[level_rows].mean(axis=0)
+        if valid.sum() > 1:
+            sigma = deseasonalized[valid].std(axis=0, ddof=1)
+        else:
+            sigma = level * 0.5
+    else:
+        # 過去の月が無い場合は今月のペースだけで見込み、幅は広めにとる
+        factors = np.ones((12, len(category_ids)))
+        level = pace
+        sigma = pace * 0.5
+    expected = level * factors[month - 1]
+
+    remaining = (1 - elapsed) * (elapsed * pace + (1 - elapsed) * expected)
+    month_total = spent + remaining
+    month_sigma = sigma * np.sqrt(1 - elapsed)
+
+    # 今年の先月までの支出額
+    year_rows = np.arange(start, current) >= month_number(year, 1)
+    year_spent = history[year_rows].sum(axis=0) + spent
+    future = factors[month:12] * level
+    year_total = history[year_rows].sum(axis=0) + month_total + future.sum(axis=0)
+    year_sigma = np.sqrt(month_sigma ** 2 + (12 - month) * sigma ** 2)
+
+    def projection(category_id, spent, month_total, month_sigma, year_spent, year_total, year_sigma):
+        return Projection(
+            category_id=category_id,
+            spent=int(round(spent)),
+            month_end=int(round(month_total)),
+            month_low=int(round(max(spent, month_total - Z_95 * month_sigma))),
+            month_high=int(round(month_total + Z_95 * month_sigma)),
+            year_spent=int(round(year_spent)),
+            year_end=int(round(year_total)),
+            year_low=int(round(max(year_spent, year_total - Z_95 * year_sigma))),
+            year_high=int(round(year_total + Z_95 * year_sigma)),
+        )
+
+    categories = [projection(category_id, *values) for category_id, *values
+                  in zip(category_ids, spent, month_total, month_sigma, year_spent, year_total, year_sigma)]
+    total = projection(None, spent.sum(), month_total.sum(), np.sqrt((month_sigma ** 2).sum()),
+                       year_spent.sum(), year_total.sum(), np.sqrt((year_sigma ** 2).sum()))
+    forecast = Forecast(today, year, month, categories, total)
+
+    days_left = days_in_month - today.day
+    if days_left:
+        forecast.daily_dates = [today + datetime.timedelta(days=day) for day in range(1, days_left + 1)]
+        forecast.daily_expected = [round((total.month_end - total.spent) / days_left)] * days_left
+        forecast.daily_low = [round((total.month_low - total.spent) / days_left)] * days_left
+        forecast.daily_high = [round((total.month_high - total.spent) / days_left)] * days_left
+
+    # 今月は月末の見込み、来月以降は普段の月の額
+    forecast.month_labels = [f'{year}-{calendar_month:02d}' for calendar_month in range(month, 13)]
+    monthly_expected = np.vstack([month_total, future])
+    monthly_sigma = np.vstack([month_sigma, np.tile(sigma, (12 - month, 1))])
+    for position, category_id in enumerate([*category_ids, None]):
+        if category_id is None:
+            values = monthly_expected.sum(axis=1)
+            spread = Z_95 * np.sqrt((monthly_sigma ** 2).sum(axis=1))
+        else:
+            values = monthly_expected[:, position]
+            spread = Z_95 * monthly_sigma[:, position]
+        forecast.monthly[category_id] = ([int(round(value)) for value in values],
+                                         [int(round(max(value, 0))) for value in values - spread],
+                                         [int(round(value)) for value in values + spread])
+    return forecast
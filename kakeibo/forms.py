@@ -1,11 +1,26 @@
 from django import forms
-from .models import PaymentCategory, Payment, Income, IncomeCategory
+from .models import PaymentCategory, Payment, Income, IncomeCategory, ReportJob
 from django.utils import timezone
-from .widgets import CustomRadioSelect
+from .widgets import CustomRadioSelect, CustomCheckboxSelectMultiple
+from .categorizer import suggest_category
+from .reports import available_formats
 
 
-class PaymentSearchForm(forms.Form):
-    """支出検索フォーム"""
+class HouseholdFormMixin:
+    """カテゴリの選択肢を、ログイン中のユーザーの世帯のものに絞る"""
+    category_fields = ()
+
+    def __init__(self, *args, owner=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.owner = owner
+        if owner is not None:
+            for name in self.category_fields:
+                field = self.fields[name]
+                field.queryset = field.queryset.filter(owner=owner)
+
+
+class ListSearchForm(HouseholdFormMixin, forms.Form):
+    """支出・収入・入出金明細に共通の検索項目"""
 
     start_year = 2019  # 家計簿の登録を始めた年
     end_year = timezone.now().year + 1
@@ -56,73 +71,105 @@ class PaymentSearchForm(forms.Form):
                                       })
     )
 
-    category = forms.ModelChoiceField(
+
+class PaymentSearchForm(ListSearchForm):
+    """支出検索フォーム"""
+    category_fields = ('category',)
+
+    category = forms.ModelMultipleChoiceField(
         label='カテゴリでの絞り込み',
         required=False,
         queryset=PaymentCategory.objects.order_by('name'),
-        widget=CustomRadioSelect
+        widget=CustomCheckboxSelectMultiple
     )
 
 
-class IncomeSearchForm(forms.Form):
+class IncomeSearchForm(ListSearchForm):
     """収入検索フォーム"""
-    start_year = 2019
-    end_year = timezone.now().year + 1
-    years = [(year, f'{year}年') for year in reversed(range(start_year, end_year + 1))]
-    years.insert(0, (0, ''))
-    YEAR_CHOICES = tuple(years)
-
-    months = [(month, f'{month}月') for month in range(1, 13)]
-    months.insert(0, (0, ''))
-    MONTH_CHOICES = tuple(months)
+    category_fields = ('category',)
 
-    year = forms.ChoiceField(
-        label='年での絞り込み',
+    category = forms.ModelMultipleChoiceField(
+        label='カテゴリでの絞り込み',
         required=False,
-        choices=YEAR_CHOICES,
-        widget=forms.Select(attrs={'class': 'form', 'value': ''})
+        queryset=IncomeCategory.objects.order_by('name'),
+        widget=CustomCheckboxSelectMultiple
     )
 
-    month = forms.ChoiceField(
-        label='月での絞り込み',
+
+class LedgerSearchForm(ListSearchForm):
+    """入出金明細の検索フォーム。カテゴリは支出と収入で異なるため、種類で絞る"""
+    KIND_CHOICES = (
+        ('', 'すべて'),
+        ('payment', '支出'),
+        ('income', '収入'),
+    )
+
+    kind = forms.ChoiceField(
+        label='種類での絞り込み',
         required=False,
-        choices=MONTH_CHOICES,
+        choices=KIND_CHOICES,
         widget=forms.Select(attrs={'class': 'form'})
     )
 
 
-class PaymentCreateForm(forms.ModelForm):
+class PaymentCreateForm(HouseholdFormMixin, forms.ModelForm):
     """支出登録フォーム"""
+    category_fields = ('category',)
+    # カテゴリを選ばなかった場合に、摘要から自動分類したかどうか
+    auto_categorized = False
 
     class Meta:
         model = Payment
-        fields = '__all__'
+        exclude = ('owner',)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        if self.owner is not None:
+            self.instance.owner = self.owner
         for field in self.fields.values():
             field.widget.attrs['class'] = 'form'
             field.widget.attrs['placeholder'] = field.label
             field.widget.attrs['autocomplete'] = 'off'
-
-
-class IncomeCreateForm(forms.ModelForm):
+        # 摘要があればカテゴリは自動分類できるため、未選択を許す
+        self.fields['category'].required = False
+        self.fields['category'].empty_label = 'カテゴリ(空欄なら摘要から自動分類)'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('category') and 'category' not in self.errors:
+            category_id = None
+            if cleaned_data.get('description'):
+                category_id = suggest_category(self.instance.owner_id, cleaned_data['description'])
+            if category_id is None:
+                self.add_error('category', 'カテゴリを選択するか、摘要を入力してください')
+            else:
+                cleaned_data['category'] = PaymentCategory.objects.get(pk=category_id)
+                self.auto_categorized = True
+        # 同じ明細の二重登録は Payment.clean で検証する
+        return cleaned_data
+
+
+class IncomeCreateForm(HouseholdFormMixin, forms.ModelForm):
     """収入登録フォーム"""
+    category_fields = ('category',)
 
     class Meta:
         model = Income
-        fields = '__all__'
+        exclude = ('owner',)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        if self.owner is not None:
+            self.instance.owner = self.owner
         for field in self.fields.values():
             field.widget.attrs['class'] = 'form'
             field.widget.attrs['placeholder'] = field.label
             field.widget.attrs['autocomplete'] = 'off'
 
 
-class TransitionGraphSearchForm(forms.Form):
+class TransitionGraphSearchForm(HouseholdFormMixin, forms.Form):
     """推移グラフの絞り込みフォーム"""
+    category_fields = ('payment_category', 'income_category')
 
     SHOW_CHOICES = (
         ('Payment', 'Payment'),
@@ -148,3 +195,35 @@ class TransitionGraphSearchForm(forms.Form):
                                       choices=SHOW_CHOICES,
                                       widget=CustomRadioSelect
                                       )
+
+
+class ReportJobForm(HouseholdFormMixin, forms.ModelForm):
+    """集計レポートの作成依頼フォーム"""
+    # 一度に作成できる年数
+    max_years = 30
+
+    class Meta:
+        model = ReportJob
+        fields = ('kind', 'file_format', 'start_year', 'end_year')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.owner is not None:
+            self.instance.owner = self.owner
+        self.fields['file_format'].choices = available_formats()
+        this_year = timezone.localdate().year
+        self.fields['start_year'].initial = this_year
+        self.fields['end_year'].initial = this_year
+        for field in self.fields.values():
+            field.widget.attrs['class'] = 'form'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start_year = cleaned_data.get('start_year')
+        end_year = cleaned_data.get('end_year')
+        if start_year and end_year:
+            if start_year > end_year:
+                raise forms.ValidationError('開始年は終了年以前にしてください')
+            if end_year - start_year + 1 > self.max_years:
+                raise forms.ValidationError(f'一度に作成できるのは{self.max_years}年分までです')
+        return cleaned_data
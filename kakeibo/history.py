@@ -0,0 +1,63 @@
+"""支出・収入の変更履歴
+
+書き込みのシグナルや一括書き込みから履歴の行を組み立て、bulk_create でまとめて追記する。
+"""
+from .models import ChangeLog
+
+# 履歴に残す項目
+FIELDS = ('date', 'price', 'category_id', 'description')
+# 変更の判定に使う項目。削除日時は操作の種類(削除・復元)として記録する
+TRACKED_FIELDS = FIELDS + ('deleted_at',)
+BATCH_SIZE = 1000
+
+
+def current_values(instance):
+    return {field: getattr(instance, field) for field in FIELDS}
+
+
+def build_entry(instance, original=None, created=False):
+    """保存された行の履歴を作る。変更が無ければ None"""
+    if created or original is None:
+        action, changes = 'create', current_values(instance)
+    elif original['deleted_at'] is None and instance.deleted_at is not None:
+        action, changes = 'delete', {}
+    elif original['deleted_at'] is not None and instance.deleted_at is None:
+        action, changes = 'restore', {}
+    else:
+        action = 'update'
+        changes = {field: [original[field], value] for field, value in current_values(instance).items()
+                   if original[field] != value}
+        if not changes:
+            return None
+    return ChangeLog(owner_id=instance.owner_id,
+                     kind=type(instance).__name__,
+                     object_id=instance.pk,
+                     action=action,
+                     changes=changes,
+                     user=getattr(instance, '_changed_by', None))
+
+
+def build_purge_entry(instance):
+    """完全に削除された行の履歴。最後の値を残しておく"""
+    return ChangeLog(owner_id=instance.owner_id,
+                     kind=type(instance).__name__,
+                     object_id=instance.pk,
+                     action='purge',
+                     changes=current_values(instance),
+                     user=getattr(instance, '_changed_by', None))
+
+
+def record(entries):
+    """履歴をまとめて追記する"""
+    entries = [entry for entry in entries if entry is not None]
+    if entries:
+        ChangeLog.objects.bulk_create(entries, batch_size=BATCH_SIZE)
+
+
+def fold_updates(changes_list):
+    """連続した更新の変更内容を、最初の変更前と最後の変更後の一つにまとめる。元に戻った項目は除く"""
+    folded = {}
+    for changes in changes_list:
+        for field, (before, after) in changes.items():
+            folded[field] = [folded[field][0] if field in folded else before, after]
+    return {field: values for field, values in folded.items() if values[0] != values[1]}
@@ -0,0 +1,110 @@
+"""支出と収入を日付順に並べた入出金の明細
+
+支出・収入のそれぞれに同じ絞り込み(filters.LEDGER_FILTERS)を行い、一つの UNION ALL のクエリで日付の新しい順に取得する。
+ページ送りはOFFSETではなく、前のページの最後の行(日付・種類・pk)より後ろを取得する(キーセット)。
+残高(絞り込んだ明細の累計)は、最初のページでは合計を集計し(UNION ALLの1クエリ)、
+以降のページは前のページの最後の残高(チェックポイント)をカーソルに入れて引き継ぐため、再集計しない。
+カーソルは改ざんされないよう署名する。
+カーソルが古くなったか(取得後に明細が書き換えられたか)は判定しない。位置は日付・種類・pkで表すため、
+カーソルの行が削除されていても続きから取得できるが、残高は最初のページを表示した時点のものを引き継ぐ。
+"""
+import datetime
+from dataclasses import dataclass
+from django.core import signing
+from django.db.models import F, Q, Sum, Value
+from .filters import LEDGER_FILTERS
+from .models import Payment, Income
+
+CURSOR_SALT = 'kakeibo.ledger'
+
+# 種類, モデル, 残高に対する符号
+KINDS = (
+    ('payment', Payment, -1),
+    ('income', Income, 1),
+)
+FIELDS = ('kind', 'id', 'date', 'price', 'amount', 'category_name', 'description')
+
+
+@dataclass(frozen=True)
+class Cursor:
+    """ページの続きの位置。前のページの最後の行と、次に表示する行までの残高"""
+    date: datetime.date
+    kind: str
+    id: int
+    balance: int
+
+    def dumps(self):
+        return signing.dumps([self.date.isoformat(), self.kind, self.id, self.balance], salt=CURSOR_SALT)
+
+    @classmethod
+    def loads(cls, value):
+        """署名や形式が不正なカーソルはNone(最初のページ)として扱う"""
+        try:
+            date, kind, pk, balance = signing.loads(value, salt=CURSOR_SALT)
+            return cls(datetime.date.fromisoformat(date), kind, int(pk), int(balance))
+        except (signing.BadSignature, TypeError, ValueError):
+            return None
+
+
+@dataclass
+class LedgerPage:
+    rows: list
+    next_cursor: Cursor = None
+
+
+def _after(kind, cursor):
+    """並び順(日付・種類・pkの降順)で、カーソルより後ろの行の条件。種類は各クエリで一定"""
+    if kind < cursor.kind:
+        return Q(date__lte=cursor.date)
+    if kind > cursor.kind:
+        return Q(date__lt=cursor.date)
+    return Q(date__lt=cursor.date) | Q(date=cursor.date, id__lt=cursor.id)
+
+
+class Ledger:
+    """世帯の入出金の明細。kinds で支出・収入の一方だけに絞れる"""
+
+    def __init__(self, owner_id, cleaned_data=None, kinds=None):
+        self.owner_id = owner_id
+        self.cleaned_data = cleaned_data or {}
+        self.kinds = [item for item in KINDS if not kinds or item[0] in kinds]
+
+    def _filtered(self, model):
+        return LEDGER_FILTERS.apply(model.objects.filter(owner_id=self.owner_id), self.cleaned_data).order_by()
+
+    def _combine(self, querysets):
+        first, *rest = querysets
+        return first.union(*rest, all=True) if rest else first
+
+    def balance(self):
+        """絞り込んだ明細全体の残高(収入 - 支出)"""
+        querysets = [self._filtered(model).values('owner_id').annotate(total=Sum('price') * sign).values('total')
+                     for _, model, sign in self.kinds]
+        return sum(row['total'] for row in self._combine(querysets))
+
+    def page_queryset(self, cursor=None, limit=20):
+        """cursor の続きから limit 件を取得するクエリ"""
+        querysets = []
+        for kind, model, sign in self.kinds:
+            queryset = self._filtered(model)
+            if cursor is not None:
+                queryset = queryset.filter(_after(kind, cursor))
+            querysets.append(queryset.values(kind=Value(kind), amount=F('price') * sign,
+                                             category_name=F('category__name'))
+                             .values(*FIELDS))
+        return self._combine(querysets).order_by('-date', '-kind', '-id')[:limit]
+
+    def page(self, cursor=None, size=20):
+        """cursor の続きから size 件を取得する。各行には、その行までの残高を付ける"""
+        rows = list(self.page_queryset(cursor, size + 1))
+
+        balance = self.balance() if cursor is None else cursor.balance
+        for row in rows:
+            row['balance'] = balance
+            balance -= row['amount']
+
+        if len(rows) <= size:
+            return LedgerPage(rows)
+        rows = rows[:size]
+        last = rows[-1]
+        return LedgerPage(rows, Cursor(last['date'], last['kind'], last['id'], last['balance'] - last['amount']))
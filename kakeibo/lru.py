@@ -0,0 +1,43 @@
+"""プロセス内に世帯ごとに保持するデータの、件数に上限のある入れ物"""
+import threading
+from collections import OrderedDict
+
+
+class LRU:
+    """上限を超えたら、最も長く使われていないものから捨てる辞書。複数のスレッドから使ってよい
+
+    捨てた後も、取得済みのものは参照している間そのまま使える。
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, factory):
+        """key のものを返す。無ければ factory() で作って加える"""
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                value = self._items[key] = factory()
+                while len(self._items) > self.maxsize:
+                    self._items.popitem(last=False)
+            else:
+                self._items.move_to_end(key)
+            return value
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._items[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from kakeibo import archive
+from kakeibo.models import Payment, Income
+from register.models import Household
+
+
+class Command(BaseCommand):
+    help = '締まった年の支出・収入を、メモリマップ用のアーカイブに凍結します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, action='append',
+                            help='凍結する年(複数指定可)。省略時は今年より前の全ての年')
+        parser.add_argument('--force', action='store_true',
+                            help='凍結済みの年も凍結し直す')
+
+    def handle(self, *args, **options):
+        current_year = timezone.localdate().year
+        for year in options['year'] or []:
+            if year >= current_year:
+                raise CommandError(f'{year}年はまだ締まっていないため、凍結できません')
+
+        for model in (Payment, Income):
+            kind = model.__name__
+            for owner in Household.objects.order_by('pk'):
+                if options['year']:
+                    years = options['year']
+                else:
+                    years = model.objects.filter(owner=owner, date__year__lt=current_year).dates('date', 'year')
+                    years = [date.year for date in years]
+
+                archived = set(archive.archived_years(kind, owner.pk))
+                for year in years:
+                    if year in archived and not options['force']:
+                        continue
+                    count = archive.freeze_year(model, owner.pk, year)
+                    self.stdout.write(f'{owner} {kind} {year}年: {count}件を凍結しました')
@@ -0,0 +1,82 @@
+import timeit
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.template import Context, Template
+from django.test import RequestFactory
+from kakeibo import views
+from kakeibo.templatetags import kakeibo as kakeibo_tags
+
+QUERY = {
+    'year': '2021',
+    'month': '0',
+    'greater_than': '100',
+    'less_than': '50000',
+    'key_word': 'スーパー コンビニ',
+    'page': '1',
+}
+
+PAGE_RANGE_TEMPLATE = Template(
+    '{% load kakeibo %}'
+    '{% for number in page_range %}'
+    '<a href="?{% url_replace request \'page\' number %}">{{ number }}</a>'
+    '{% endfor %}'
+)
+
+
+class LegacyBuilder:
+    """QueryStringBuilder導入前の実装(比較用)。呼び出しの度にGETパラメータを複製してエンコードする"""
+
+    def __init__(self, request):
+        self.request = request
+
+    def replace(self, field, value):
+        url_dict = self.request.GET.copy()
+        url_dict[field] = str(value)
+        return url_dict.urlencode()
+
+
+class Command(BaseCommand):
+    help = '一覧ページと、ページ数の多いページャーの描画時間を計測します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=1000, help='ページャーに並べるページ数')
+        parser.add_argument('--repeat', type=int, default=50, help='計測の繰り返し回数')
+        parser.add_argument('--username', help='一覧を表示するユーザー。省略時は最初に登録されたユーザー')
+
+    def measure(self, func, repeat):
+        return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+    def render_page_range(self, pages):
+        # リクエスト単位のキャッシュを使わないよう、毎回新しいリクエストを作る
+        request = RequestFactory().get('/', QUERY)
+        return PAGE_RANGE_TEMPLATE.render(Context({'request': request, 'page_range': range(1, pages + 1)}))
+
+    def render_list(self, view_class, path):
+        request = RequestFactory().get(path, QUERY)
+        request.user = self.user
+        return view_class.as_view()(request).render()
+
+    def handle(self, *args, **options):
+        pages = options['pages']
+        repeat = options['repeat']
+        users = get_user_model().objects.order_by('pk')
+        if options['username']:
+            users = users.filter(username=options['username'])
+        self.user = users.first()
+        if self.user is None:
+            raise CommandError('一覧を表示するユーザーが見つかりません')
+        cases = [
+            (f'ページャー({pages}ページ)', lambda: self.render_page_range(pages)),
+            ('支出一覧', lambda: self.render_list(views.PaymentList, '/')),
+            ('収入一覧', lambda: self.render_list(views.IncomeList, '/income_list/')),
+        ]
+
+        get_builder = kakeibo_tags.get_query_string_builder
+        for label, func in cases:
+            builder_ms = self.measure(func, repeat)
+            kakeibo_tags.get_query_string_builder = LegacyBuilder
+            try:
+                legacy_ms = self.measure(func, repeat)
+            finally:
+                kakeibo_tags.get_query_string_builder = get_builder
+            self.stdout.write(f'{label}: 従来 {legacy_ms:.2f}ms / QueryStringBuilder {builder_ms:.2f}ms')
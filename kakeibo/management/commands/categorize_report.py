@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from kakeibo.categorizer import get_categorizer
+from register.models import Household
+
+
+class Command(BaseCommand):
+    help = '登録済みの支出で自動分類を試し、的中率と処理速度を表示します'
+
+    def handle(self, *args, **options):
+        for owner in Household.objects.order_by('pk'):
+            self.stdout.write(f'[{owner}]')
+            self.report(owner)
+
+    def report(self, owner):
+        started = time.perf_counter()
+        categorizer = get_categorizer(owner.pk)
+        self.stdout.write(f'学習: {len(categorizer.rows)}件 / キーワード{len(categorizer.keyword_counts)}語 '
+                          f'({time.perf_counter() - started:.2f}秒)')
+
+        started = time.perf_counter()
+        result = categorizer.evaluate()
+        elapsed = time.perf_counter() - started
+        total = result['total']
+        if not total:
+            self.stdout.write('支出が登録されていません')
+            return
+
+        # 各行を、その行を除いて学習した状態で推定し直した結果
+        self.stdout.write(f'キーワードで分類: {result["rule"] / total:.1%} '
+                          f'(うち正解 {result["rule_correct"] / max(result["rule"], 1):.1%})')
+        self.stdout.write(f'件数の多いカテゴリで代用: {result["fallback"] / total:.1%} '
+                          f'(うち正解 {result["fallback_correct"] / max(result["fallback"], 1):.1%})')
+        self.stdout.write(f'全体の正解率: {result["correct"] / total:.1%}')
+        self.stdout.write(f'処理速度: {total / elapsed:,.0f}件/秒')
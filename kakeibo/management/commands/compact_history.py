@@ -0,0 +1,74 @@
+import datetime
+import itertools
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from kakeibo import history
+from kakeibo.models import Payment, Income, ChangeLog
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = ('古い変更履歴のうち、連続した更新を対象ごとに一つにまとめます。'
+            '登録・削除・復元・完全削除の履歴は残します')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365,
+                            help='この日数より古い変更履歴をまとめる')
+        parser.add_argument('--purge-trash', action='store_true',
+                            help='ゴミ箱の古い行を完全に削除する(履歴には完全削除として残す)')
+        parser.add_argument('--trash-days', type=int, default=30,
+                            help='--purge-trash で、ゴミ箱に移してからこの日数を過ぎた行を削除する')
+
+    def purge_trash(self, cutoff):
+        for model in (Payment, Income):
+            kind = model.__name__
+            ids = list(model.all_objects.filter(deleted_at__lt=cutoff).values_list('id', flat=True))
+            for start in range(0, len(ids), BATCH_SIZE):
+                with transaction.atomic():
+                    rows = list(model.all_objects.filter(pk__in=ids[start:start + BATCH_SIZE]))
+                    history.record(history.build_purge_entry(row) for row in rows)
+                    model.all_objects.filter(pk__in=[row.pk for row in rows]).delete()
+            self.stdout.write(f'{kind}: ゴミ箱から{len(ids)}件を完全に削除しました')
+
+    def fold_updates(self, cutoff):
+        """対象ごとに、他の操作をはさまずに続いた更新を最後の1件にまとめる"""
+        old = (ChangeLog.objects.filter(created_at__lt=cutoff)
+               .order_by('kind', 'object_id', 'id')
+               .values_list('id', 'kind', 'object_id', 'action', 'changes'))
+        folded = []
+        removed = []
+
+        def flush():
+            with transaction.atomic():
+                ChangeLog.objects.bulk_update(folded, ['changes'], batch_size=BATCH_SIZE)
+                ChangeLog.objects.filter(id__in=removed).delete()
+            count = len(removed)
+            folded.clear()
+            removed.clear()
+            return count
+
+        count = 0
+        for _, entries in itertools.groupby(old.iterator(), key=lambda entry: entry[1:3]):
+            for is_update, run in itertools.groupby(entries, key=lambda entry: entry[3] == 'update'):
+                run = list(run)
+                if not is_update or len(run) < 2:
+                    continue
+                changes = history.fold_updates(entry[4] for entry in run)
+                if changes:
+                    folded.append(ChangeLog(id=run[-1][0], changes=changes))
+                    removed.extend(entry[0] for entry in run[:-1])
+                else:
+                    # 元に戻っただけの更新は残さない
+                    removed.extend(entry[0] for entry in run)
+            if len(removed) >= BATCH_SIZE:
+                count += flush()
+        return count + flush()
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        if options['purge_trash']:
+            self.purge_trash(now - datetime.timedelta(days=options['trash_days']))
+        count = self.fold_updates(now - datetime.timedelta(days=options['days']))
+        self.stdout.write(f'古い更新の履歴を{count}件まとめました')
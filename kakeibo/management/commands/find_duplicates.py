@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from kakeibo.dedupe import find_near_duplicates, find_unfingerprinted, DEFAULT_WINDOW_DAYS
+from kakeibo.models import Payment
+
+
+class Command(BaseCommand):
+    help = '日付の近い同額の支出から、重複と思われるものを探します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=DEFAULT_WINDOW_DAYS,
+                            help='重複とみなす日付の差(日)')
+        parser.add_argument('--delete', action='store_true',
+                            help='各グループで最初に登録された支出だけを残し、残りをゴミ箱に移す。'
+                                 '指紋の無い完全な重複もゴミ箱に移し、同じ明細の無い行には指紋を付ける')
+        parser.add_argument('--yes', action='store_true',
+                            help='--delete の確認を省略する')
+
+    def confirm(self, message):
+        try:
+            return input(message).strip().lower() in ('y', 'yes')
+        except EOFError:
+            return False
+
+    def handle(self, *args, **options):
+        groups = find_near_duplicates(window_days=options['days'])
+        # 移行時に、既存の行と同じ明細だったため指紋を付けなかった支出
+        unfingerprinted = find_unfingerprinted()
+        pks = [pk for group in groups for pk in group] + [pk for pair in unfingerprinted for pk in pair if pk]
+        payments = Payment.objects.select_related('owner', 'category').in_bulk(pks)
+
+        def describe(pk):
+            payment = payments[pk]
+            return (f'#{pk} {payment.owner} {payment.date} {payment.category} {payment.price}円 '
+                    f'{payment.description or ""}')
+
+        for group in groups:
+            self.stdout.write(' / '.join(describe(pk) for pk in group))
+        self.stdout.write(f'{len(groups)}件の重複候補が見つかりました')
+        for pk, original in unfingerprinted:
+            if original:
+                self.stdout.write(f'{describe(pk)} は #{original} と同じ明細です')
+            else:
+                self.stdout.write(f'{describe(pk)} は指紋がありません')
+        if unfingerprinted:
+            self.stdout.write(f'{len(unfingerprinted)}件の支出に指紋がありません')
+
+        if options['delete'] and (groups or unfingerprinted):
+            duplicates = [pk for group in groups for pk in group[1:]]
+            duplicates += [pk for pk, original in unfingerprinted if original]
+            fingerprinted = [pk for pk, original in unfingerprinted if not original]
+            message = f'{len(duplicates)}件をゴミ箱に移し、{len(fingerprinted)}件に指紋を付けます。よろしいですか? [y/N] '
+            if not options['yes'] and not self.confirm(message):
+                self.stdout.write('中止しました')
+                return
+            with transaction.atomic():
+                # 一件ずつゴミ箱に移して、集計表やキャッシュの更新シグナルを送る
+                for pk in duplicates:
+                    payments[pk].soft_delete()
+                # 指紋は集計に影響しないため、シグナルを送らずに更新する
+                for pk in fingerprinted:
+                    payment = payments[pk]
+                    Payment.objects.filter(pk=pk).update(
+                        fingerprint=Payment.build_fingerprint(payment.date, payment.price, payment.description))
+            self.stdout.write(f'{len(duplicates)}件をゴミ箱に移し、{len(fingerprinted)}件に指紋を付けました')
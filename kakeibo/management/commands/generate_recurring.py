@@ -0,0 +1,17 @@
+import datetime
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from kakeibo import recurring
+
+
+class Command(BaseCommand):
+    help = '期日を迎えた定期的な支出・収入をまとめて登録します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--until', type=datetime.date.fromisoformat,
+                            help='この日付(YYYY-MM-DD)までの分を作成する。省略時は今日')
+
+    def handle(self, *args, **options):
+        until = options['until'] or timezone.localdate()
+        created = recurring.generate(until)
+        self.stdout.write(f'支出{created["Payment"]}件、収入{created["Income"]}件を登録しました')
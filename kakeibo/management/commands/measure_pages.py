@@ -0,0 +1,65 @@
+import timeit
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+from kakeibo import compression
+from kakeibo.categorizer import categorizers
+from kakeibo.navigation import month_navigation
+from kakeibo.snapshot import snapshots
+
+ENCODINGS = ['identity', 'gzip'] + (['br'] if compression.brotli is not None else [])
+
+
+class Command(BaseCommand):
+    help = 'グラフのあるページの転送量と応答時間を、圧縮の方式ごとに計測します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='計測の繰り返し回数')
+        parser.add_argument('--username', help='ページを表示するユーザー。省略時は最初に登録されたユーザー')
+
+    def get(self, url, encoding):
+        return self.client.get(url, HTTP_ACCEPT_ENCODING=encoding)
+
+    def measure(self, func, repeat):
+        return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+    def cold(self, url, encoding):
+        """キャッシュやプロセス内のスナップショットが無い状態での応答時間"""
+        cache.clear()
+        snapshots.clear()
+        categorizers.clear()
+        return self.measure(lambda: self.get(url, encoding), 1)
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        users = get_user_model().objects.order_by('pk')
+        if options['username']:
+            users = users.filter(username=options['username'])
+        user = users.first()
+        if user is None:
+            raise CommandError('ページを表示するユーザーが見つかりません')
+        # 開発用サーバーと同じホスト名でアクセスする(ALLOWED_HOSTS を変えずに済む)
+        self.client = Client(SERVER_NAME='localhost')
+        self.client.force_login(user)
+
+        last = month_navigation(user.household_id).last
+        pages = [('推移グラフ', reverse('kakeibo:transition'))]
+        if last:
+            pages.insert(0, ('月別ダッシュボード', reverse('kakeibo:month_dashboard', args=last)))
+
+        for label, url in pages:
+            self.stdout.write(f'{label} ({url})')
+            for encoding in ENCODINGS:
+                cold_ms = self.cold(url, encoding)
+                warm_ms = self.measure(lambda: self.get(url, encoding), repeat)
+                size = len(self.get(url, encoding).content)
+                self.stdout.write(f'  {encoding:8}: {size:>8,}バイト / 初回 {cold_ms:.1f}ms / 2回目以降 {warm_ms:.1f}ms')
+
+            # 圧縮済みの断片をつなぎ合わせる場合と、ページ全体をその場で圧縮する場合の比較
+            response = self.get(url, 'identity')
+            fragments = response.wsgi_request.__dict__.get('_compressed_fragments', ())
+            spliced_ms = self.measure(lambda: compression.gzip_compress(response.content, fragments), repeat)
+            whole_ms = self.measure(lambda: compression.gzip_compress(response.content), repeat)
+            self.stdout.write(f'  gzip圧縮: ページ全体 {whole_ms:.2f}ms / 断片をつなぎ合わせる {spliced_ms:.2f}ms')
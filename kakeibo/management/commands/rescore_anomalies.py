@@ -0,0 +1,72 @@
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from kakeibo import anomaly
+from kakeibo.models import CategoryStats, Payment
+
+BATCH_SIZE = 1000
+
+
+def leave_one_out_scores(categories, prices, min_count):
+    """各支出の外れ度を、同じカテゴリの他の全支出の統計と比べて計算する
+
+    戻り値は (カテゴリのpk, 件数, 平均, 偏差平方和) の各配列と、支出ごとの外れ度(判定できない場合はnan)。
+    """
+    codes, inverse = np.unique(categories, return_inverse=True)
+    counts = np.bincount(inverse)
+    means = np.bincount(inverse, weights=prices) / counts
+    m2s = np.bincount(inverse, weights=(prices - means[inverse]) ** 2, minlength=len(codes))
+
+    # 自分自身を除いた統計(anomaly.remove を配列でまとめて行う)
+    count = counts[inverse]
+    mean = means[inverse]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        other_count = count - 1
+        other_mean = (count * mean - prices) / other_count
+        other_m2 = m2s[inverse] - (prices - mean) ** 2 * count / other_count
+        scores = (prices - other_mean) / np.sqrt(other_m2 / other_count)
+    scores[(other_count < min_count) | ~(other_m2 > 0)] = np.nan
+    return codes, counts, means, m2s, scores
+
+
+class Command(BaseCommand):
+    help = ('カテゴリ別の金額の統計を作り直し、過去の支出の外れ度をまとめて計算し直します。'
+            '過去の支出は、同じカテゴリの他の全支出と比べます')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owner', type=int, help='対象の世帯のpk。省略時はすべての世帯')
+
+    def rescore(self, owner_id):
+        rows = list(Payment.objects.filter(owner_id=owner_id).values_list('id', 'category_id', 'price', 'anomaly_score'))
+        if not rows:
+            CategoryStats.objects.filter(owner_id=owner_id).delete()
+            return 0, 0
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        categories = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+        prices = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+        current = np.fromiter((np.nan if row[3] is None else row[3] for row in rows), dtype=np.float64,
+                              count=len(rows))
+        codes, counts, means, m2s, scores = leave_one_out_scores(categories, prices, anomaly.min_count())
+
+        # 外れ度が変わった行だけを書き込む
+        changed = ~(np.isclose(scores, current) | (np.isnan(scores) & np.isnan(current)))
+        payments = [Payment(pk=int(pk), anomaly_score=None if np.isnan(score) else float(score))
+                    for pk, score in zip(ids[changed], scores[changed])]
+        with transaction.atomic():
+            CategoryStats.objects.filter(owner_id=owner_id).delete()
+            CategoryStats.objects.bulk_create([
+                CategoryStats(owner_id=owner_id, category_id=int(category_id), count=int(count),
+                              mean=float(mean), m2=float(m2))
+                for category_id, count, mean, m2 in zip(codes, counts, means, m2s)
+            ])
+            Payment.objects.bulk_update(payments, ['anomaly_score'], batch_size=BATCH_SIZE)
+        flagged = int(np.count_nonzero(np.abs(np.nan_to_num(scores)) >= anomaly.z_threshold()))
+        return len(payments), flagged
+
+    def handle(self, *args, **options):
+        owner_ids = Payment.objects.order_by().values_list('owner_id', flat=True).distinct()
+        if options['owner']:
+            owner_ids = [options['owner']]
+        for owner_id in owner_ids:
+            updated, flagged = self.rescore(owner_id)
+            self.stdout.write(f'世帯{owner_id}: 外れ度を{updated}件更新しました(外れ値 {flagged}件)')
@@ -0,0 +1,51 @@
+import datetime
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from kakeibo import reports
+from kakeibo.models import ReportJob
+
+
+class Command(BaseCommand):
+    help = '待機中の集計レポートを作成します(Webのプロセスとは別に動かすワーカー)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--watch', action='store_true', help='終了せずに、新しいジョブを待ち続ける')
+        parser.add_argument('--interval', type=float, default=5, help='--watch で待機中のジョブを探す間隔(秒)')
+        parser.add_argument('--stale-minutes', type=int, default=30,
+                            help='作成を始めてからこの時間を過ぎても終わらないジョブを、待機中に戻す')
+        parser.add_argument('--keep-days', type=int, default=7,
+                            help='完了・失敗してからこの日数を過ぎたジョブとファイルを削除する')
+
+    def cleanup(self, options):
+        now = timezone.now()
+        # 作成中にプロセスが止まったジョブをやり直す
+        stale = (ReportJob.objects
+                 .filter(status='running', started_at__lt=now - datetime.timedelta(minutes=options['stale_minutes']))
+                 .update(status='pending', progress=0))
+        if stale:
+            self.stdout.write(f'止まっていたジョブを{stale}件、待機中に戻しました')
+        expired = ReportJob.objects.filter(finished_at__lt=now - datetime.timedelta(days=options['keep_days']))
+        count = 0
+        for job in expired:
+            reports.delete_job(job)
+            count += 1
+        if count:
+            self.stdout.write(f'古いジョブを{count}件削除しました')
+
+    def run_pending(self):
+        count = 0
+        for job_id in list(reports.pending_jobs()):
+            if reports.run_job(job_id):
+                count += 1
+        return count
+
+    def handle(self, *args, **options):
+        while True:
+            self.cleanup(options)
+            count = self.run_pending()
+            if count:
+                self.stdout.write(f'レポートを{count}件作成しました')
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
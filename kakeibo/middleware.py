@@ -0,0 +1,52 @@
+import re
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from . import compression
+
+# 圧縮しても小さくならない画像などは対象外にする
+COMPRESSIBLE_TYPES = re.compile(r'^(text/|application/(json|javascript|xml))')
+
+
+class CompressionMiddleware:
+    """一定の大きさ以上のレスポンスを、brotli(インストールされていれば)またはgzipで圧縮する
+
+    htmlは圧縮の前にタグ間の空白を縮める。
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_size = getattr(settings, 'KAKEIBO_COMPRESS_MIN_SIZE', 1024)
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        content_type = response.get('Content-Type', '')
+        if not COMPRESSIBLE_TYPES.match(content_type):
+            return response
+
+        content = response.content
+        if content_type.startswith('text/html'):
+            content = compression.minify(content)
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        encodings = compression.accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        encoding = None
+        if len(content) >= self.min_size:
+            if compression.brotli is not None and 'br' in encodings:
+                encoding = 'br'
+                content = compression.brotli_compress(content)
+            elif 'gzip' in encodings:
+                encoding = 'gzip'
+                content = compression.gzip_compress(
+                    content, getattr(request, '_compressed_fragments', ()))
+
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        if encoding:
+            response['Content-Encoding'] = encoding
+            # 圧縮の前後でバイト列が変わるため、強いETagを弱いETagにする
+            etag = response.get('ETag')
+            if etag and etag.startswith('"'):
+                response['ETag'] = 'W/' + etag
+        return response
@@ -0,0 +1,58 @@
+# Generated by Django 3.2.8 on 2026-10-19 15:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.functions import TruncMonth
+
+
+def backfill_monthly_category_spend(apps, schema_editor):
+    """既存の支出から集計表を作成する"""
+    Payment = apps.get_model('kakeibo', 'Payment')
+    MonthlyCategorySpend = apps.get_model('kakeibo', 'MonthlyCategorySpend')
+    rows = (Payment.objects
+            .annotate(month=TruncMonth('date'))
+            .values('category_id', 'month')
+            .annotate(total=models.Sum('price'), count=models.Count('id')))
+    MonthlyCategorySpend.objects.bulk_create(
+        MonthlyCategorySpend(category_id=row['category_id'], month=row['month'],
+                             total=row['total'], count=row['count'])
+        for row in rows
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0002_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyCategorySpend',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(verbose_name='対象月')),
+                ('total', models.IntegerField(default=0, verbose_name='合計金額')),
+                ('count', models.IntegerField(default=0, verbose_name='件数')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='kakeibo.paymentcategory', verbose_name='カテゴリ')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Budget',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='月の初日で登録します', verbose_name='対象月')),
+                ('limit', models.IntegerField(verbose_name='予算額')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='kakeibo.paymentcategory', verbose_name='カテゴリ')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='monthlycategoryspend',
+            constraint=models.UniqueConstraint(fields=('category', 'month'), name='unique_spend_category_month'),
+        ),
+        migrations.AddConstraint(
+            model_name='budget',
+            constraint=models.UniqueConstraint(fields=('category', 'month'), name='unique_budget_category_month'),
+        ),
+        migrations.RunPython(backfill_monthly_category_spend, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 3.2.8 on 2026-10-19 15:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0003_budget'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('Payment', '支出'), ('Income', '収入')], max_length=16, verbose_name='種類')),
+                ('interval', models.PositiveSmallIntegerField(default=1, verbose_name='間隔(月)')),
+                ('day', models.PositiveSmallIntegerField(help_text='月末より大きい場合は月末日になります', verbose_name='日')),
+                ('price', models.IntegerField(verbose_name='金額')),
+                ('description', models.TextField(blank=True, null=True, verbose_name='摘要')),
+                ('start_date', models.DateField(verbose_name='開始日')),
+                ('end_date', models.DateField(blank=True, null=True, verbose_name='終了日')),
+                ('last_generated', models.DateField(blank=True, editable=False, null=True, verbose_name='最終作成日')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='recurringrule',
+            name='income_category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='kakeibo.incomecategory', verbose_name='収入カテゴリ'),
+        ),
+        migrations.AddField(
+            model_name='recurringrule',
+            name='payment_category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='kakeibo.paymentcategory', verbose_name='支出カテゴリ'),
+        ),
+        migrations.AddField(
+            model_name='income',
+            name='recurring_rule',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='kakeibo.recurringrule', verbose_name='定期ルール'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='recurring_rule',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='kakeibo.recurringrule', verbose_name='定期ルール'),
+        ),
+        migrations.AddConstraint(
+            model_name='income',
+            constraint=models.UniqueConstraint(fields=('recurring_rule', 'date'), name='unique_income_recurring_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(fields=('recurring_rule', 'date'), name='unique_payment_recurring_date'),
+        ),
+    ]
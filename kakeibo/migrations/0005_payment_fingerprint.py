@@ -0,0 +1,38 @@
+# Generated by Django 3.2.8 on 2026-10-19 15:10
+
+import hashlib
+import unicodedata
+from django.db import migrations, models
+
+
+def fill_fingerprints(apps, schema_editor):
+    """既存の支出に指紋を付ける。既に同じ指紋の行がある場合は重複として空のままにする"""
+    Payment = apps.get_model('kakeibo', 'Payment')
+    seen = set()
+    payments = []
+    for payment in Payment.objects.order_by('id').only('id', 'date', 'price', 'description'):
+        description = ' '.join(unicodedata.normalize('NFKC', payment.description or '').lower().split())
+        key = f'{payment.date.isoformat()}|{payment.price}|{description}'
+        fingerprint = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        if fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        payment.fingerprint = fingerprint
+        payments.append(payment)
+    Payment.objects.bulk_update(payments, ['fingerprint'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0004_recurringrule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True, unique=True, verbose_name='指紋'),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+    ]
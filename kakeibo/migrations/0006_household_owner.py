@@ -0,0 +1,67 @@
+# Generated by Django 3.2.8 on 2026-10-19 15:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+OWNED_MODELS = ('PaymentCategory', 'IncomeCategory', 'Payment', 'Income',
+                'Budget', 'MonthlyCategorySpend', 'RecurringRule')
+
+
+def assign_default_household(apps, schema_editor):
+    """既存のデータと世帯のないユーザーを、一つの世帯にまとめる"""
+    Household = apps.get_model('register', 'Household')
+    User = apps.get_model('register', 'User')
+    models_with_rows = [apps.get_model('kakeibo', name) for name in OWNED_MODELS]
+    if not any(model.objects.exists() for model in models_with_rows):
+        return
+    household = Household.objects.create(name='既定の世帯')
+    User.objects.filter(household__isnull=True).update(household=household)
+    for model in models_with_rows:
+        model.objects.filter(owner__isnull=True).update(owner=household)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0002_household'),
+        ('kakeibo', '0005_payment_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='budget',
+            name='owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AddField(
+            model_name='income',
+            name='owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AddField(
+            model_name='incomecategory',
+            name='owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AddField(
+            model_name='monthlycategoryspend',
+            name='owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AddField(
+            model_name='paymentcategory',
+            name='owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AddField(
+            model_name='recurringrule',
+            name='owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.RunPython(assign_default_household, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 3.2.8 on 2026-10-19 15:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0002_household'),
+        ('kakeibo', '0006_household_owner'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='budget',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AlterField(
+            model_name='income',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AlterField(
+            model_name='incomecategory',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AlterField(
+            model_name='monthlycategoryspend',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AlterField(
+            model_name='paymentcategory',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AlterField(
+            model_name='recurringrule',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True, verbose_name='指紋'),
+        ),
+        migrations.AddIndex(
+            model_name='budget',
+            index=models.Index(fields=['owner', 'month'], name='budget_owner_month'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['owner', 'date'], name='income_owner_date'),
+        ),
+        migrations.AddIndex(
+            model_name='monthlycategoryspend',
+            index=models.Index(fields=['owner', 'month'], name='spend_owner_month'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['owner', 'date'], name='payment_owner_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(fields=('owner', 'fingerprint'), name='unique_payment_owner_fingerprint'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 3.2.8 on 2026-10-19 15:18
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('register', '0002_household'),
+        ('kakeibo', '0007_household_owner_required'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16, verbose_name='種類')),
+                ('object_id', models.BigIntegerField(verbose_name='対象のpk')),
+                ('action', models.CharField(choices=[('create', '登録'), ('update', '更新'), ('delete', '削除'), ('restore', '復元'), ('purge', '完全削除')], max_length=16, verbose_name='操作')),
+                ('changes', models.JSONField(blank=True, default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='変更内容')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='日時')),
+            ],
+        ),
+        migrations.RemoveConstraint(
+            model_name='payment',
+            name='unique_payment_owner_fingerprint',
+        ),
+        migrations.RemoveIndex(
+            model_name='income',
+            name='income_owner_date',
+        ),
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_owner_date',
+        ),
+        migrations.AddField(
+            model_name='income',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='削除日時'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='削除日時'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['owner', 'date'], name='income_owner_date_live'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['owner', 'date'], name='payment_owner_date_live'),
+        ),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(condition=models.Q(('deleted_at__isnull', True)), fields=('owner', 'fingerprint'), name='unique_payment_owner_fingerprint'),
+        ),
+        migrations.AddField(
+            model_name='changelog',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯'),
+        ),
+        migrations.AddField(
+            model_name='changelog',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='ユーザー'),
+        ),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['owner', 'kind', 'object_id'], name='changelog_owner_object'),
+        ),
+    ]
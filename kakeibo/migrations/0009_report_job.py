@@ -0,0 +1,44 @@
+# Generated by Django 3.2.8 on 2026-10-19 15:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('register', '0002_household'),
+        ('kakeibo', '0008_soft_delete_changelog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('monthly', '月別'), ('annual', '年別')], default='monthly', max_length=16, verbose_name='集計単位')),
+                ('file_format', models.CharField(choices=[('csv', 'CSV'), ('xlsx', 'Excel')], default='csv', max_length=8, verbose_name='形式')),
+                ('start_year', models.PositiveSmallIntegerField(verbose_name='開始年')),
+                ('end_year', models.PositiveSmallIntegerField(verbose_name='終了年')),
+                ('status', models.CharField(choices=[('pending', '待機中'), ('running', '作成中'), ('done', '完了'), ('failed', '失敗')], default='pending', max_length=16, verbose_name='状態')),
+                ('progress', models.PositiveSmallIntegerField(default=0, verbose_name='進捗')),
+                ('file_name', models.CharField(blank=True, max_length=255, verbose_name='ファイル')),
+                ('error', models.TextField(blank=True, verbose_name='エラー')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='登録日時')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='開始日時')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='完了日時')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reportjob',
+            index=models.Index(fields=['owner', 'created_at'], name='reportjob_owner_created'),
+        ),
+        migrations.AddIndex(
+            model_name='reportjob',
+            index=models.Index(fields=['status', 'created_at'], name='reportjob_status_created'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.8 on 2026-10-19 15:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_stats(apps, schema_editor):
+    """既存の支出から、カテゴリ別の統計を作る"""
+    Payment = apps.get_model('kakeibo', 'Payment')
+    CategoryStats = apps.get_model('kakeibo', 'CategoryStats')
+    rows = (Payment.objects.filter(deleted_at__isnull=True)
+            .values('owner_id', 'category_id')
+            .order_by()
+            .annotate(count=models.Count('id'), mean=models.Avg('price'), variance=models.Variance('price')))
+    CategoryStats.objects.bulk_create([
+        CategoryStats(owner_id=row['owner_id'], category_id=row['category_id'], count=row['count'],
+                      mean=row['mean'], m2=(row['variance'] or 0) * row['count'])
+        for row in rows
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('register', '0002_household'),
+        ('kakeibo', '0009_report_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='anomaly_score',
+            field=models.FloatField(blank=True, editable=False, null=True, verbose_name='外れ度'),
+        ),
+        migrations.CreateModel(
+            name='CategoryStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0, verbose_name='件数')),
+                ('mean', models.FloatField(default=0, verbose_name='平均')),
+                ('m2', models.FloatField(default=0, verbose_name='偏差平方和')),
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='kakeibo.paymentcategory', verbose_name='カテゴリ')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='register.household', verbose_name='世帯')),
+            ],
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
@@ -1,33 +1,320 @@
-from django.db import models
+import hashlib
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .normalize import normalize
+
+
+class LiveManager(models.Manager):
+    """ゴミ箱に移した(論理削除した)行を除くマネージャー"""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
+def validate_category_owner(instance, *fields):
+    """他の世帯のカテゴリは選べない。カテゴリ別の集計表は (世帯, カテゴリ) で持つため、混ざると集計が壊れる"""
+    for field in fields:
+        if instance.owner_id and getattr(instance, f'{field}_id'):
+            if getattr(instance, field).owner_id != instance.owner_id:
+                raise ValidationError({field: '世帯のカテゴリを選択してください'})
+
+
+class SoftDeleteMixin:
+    """行を消さずにゴミ箱に移し、元に戻せるようにする"""
+
+    def soft_delete(self, user=None):
+        self._changed_by = user
+        self.deleted_at = timezone.now()
+        with transaction.atomic():
+            self.save(update_fields=['deleted_at', 'updated_at'])
+
+    def restore(self, user=None):
+        self._changed_by = user
+        self.deleted_at = None
+        with transaction.atomic():
+            self.save(update_fields=['deleted_at', 'updated_at'])
 
 
 class PaymentCategory(models.Model):
     """支出カテゴリ"""
+    owner = models.ForeignKey('register.Household', on_delete=models.CASCADE, verbose_name='世帯')
     name = models.CharField('カテゴリ名', max_length=32)
 
     def __str__(self):
         return self.name
 
 
-class Payment(models.Model):
+class Payment(SoftDeleteMixin, models.Model):
     """支出"""
+    owner = models.ForeignKey('register.Household', on_delete=models.CASCADE, verbose_name='世帯')
     date = models.DateField('日付')
     price = models.IntegerField('金額')
     category = models.ForeignKey(PaymentCategory, on_delete=models.PROTECT, verbose_name='カテゴリ')
     description = models.TextField('摘要', null=True, blank=True)
+    updated_at = models.DateTimeField('更新日時', auto_now=True, db_index=True)
+    recurring_rule = models.ForeignKey('RecurringRule', on_delete=models.SET_NULL, null=True, blank=True,
+                                       editable=False, verbose_name='定期ルール')
+    # 日付・金額・正規化した摘要のハッシュ。同じ明細の二重登録を防ぐ
+    fingerprint = models.CharField('指紋', max_length=32, null=True, blank=True, editable=False)
+    deleted_at = models.DateTimeField('削除日時', null=True, blank=True, editable=False)
+    # 保存した時点のカテゴリの平均から標準偏差の何倍離れているか(anomaly.py)。統計が足りない場合は空
+    anomaly_score = models.FloatField('外れ度', null=True, blank=True, editable=False)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        constraints = [
+            # 定期ルールから同じ日付の行を二重に作らないための一意キー
+            models.UniqueConstraint(fields=['recurring_rule', 'date'], name='unique_%(class)s_recurring_date'),
+            # ゴミ箱の行と同じ明細は登録し直せるよう、削除されていない行だけで一意にする
+            models.UniqueConstraint(fields=['owner', 'fingerprint'], condition=Q(deleted_at__isnull=True),
+                                    name='unique_payment_owner_fingerprint'),
+        ]
+        indexes = [
+            # 一覧と集計は削除されていない行しか読まないため、部分インデックスにする
+            models.Index(fields=['owner', 'date'], condition=Q(deleted_at__isnull=True),
+                         name='payment_owner_date_live'),
+        ]
+
+    @staticmethod
+    def build_fingerprint(date, price, description):
+        key = f'{date.isoformat()}|{price}|{normalize(description)}'
+        return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def clean(self):
+        validate_category_owner(self, 'category')
+        # 管理画面などフォームからの二重登録を、一意制約の違反(500)ではなく入力エラーにする
+        if self.owner_id and self.date and self.price is not None and self.deleted_at is None:
+            fingerprint = self.build_fingerprint(self.date, self.price, self.description)
+            duplicates = Payment.objects.filter(owner_id=self.owner_id, fingerprint=fingerprint).exclude(pk=self.pk)
+            if duplicates.exists():
+                raise ValidationError('同じ日付・金額・摘要の支出が既に登録されています')
+
+    def save(self, *args, **kwargs):
+        self.fingerprint = self.build_fingerprint(self.date, self.price, self.description)
+        super().save(*args, **kwargs)
+
+    @property
+    def is_anomaly(self):
+        return (self.anomaly_score is not None
+                and abs(self.anomaly_score) >= getattr(settings, 'KAKEIBO_ANOMALY_Z', 3.0))
 
 
 class IncomeCategory(models.Model):
     """収入カテゴリ"""
+    owner = models.ForeignKey('register.Household', on_delete=models.CASCADE, verbose_name='世帯')
     name = models.CharField('カテゴリ名', max_length=32)
 
     def __str__(self):
         return self.name
 
 
-class Income(models.Model):
+class Income(SoftDeleteMixin, models.Model):
     """収入"""
+    owner = models.ForeignKey('register.Household', on_delete=models.CASCADE, verbose_name='世帯')
     date = models.DateField('日付')
     price = models.IntegerField('金額')
     category = models.ForeignKey(IncomeCategory, on_delete=models.PROTECT, verbose_name='カテゴリ')
     description = models.TextField('摘要', null=True, blank=True)
+    updated_at = models.DateTimeField('更新日時', auto_now=True, db_index=True)
+    recurring_rule = models.ForeignKey('RecurringRule', on_delete=models.SET_NULL, null=True, blank=True,
+                                       editable=False, verbose_name='定期ルール')
+    deleted_at = models.DateTimeField('削除日時', null=True, blank=True, editable=False)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        constraints = [
+            # 定期ルールから同じ日付の行を二重に作らないための一意キー
+            models.UniqueConstraint(fields=['recurring_rule', 'date'], name='unique_%(class)s_recurring_date'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', 'date'], condition=Q(deleted_at__isnull=True),
+                         name='income_owner_date_live'),
+        ]
+
+    def clean(self):
+        validate_category_owner(self, 'category')
+
+
+class Budget(models.Model):
+    """予算"""
+    owner = models.ForeignKey('register.Household', on_delete=models.CASCADE, verbose_name='世帯')
+    category = models.ForeignKey(PaymentCategory, on_delete=models.PROTECT, verbose_name='カテゴリ')
+    month = models.DateField('対象月', help_text='月の初日で登録します')
+    limit = models.IntegerField('予算額')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'month'], name='unique_budget_category_month'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', 'month'], name='budget_owner_month'),
+        ]
+
+    def clean(self):
+        validate_category_owner(self, 'category')
+
+    def save(self, *args, **kwargs):
+        self.month = self.month.replace(day=1)
+        super().save(*args, **kwargs)
+
+
+class MonthlyCategorySpend(models.Model):
+    """カテゴリ別の月間支出額
+
+    支出の書き込みの度に差分で更新する集計表。予算の消化状況はここから読む。
+    """
+    owner = models.ForeignKey('register.Household', on_delete=models.CASCADE, verbose_name='世帯')
+    category = models.ForeignKey(PaymentCategory, on_delete=models.CASCADE, verbose_name='カテゴリ')
+    month = models.DateField('対象月')
+    total = models.IntegerField('合計金額', default=0)
+    count = models.IntegerField('件数', default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'month'], name='unique_spend_category_month'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', 'month'], name='spend_owner_month'),
+        ]
+
+
+class CategoryStats(models.Model):
+    """カテゴリ別の支出金額の統計(件数・平均・偏差平方和)
+
+    支出の書き込みの度に Welford の方法で1件分ずつ更新する。外れ値の判定に使う。
+    """
+    owner = models.ForeignKey('register.Household', on_delete=models.CASCADE, verbose_name='世帯')
+    category = models.OneToOneField(PaymentCategory, on_delete=models.CASCADE, verbose_name='カテゴリ')
+    count = models.IntegerField('件数', default=0)
+    mean = models.FloatField('平均', default=0)
+    # 平均との差の二乗の合計。分散は m2 / count
+    m2 = models.FloatField('偏差平方和', default=0)
+
+
+class RecurringRule(models.Model):
+    """定期的な支出・収入(家賃・サブスクリプション・給与など)"""
+    KIND_CHOICES = (
+        ('Payment', '支出'),
+        ('Income', '収入'),
+    )
+
+    owner = models.ForeignKey('register.Household', on_delete=models.CASCADE, verbose_name='世帯')
+    kind = models.CharField('種類', max_length=16, choices=KIND_CHOICES)
+    interval = models.PositiveSmallIntegerField('間隔(月)', default=1)
+    day = models.PositiveSmallIntegerField('日', help_text='月末より大きい場合は月末日になります')
+    price = models.IntegerField('金額')
+    payment_category = models.ForeignKey(PaymentCategory, on_delete=models.PROTECT, null=True, blank=True,
+                                         verbose_name='支出カテゴリ')
+    income_category = models.ForeignKey(IncomeCategory, on_delete=models.PROTECT, null=True, blank=True,
+                                        verbose_name='収入カテゴリ')
+    description = models.TextField('摘要', null=True, blank=True)
+    start_date = models.DateField('開始日')
+    end_date = models.DateField('終了日', null=True, blank=True)
+    last_generated = models.DateField('最終作成日', null=True, blank=True, editable=False)
+
+    def __str__(self):
+        return f'{self.get_kind_display()} {self.description or ""} {self.price}円'
+
+    def clean(self):
+        if not 1 <= self.day <= 31:
+            raise ValidationError({'day': '1から31の間で指定してください'})
+        if not self.interval:
+            raise ValidationError({'interval': '1以上を指定してください'})
+        if self.kind == 'Payment' and not self.payment_category:
+            raise ValidationError({'payment_category': '支出カテゴリを選択してください'})
+        if self.kind == 'Income' and not self.income_category:
+            raise ValidationError({'income_category': '収入カテゴリを選択してください'})
+        validate_category_owner(self, 'payment_category', 'income_category')
+
+
+class ChangeLog(models.Model):
+    """支出・収入の変更履歴
+
+    追記のみで更新はしない。古い履歴の連続した更新は managementコマンド compact_history で一つにまとめる。
+    """
+    ACTION_CHOICES = (
+        ('create', '登録'),
+        ('update', '更新'),
+        ('delete', '削除'),
+        ('restore', '復元'),
+        ('purge', '完全削除'),
+    )
+
+    owner = models.ForeignKey('register.Household', on_delete=models.CASCADE, verbose_name='世帯')
+    kind = models.CharField('種類', max_length=16)
+    object_id = models.BigIntegerField('対象のpk')
+    action = models.CharField('操作', max_length=16, choices=ACTION_CHOICES)
+    # 登録時は各項目の値、更新時は変更された項目の [変更前, 変更後]
+    changes = models.JSONField('変更内容', default=dict, blank=True, encoder=DjangoJSONEncoder)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True,
+                             verbose_name='ユーザー')
+    created_at = models.DateTimeField('日時', auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'kind', 'object_id'], name='changelog_owner_object'),
+        ]
+
+    def __str__(self):
+        return f'{self.kind}#{self.object_id} {self.get_action_display()}'
+
+
+class ReportJob(models.Model):
+    """集計レポート(CSV・Excel)の作成ジョブ
+
+    リクエストでは登録だけを行い、作成はスレッドプールか managementコマンド run_reports で行う。
+    """
+    KIND_CHOICES = (
+        ('monthly', '月別'),
+        ('annual', '年別'),
+    )
+    FORMAT_CHOICES = (
+        ('csv', 'CSV'),
+        ('xlsx', 'Excel'),
+    )
+    STATUS_CHOICES = (
+        ('pending', '待機中'),
+        ('running', '作成中'),
+        ('done', '完了'),
+        ('failed', '失敗'),
+    )
+
+    owner = models.ForeignKey('register.Household', on_delete=models.CASCADE, verbose_name='世帯')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True,
+                             verbose_name='ユーザー')
+    kind = models.CharField('集計単位', max_length=16, choices=KIND_CHOICES, default='monthly')
+    file_format = models.CharField('形式', max_length=8, choices=FORMAT_CHOICES, default='csv')
+    start_year = models.PositiveSmallIntegerField('開始年')
+    end_year = models.PositiveSmallIntegerField('終了年')
+    status = models.CharField('状態', max_length=16, choices=STATUS_CHOICES, default='pending')
+    # 0〜100
+    progress = models.PositiveSmallIntegerField('進捗', default=0)
+    file_name = models.CharField('ファイル', max_length=255, blank=True)
+    error = models.TextField('エラー', blank=True)
+    created_at = models.DateTimeField('登録日時', auto_now_add=True)
+    started_at = models.DateTimeField('開始日時', null=True, blank=True)
+    finished_at = models.DateTimeField('完了日時', null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'created_at'], name='reportjob_owner_created'),
+            models.Index(fields=['status', 'created_at'], name='reportjob_status_created'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()}レポート {self.start_year}〜{self.end_year}年 ({self.get_status_display()})'
+
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+    def download_name(self):
+        return f'kakeibo_{self.kind}_{self.start_year}-{self.end_year}.{self.file_format}'
@@ -1,9 +1,18 @@
-from django.utils import timezone
+from .navigation import month_navigation
 
 
 def common(request):
-    """家計簿アプリの共通コンテクスト"""
-    now = timezone.now()
+    """家計簿アプリの共通コンテクスト
 
-    return {"now_year": now.year,
-            "now_month": now.month}
+    一つのリクエストで何度描画しても一度だけ作る。
+    ナビゲーションの今月へのリンクは month_nav.current を使う。支出のある月は使われた場合だけ読む。
+    """
+    context = getattr(request, '_kakeibo_common', None)
+    if context is not None:
+        return context
+
+    user = getattr(request, 'user', None)
+    owner_id = user.household_id if user is not None and user.is_authenticated else None
+    context = {"month_nav": month_navigation(owner_id)}
+    request._kakeibo_common = context
+    return context
@@ -0,0 +1,103 @@
+"""月の移動(前月・次月など)
+
+世帯ごとに支出のある月の一覧をキャッシュし、前後の支出のある月や最初・最後の月を
+一度のキャッシュの参照で求める。一覧は、支出のある月が変わり得る書き込みの後に読み直す。
+ビューとコンテキストプロセッサの両方から使う。
+"""
+import bisect
+from django.core.cache import cache
+from django.utils.functional import cached_property
+from django.utils import timezone
+from .models import Payment
+
+MONTHS_KEY = 'kakeibo:data_months:{owner}'
+
+
+def month_index(year, month):
+    return year * 12 + month - 1
+
+
+def from_index(index):
+    year, month = divmod(index, 12)
+    return year, month + 1
+
+
+def data_months(owner_id):
+    """支出のある月の通し番号(年*12+月-1)の昇順のリスト"""
+    key = MONTHS_KEY.format(owner=owner_id)
+    months = cache.get(key)
+    if months is None:
+        dates = Payment.objects.filter(owner_id=owner_id).dates('date', 'month')
+        months = [month_index(date.year, date.month) for date in dates]
+        cache.set(key, months, None)
+    return months
+
+
+def invalidate(owner_id):
+    cache.delete(MONTHS_KEY.format(owner=owner_id))
+
+
+def note_write(owner_id, added=None, removed=None):
+    """支出のある月の一覧が変わり得る場合だけ、一覧を読み直させる
+
+    added は支出が増えた日付、removed は支出が減った日付。
+    """
+    months = cache.get(MONTHS_KEY.format(owner=owner_id))
+    if months is None:
+        return
+    if added is not None and month_index(added.year, added.month) not in months:
+        invalidate(owner_id)
+    elif removed is not None:
+        # その月の最後の支出だったかもしれないため、読み直す
+        invalidate(owner_id)
+
+
+class MonthNavigation:
+    """ある月から見た、前後の支出のある月と最初・最後の月
+
+    支出のある月の一覧は、前後の月などを初めて参照した時に読む。今月(current)だけならキャッシュも読まない。
+    """
+
+    def __init__(self, owner_id, year, month):
+        # サーバーの時刻(UTC)ではなく、設定したタイムゾーンの日付で今月を決める
+        today = timezone.localdate()
+        self.current = (today.year, today.month)
+        self.owner_id = owner_id
+        self.year, self.month = year, month
+
+    @cached_property
+    def months(self):
+        return data_months(self.owner_id) if self.owner_id is not None else []
+
+    @cached_property
+    def _position(self):
+        return bisect.bisect_left(self.months, month_index(self.year, self.month))
+
+    @property
+    def has_data(self):
+        return self._position < len(self.months) and self.months[self._position] == month_index(self.year, self.month)
+
+    @property
+    def prev(self):
+        return from_index(self.months[self._position - 1]) if self._position else None
+
+    @property
+    def next(self):
+        next_position = self._position + self.has_data
+        return from_index(self.months[next_position]) if next_position < len(self.months) else None
+
+    @property
+    def first(self):
+        return from_index(self.months[0]) if self.months else None
+
+    @property
+    def last(self):
+        return from_index(self.months[-1]) if self.months else None
+
+
+def month_navigation(owner_id, year=None, month=None):
+    """year, month を省略した場合は、今月から見た移動先を返す。owner_id がNoneなら支出のある月は無いものとする"""
+    if year is None:
+        today = timezone.localdate()
+        year, month = today.year, today.month
+    return MonthNavigation(owner_id, year, month)
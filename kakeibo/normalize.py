@@ -0,0 +1,6 @@
+import unicodedata
+
+
+def normalize(text):
+    """全角半角・大文字小文字の違いをならし、空白を一つにまとめる"""
+    return ' '.join(unicodedata.normalize('NFKC', text or '').lower().split())
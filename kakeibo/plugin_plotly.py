@@ -12,6 +12,18 @@ class GraphGenerator:
     color_palette = sns_paired()
     payment_color = 'tomato'
     income_color = 'forestgreen'
+    forecast_color = 'gray'
+    forecast_band_color = 'rgba(128,128,128,0.2)'
+
+    def add_forecast(self, fig, x_list, expected, low, high):
+        """見込みを破線で、95%の区間を帯で重ねる"""
+        fig.add_trace(go.Scatter(x=x_list, y=high, mode='lines', line=dict(width=0),
+                                 hoverinfo='skip', showlegend=False))
+        fig.add_trace(go.Scatter(x=x_list, y=low, mode='lines', line=dict(width=0),
+                                 fill='tonexty', fillcolor=self.forecast_band_color,
+                                 hoverinfo='skip', showlegend=False))
+        fig.add_trace(go.Scatter(x=x_list, y=expected, mode='lines', name='forecast',
+                                 line=dict(color=self.forecast_color, dash='dash', width=3)))
 
     def month_pie(self, labels, values):
         """月間支出のパイチャート"""
@@ -38,14 +50,17 @@ class GraphGenerator:
 
         return fig.to_html(include_plotlyjs=False)
 
-    def month_daily_bar(self, x_list, y_list):
-        """月間支出の日別バーチャート"""
+    def month_daily_bar(self, x_list, y_list, forecast=None):
+        """月間支出の日別バーチャート。forecast(今月の見込み)があれば、残りの日の1日あたりの見込みを重ねる"""
         fig = go.Figure()
         fig.add_trace(go.Bar(
             x=x_list,
             y=y_list,
             marker_color=self.month_bar_color,
         ))
+        if forecast is not None and forecast.daily_dates:
+            self.add_forecast(fig, forecast.daily_dates, forecast.daily_expected,
+                              forecast.daily_low, forecast.daily_high)
 
         fig.update_layout(
             paper_bgcolor=self.paper_bg_color,
@@ -70,8 +85,9 @@ class GraphGenerator:
                         x_list_payment=None,
                         y_list_payment=None,
                         x_list_income=None,
-                        y_list_income=None):
-        """推移ページの複合グラフ"""
+                        y_list_income=None,
+                        forecast=None):
+        """推移ページの複合グラフ。forecast は支出の見込みの (年月, 見込み, 下限, 上限)"""
         fig = go.Figure()
 
         if x_list_payment and y_list_payment:
@@ -85,6 +101,9 @@ class GraphGenerator:
                           width=5, )
             ))
 
+        if forecast is not None and forecast[0]:
+            self.add_forecast(fig, *forecast)
+
         if x_list_income and y_list_income:
             fig.add_trace(go.Bar(
                 x=x_list_income, y=y_list_income,
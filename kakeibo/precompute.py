@@ -0,0 +1,126 @@
+"""ダッシュボードキャッシュの事前計算ワーカー
+
+支出・収入の書き込み後、影響する月の集計と推移グラフをバックグラウンドで再計算する。
+外部のブローカーは使わず、プロセス内のスレッドとキューで処理する。
+同じジョブが短時間に何度も登録された場合は、最後の登録から
+KAKEIBO_PRECOMPUTE_DELAY 秒待ってから一度だけ実行する(デバウンス)。
+"""
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from . import aggregates
+
+logger = logging.getLogger(__name__)
+
+
+class PrecomputeQueue:
+    """デバウンス付きのジョブキュー"""
+
+    def __init__(self, delay=1.0):
+        self.delay = delay
+        # key -> (実行予定時刻, 最初に登録された時刻, 関数, 引数)
+        self._jobs = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = 0.0
+
+    def schedule(self, key, func, *args):
+        """ジョブを登録する。同じkeyのジョブが待機中なら実行予定を後ろにずらす"""
+        now = time.monotonic()
+        with self._condition:
+            enqueued_at = self._jobs[key][1] if key in self._jobs else now
+            self._jobs[key] = (now + self.delay, enqueued_at, func, args)
+            self._ensure_worker()
+            self._condition.notify()
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run,
+                                            name='kakeibo-precompute',
+                                            daemon=True)
+            self._thread.start()
+
+    def _pop_due_job(self):
+        """実行予定時刻を過ぎたジョブを一つ取り出す。なければ待機する"""
+        with self._condition:
+            while True:
+                if not self._jobs:
+                    self._condition.wait()
+                    continue
+                key, (due, enqueued_at, func, args) = min(self._jobs.items(), key=lambda item: item[1][0])
+                wait = due - time.monotonic()
+                if wait <= 0:
+                    del self._jobs[key]
+                    return enqueued_at, func, args
+                self._condition.wait(wait)
+
+    def _run(self):
+        while True:
+            enqueued_at, func, args = self._pop_due_job()
+            self.last_lag = time.monotonic() - enqueued_at
+            close_old_connections()
+            try:
+                func(*args)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception('precompute job failed: %s%s', func.__name__, args)
+            finally:
+                close_old_connections()
+
+    @property
+    def depth(self):
+        """待機中のジョブ数"""
+        with self._condition:
+            return len(self._jobs)
+
+    @property
+    def lag(self):
+        """待機中で最も古いジョブが登録されてからの経過秒数"""
+        with self._condition:
+            if not self._jobs:
+                return 0.0
+            oldest = min(enqueued_at for _, enqueued_at, _, _ in self._jobs.values())
+        return time.monotonic() - oldest
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'lag': round(self.lag, 3),
+            'last_lag': round(self.last_lag, 3),
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+
+
+queue = PrecomputeQueue(delay=getattr(settings, 'KAKEIBO_PRECOMPUTE_DELAY', 1.0))
+
+
+def _schedule(key, func, *args):
+    if getattr(settings, 'KAKEIBO_PRECOMPUTE_ASYNC', True):
+        queue.schedule(key, func, *args)
+    else:
+        func(*args)
+
+
+def schedule_month(owner_id, year, month):
+    """世帯の月間ダッシュボードの再計算を予約する"""
+    def enqueue():
+        # コミット前の古いデータがキャッシュされないよう、無効化もコミット後に行う
+        aggregates.invalidate_month_summary(owner_id, year, month)
+        _schedule(f'month:{owner_id}:{year}-{month}', aggregates.refresh_month_summary, owner_id, year, month)
+
+    transaction.on_commit(enqueue)
+
+
+def schedule_transition(owner_id):
+    """世帯の推移グラフの再計算を予約する"""
+    def enqueue():
+        aggregates.invalidate_transition(owner_id)
+        _schedule(f'transition:{owner_id}', aggregates.get_transition_plot, owner_id)
+
+    transaction.on_commit(enqueue)
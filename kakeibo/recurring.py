@@ -0,0 +1,125 @@
+"""定期的な支出・収入の一括作成
+
+前回の実行以降に期日を迎えた行を、ルールをまたいでまとめて bulk_create する。
+(定期ルール, 日付) の一意キーがあるため、何度実行しても同じ行が二重に作られることはない。
+手入力などで同じ明細(指紋)の支出が既にある期日は、その支出を定期ルールの分とみなして作成しない。
+"""
+import calendar
+import datetime
+from django.db import transaction
+from django.utils import timezone
+from .models import Payment, Income, RecurringRule
+from .signals import notify_bulk_write
+
+BATCH_SIZE = 1000
+# IN句に渡す値の数の上限。SQLiteのバインド変数の上限を超えないようにする
+LOOKUP_BATCH_SIZE = 500
+
+
+def occurrences(rule, until):
+    """ルールの期日のうち、前回の作成日より後で until 以前のものを順に返す"""
+    after = rule.last_generated or rule.start_date - datetime.timedelta(days=1)
+    end = min(until, rule.end_date) if rule.end_date else until
+    month_index = rule.start_date.year * 12 + rule.start_date.month - 1
+    # 前回の作成日の月まで読み飛ばす
+    if after >= rule.start_date:
+        skip = (after.year * 12 + after.month - 1 - month_index) // rule.interval
+        month_index += skip * rule.interval
+
+    while True:
+        year, month = divmod(month_index, 12)
+        month += 1
+        date = datetime.date(year, month, min(rule.day, calendar.monthrange(year, month)[1]))
+        if date > end:
+            return
+        if date > after and date >= rule.start_date:
+            yield date
+        month_index += rule.interval
+
+
+def build_rows(rule, dates):
+    if rule.kind == 'Payment':
+        # bulk_createではsave()が呼ばれないため、指紋もここで付ける
+        return [Payment(owner_id=rule.owner_id, date=date, price=rule.price, category_id=rule.payment_category_id,
+                        description=rule.description, recurring_rule=rule,
+                        fingerprint=Payment.build_fingerprint(date, rule.price, rule.description))
+                for date in dates]
+    return [Income(owner_id=rule.owner_id, date=date, price=rule.price, category_id=rule.income_category_id,
+                   description=rule.description, recurring_rule=rule) for date in dates]
+
+
+def _exclude_existing(model, rows):
+    """既に作成済みの(定期ルール, 日付)を除く。ゴミ箱に移した行も作り直さない"""
+    if not rows:
+        return rows
+    existing = set(model.all_objects.filter(
+        recurring_rule__in={row.recurring_rule_id for row in rows},
+        date__gte=min(row.date for row in rows),
+    ).values_list('recurring_rule_id', 'date'))
+    return [row for row in rows if (row.recurring_rule_id, row.date) not in existing]
+
+
+def _exclude_fingerprints(rows):
+    """同じ明細(指紋)の支出が既にある行と、バッチ内で指紋が重なる行を除く"""
+    if not rows:
+        return rows
+    owner_ids = {row.owner_id for row in rows}
+    fingerprints = sorted({row.fingerprint for row in rows})
+    existing = set()
+    for start in range(0, len(fingerprints), LOOKUP_BATCH_SIZE):
+        existing.update(Payment.objects.filter(
+            owner__in=owner_ids,
+            fingerprint__in=fingerprints[start:start + LOOKUP_BATCH_SIZE],
+        ).values_list('owner_id', 'fingerprint'))
+    kept = []
+    for row in rows:
+        key = (row.owner_id, row.fingerprint)
+        if key not in existing:
+            existing.add(key)
+            kept.append(row)
+    return kept
+
+
+def _assign_ids(model, rows):
+    """ignore_conflictsを指定したbulk_createではpkが設定されないため、(定期ルール, 日付)から引き直す"""
+    if not rows:
+        return
+    ids = {(rule_id, date): pk for pk, rule_id, date in model.all_objects.filter(
+        recurring_rule__in={row.recurring_rule_id for row in rows},
+        date__gte=min(row.date for row in rows),
+    ).values_list('id', 'recurring_rule_id', 'date')}
+    for row in rows:
+        row.pk = ids.get((row.recurring_rule_id, row.date))
+
+
+def generate(until=None):
+    """期日を迎えた定期的な支出・収入を作成し、モデル名 -> 作成件数 を返す"""
+    until = until or timezone.localdate()
+    rows = {Payment: [], Income: []}
+    rules = []
+
+    with transaction.atomic():
+        for rule in RecurringRule.objects.select_for_update():
+            dates = list(occurrences(rule, until))
+            if not dates:
+                continue
+            model = Payment if rule.kind == 'Payment' else Income
+            rows[model].extend(build_rows(rule, dates))
+            rule.last_generated = dates[-1]
+            rules.append(rule)
+
+        created = {}
+        for model, model_rows in rows.items():
+            model_rows = _exclude_existing(model, model_rows)
+            if model is Payment:
+                model_rows = _exclude_fingerprints(model_rows)
+            model.objects.bulk_create(model_rows, batch_size=BATCH_SIZE, ignore_conflicts=True)
+            _assign_ids(model, model_rows)
+            # 同時に手入力された支出と指紋が重なったなど、挿入されなかった行は集計にも件数にも含めない
+            model_rows = [row for row in model_rows if row.pk is not None]
+            # 集計表とキャッシュはバッチごとに一度だけ更新する
+            notify_bulk_write(model, model_rows)
+            created[model.__name__] = len(model_rows)
+        RecurringRule.objects.bulk_update(rules, ['last_generated'], batch_size=BATCH_SIZE)
+
+    return created
@@ -0,0 +1,205 @@
+"""集計レポート(期間×カテゴリのクロス集計)の作成
+
+複数年のレポートでもWebのワーカーを止めないよう、リクエストでは ReportJob を登録するだけにし、
+作成はプロセス内のスレッドプール(KAKEIBO_REPORT_WORKERS)か managementコマンド run_reports で行う。
+どちらが実行しても二重に作成しないよう、ジョブは状態を pending から running に更新できた方が実行する。
+
+集計は1年ずつデータベースで行い(GROUP BY)、その年の行をファイルに書き出してから進捗を更新する。
+行は期間(月・年)、列はカテゴリとし、全期間を読み込まずに先頭の行から書き出せるようにしている。
+書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える。
+"""
+import csv
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Sum
+from django.db.models.functions import ExtractMonth
+from django.urls import reverse
+from django.utils import timezone
+from .models import Payment, PaymentCategory, Income, IncomeCategory, ReportJob
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def available_formats():
+    """作成できるファイル形式。Excelは openpyxl がインストールされている場合だけ"""
+    return [(value, label) for value, label in ReportJob.FORMAT_CHOICES
+            if value != 'xlsx' or openpyxl is not None]
+
+
+def report_dir():
+    return Path(settings.KAKEIBO_REPORT_DIR)
+
+
+def report_path(job):
+    return report_dir() / job.file_name
+
+
+class CsvWriter:
+    # Excelで開いても文字化けしないよう、BOM付きのUTF-8で書く
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='', encoding='utf-8-sig')
+        self.writer = csv.writer(self.file)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class XlsxWriter:
+    # write_onlyのブックは行をその都度一時ファイルに書き出すため、行数が多くてもメモリを使わない
+    def __init__(self, path):
+        self.path = path
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet('レポート')
+
+    def writerow(self, row):
+        self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+WRITERS = {
+    'csv': CsvWriter,
+    'xlsx': XlsxWriter,
+}
+
+
+def _totals(model, owner_id, year):
+    """(月, カテゴリのpk) -> 合計金額。年別のレポートでも月別に集計して足し合わせる"""
+    rows = (model.objects.filter(owner_id=owner_id, date__year=year)
+            .annotate(month=ExtractMonth('date'))
+            .values('month', 'category_id')
+            .order_by()
+            .annotate(total=Sum('price')))
+    return {(row['month'], row['category_id']): row['total'] for row in rows}
+
+
+def _period_row(label, months, payment_totals, income_totals, payment_categories, income_categories):
+    payments = [sum(payment_totals.get((month, category.pk), 0) for month in months)
+                for category in payment_categories]
+    incomes = [sum(income_totals.get((month, category.pk), 0) for month in months)
+               for category in income_categories]
+    payment_total = sum(payments)
+    income_total = sum(incomes)
+    return [label, *payments, payment_total, *incomes, income_total, income_total - payment_total]
+
+
+def write_report(job, writer, on_year_done=None):
+    """レポートの行を writer に書き出す。on_year_done は1年分を書き出す度に、書き出した年数で呼ぶ"""
+    payment_categories = list(PaymentCategory.objects.filter(owner_id=job.owner_id).order_by('name'))
+    income_categories = list(IncomeCategory.objects.filter(owner_id=job.owner_id).order_by('name'))
+    writer.writerow(['期間',
+                     *(f'支出:{category.name}' for category in payment_categories), '支出合計',
+                     *(f'収入:{category.name}' for category in income_categories), '収入合計',
+                     '収支'])
+
+    for done, year in enumerate(range(job.start_year, job.end_year + 1), 1):
+        payment_totals = _totals(Payment, job.owner_id, year)
+        income_totals = _totals(Income, job.owner_id, year)
+        if job.kind == 'annual':
+            periods = [(f'{year}年', range(1, 13))]
+        else:
+            periods = [(f'{year}年{month}月', (month,)) for month in range(1, 13)]
+        for label, months in periods:
+            writer.writerow(_period_row(label, months, payment_totals, income_totals,
+                                        payment_categories, income_categories))
+        if on_year_done is not None:
+            on_year_done(done)
+
+
+def run_job(job_id):
+    """待機中のジョブを実行する。他のワーカーが先に実行を始めていた場合は何もしない"""
+    claimed = (ReportJob.objects.filter(pk=job_id, status='pending')
+               .update(status='running', progress=0, started_at=timezone.now()))
+    if not claimed:
+        return False
+    job = ReportJob.objects.get(pk=job_id)
+    job.file_name = f'{job.owner_id}/{job.pk}.{job.file_format}'
+    path = report_path(job)
+    tmp_path = path.with_name(f'{path.name}.tmp')
+    years = job.end_year - job.start_year + 1
+
+    def on_year_done(done):
+        ReportJob.objects.filter(pk=job.pk).update(progress=done * 100 // years)
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        writer = WRITERS[job.file_format](tmp_path)
+        try:
+            write_report(job, writer, on_year_done)
+        finally:
+            writer.close()
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.exception('report job %s failed', job.pk)
+        tmp_path.unlink(missing_ok=True)
+        ReportJob.objects.filter(pk=job.pk).update(status='failed', error=str(e), finished_at=timezone.now())
+    else:
+        ReportJob.objects.filter(pk=job.pk).update(status='done', progress=100, file_name=job.file_name,
+                                                   finished_at=timezone.now())
+    return True
+
+
+def _run_in_thread(job_id):
+    close_old_connections()
+    try:
+        run_job(job_id)
+    except Exception:
+        logger.exception('report job %s failed', job_id)
+    finally:
+        close_old_connections()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.KAKEIBO_REPORT_WORKERS,
+                                       thread_name_prefix='kakeibo-report')
+    return _executor
+
+
+def submit(job):
+    """ジョブの実行を予約する。KAKEIBO_REPORT_WORKERS が0なら run_reports に任せる"""
+    if not getattr(settings, 'KAKEIBO_REPORT_WORKERS', 0):
+        return
+    # 登録がコミットされる前にワーカーがジョブを探さないよう、コミット後に渡す
+    transaction.on_commit(lambda: get_executor().submit(_run_in_thread, job.pk))
+
+
+def pending_jobs():
+    return ReportJob.objects.filter(status='pending').order_by('created_at').values_list('pk', flat=True)
+
+
+def delete_job(job):
+    if job.file_name:
+        report_path(job).unlink(missing_ok=True)
+    job.delete()
+
+
+def job_status(job):
+    """進捗の問い合わせに返す内容"""
+    status = {
+        'id': job.pk,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'progress': job.progress,
+        'error': job.error,
+        'download_url': None,
+    }
+    if job.status == 'done':
+        status['download_url'] = reverse('kakeibo:report_download', args=(job.pk,))
+    return status
@@ -0,0 +1,184 @@
+from collections import defaultdict
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db import transaction
+from django.dispatch import receiver
+from .models import Payment, Income
+from . import anomaly, archive, budget, history, navigation, precompute, snapshot
+
+
+@receiver(pre_save, sender=Payment)
+@receiver(pre_save, sender=Income)
+def remember_original(sender, instance, **kwargs):
+    """更新前の値を控えておき、移動元の月の集計の更新や変更履歴に使う"""
+    instance._original = None
+    if instance.pk:
+        # ゴミ箱からの復元もあるため、削除済みの行も含めて探す
+        instance._original = sender.all_objects.filter(pk=instance.pk).values(*history.TRACKED_FIELDS).first()
+
+
+@receiver(pre_save, sender=Payment)
+def score_anomaly(sender, instance, update_fields=None, **kwargs):
+    """金額かカテゴリを保存する場合に、カテゴリの普段の金額からの外れ度を付ける"""
+    if update_fields is not None and not {'price', 'category'} & set(update_fields):
+        return
+    if instance.deleted_at is None:
+        instance.anomaly_score = anomaly.score_payment(instance, getattr(instance, '_original', None))
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_save, sender=Income)
+def log_change(sender, instance, created, **kwargs):
+    """書き込みと同じトランザクションで変更履歴を追記する"""
+    history.record([history.build_entry(instance, getattr(instance, '_original', None), created)])
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_save, sender=Income)
+@receiver(post_delete, sender=Payment)
+@receiver(post_delete, sender=Income)
+def thaw_archive(sender, instance, **kwargs):
+    """凍結済みの年の行の書き込みは、アーカイブに反映されないため、その年の凍結を解除する
+
+    事前計算がスナップショットを読む前にアーカイブを外しておくため、スナップショットより先に登録する
+    """
+    if kwargs.get('signal') is post_delete and instance.deleted_at is not None:
+        return
+    original = getattr(instance, '_original', None)
+    dates = [instance.date, original and original['date']]
+    transaction.on_commit(lambda: archive.thaw_dates(sender.__name__, instance.owner_id, dates))
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_save, sender=Income)
+def mark_snapshot_written(sender, instance, **kwargs):
+    """スナップショットに差分の取り込みを促す
+
+    事前計算がスナップショットを参照するため、事前計算の予約より先に登録しておく
+    """
+    transaction.on_commit(lambda: snapshot.mark_written(sender.__name__, instance.owner_id))
+
+
+@receiver(post_delete, sender=Payment)
+@receiver(post_delete, sender=Income)
+def mark_snapshot_deleted(sender, instance, **kwargs):
+    """完全な削除は差分で表せないため、スナップショットに全件の読み直しを促す
+
+    ゴミ箱の行は集計から除かれているため、完全に削除しても集計には影響しない。
+    """
+    if instance.deleted_at is None:
+        transaction.on_commit(lambda: snapshot.mark_deleted(sender.__name__, instance.owner_id))
+
+
+@receiver(post_delete, sender=Payment)
+@receiver(post_delete, sender=Income)
+def log_purge(sender, instance, **kwargs):
+    if instance.deleted_at is None:
+        history.record([history.build_purge_entry(instance)])
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def schedule_payment_precompute(sender, instance, **kwargs):
+    """支出の書き込み後、影響する月と推移グラフの再計算を予約する"""
+    if kwargs.get('signal') is post_delete and instance.deleted_at is not None:
+        return
+    original = getattr(instance, '_original', None)
+    dates = {instance.date, original and original['date']}
+    for date in dates - {None}:
+        precompute.schedule_month(instance.owner_id, date.year, date.month)
+    precompute.schedule_transition(instance.owner_id)
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def update_month_navigation(sender, instance, **kwargs):
+    """支出のある月が変わり得る書き込みの後に、月の移動先を読み直させる"""
+    original = getattr(instance, '_original', None)
+    if kwargs.get('signal') is post_delete:
+        added, removed = None, instance.date if instance.deleted_at is None else None
+    else:
+        added = instance.date if instance.deleted_at is None else None
+        removed = original['date'] if original and original['deleted_at'] is None else None
+        if added and removed and (added.year, added.month) == (removed.year, removed.month):
+            return
+    if added or removed:
+        transaction.on_commit(lambda: navigation.note_write(instance.owner_id, added, removed))
+
+
+@receiver(post_save, sender=Income)
+@receiver(post_delete, sender=Income)
+def schedule_income_precompute(sender, instance, **kwargs):
+    """収入の書き込み後、推移グラフの再計算を予約する"""
+    if kwargs.get('signal') is post_delete and instance.deleted_at is not None:
+        return
+    precompute.schedule_transition(instance.owner_id)
+
+
+@receiver(post_save, sender=Payment)
+def update_spend_on_save(sender, instance, created, **kwargs):
+    """カテゴリ別の月間支出額を差分で更新する。ゴミ箱の行は集計に含めない"""
+    original = getattr(instance, '_original', None)
+    if original and original['deleted_at'] is None:
+        budget.apply_spend(instance.owner_id, original['category_id'], original['date'], -original['price'], -1)
+    if instance.deleted_at is None:
+        budget.apply_spend(instance.owner_id, instance.category_id, instance.date, instance.price)
+
+
+@receiver(post_delete, sender=Payment)
+def update_spend_on_delete(sender, instance, **kwargs):
+    if instance.deleted_at is None:
+        budget.apply_spend(instance.owner_id, instance.category_id, instance.date, -instance.price, -1)
+
+
+@receiver(post_save, sender=Payment)
+def update_stats_on_save(sender, instance, **kwargs):
+    """カテゴリ別の金額の統計を1件分ずつ更新する。ゴミ箱の行は含めない"""
+    original = getattr(instance, '_original', None)
+    if original and original['deleted_at'] is None:
+        if (instance.deleted_at is None and original['category_id'] == instance.category_id
+                and original['price'] == instance.price):
+            return
+        anomaly.remove_price(instance.owner_id, original['category_id'], original['price'])
+    if instance.deleted_at is None:
+        anomaly.add_price(instance.owner_id, instance.category_id, instance.price)
+
+
+@receiver(post_delete, sender=Payment)
+def update_stats_on_delete(sender, instance, **kwargs):
+    if instance.deleted_at is None:
+        anomaly.remove_price(instance.owner_id, instance.category_id, instance.price)
+
+
+def notify_bulk_write(model, instances):
+    """bulk_createなどシグナルが送られない一括書き込みの後に、集計とキャッシュをまとめて更新する"""
+    if not instances:
+        return
+    history.record(history.build_entry(instance, created=True) for instance in instances)
+    kind = model.__name__
+    owner_ids = {instance.owner_id for instance in instances}
+    for owner_id in owner_ids:
+        dates = [instance.date for instance in instances if instance.owner_id == owner_id]
+        transaction.on_commit(lambda owner_id=owner_id, dates=dates: archive.thaw_dates(kind, owner_id, dates))
+        transaction.on_commit(lambda owner_id=owner_id: snapshot.mark_written(kind, owner_id))
+
+    if model is Payment:
+        spends = defaultdict(lambda: [0, 0])
+        for instance in instances:
+            spend = spends[(instance.owner_id, instance.category_id, instance.date.replace(day=1))]
+            spend[0] += instance.price
+            spend[1] += 1
+        for (owner_id, category_id, month), (total, count) in spends.items():
+            budget.apply_spend(owner_id, category_id, month, total, count)
+        prices = defaultdict(list)
+        for instance in instances:
+            prices[(instance.owner_id, instance.category_id)].append(instance.price)
+        for (owner_id, category_id), category_prices in prices.items():
+            anomaly.merge_into(owner_id, category_id, anomaly.batch_stats(category_prices))
+        months = {(instance.owner_id, instance.date.year, instance.date.month) for instance in instances}
+        for owner_id, year, month in months:
+            precompute.schedule_month(owner_id, year, month)
+        for instance in {(instance.owner_id, instance.date.replace(day=1)): instance
+                         for instance in instances}.values():
+            transaction.on_commit(lambda instance=instance: navigation.note_write(instance.owner_id, instance.date))
+    for owner_id in owner_ids:
+        precompute.schedule_transition(owner_id)
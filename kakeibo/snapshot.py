@@ -0,0 +1,195 @@
+"""台帳の列指向スナップショット
+
+支出・収入をNumPy配列(日付はint32の通し日数、金額はint64、カテゴリはint16のコード)で
+プロセス内に保持し、集計はブールマスクと np.bincount で行う(columns.py)。
+最初の参照時に全件を読み込み、以降は id と updated_at の透かし(watermark)より
+新しい行だけを差分で取り込み、ゴミ箱に移された行は取り除く。
+updated_at は書き込みのコミットより前に付くため、コミットの順とは前後し得る。
+透かしより KAKEIBO_SNAPSHOT_WATERMARK_LAG 秒前までの行は毎回読み直して取りこぼしを防ぐ(同じ行を二度取り込んでも結果は変わらない)。
+行の完全な削除があった場合は全件を読み直す。
+凍結済みの年はデータベースではなく、メモリマップしたアーカイブ(archive.py)から読む。
+"""
+import datetime
+import threading
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+import numpy as np
+from .models import Payment, Income
+from . import archive
+from .columns import LedgerColumns, CombinedColumns, EMPTY_COLUMNS, to_day
+from .lru import LRU
+
+# 書き込みの度に変わる。値が変わった時だけ差分の取り込みを行う
+VERSION_KEY = 'kakeibo:snapshot_version:{owner}:{kind}'
+# 削除の度に変わる。値が変わったら全件を読み直す
+GENERATION_KEY = 'kakeibo:snapshot_generation:{owner}:{kind}'
+
+
+def new_version():
+    """バージョンの新しい値
+
+    ファイルやデータベースのキャッシュの incr は読んでから書くため、同時に書き込むと増分が失われる。
+    毎回一意な値にすれば、同時に書き込んでも値は必ず変わる。
+    """
+    return uuid.uuid4().hex
+
+
+def _bump(key):
+    cache.set(key, new_version(), None)
+
+
+def changed_since(max_id, watermark):
+    """前回の取り込み以降に追加・更新された行の条件
+
+    先に更新日時を付けた書き込みが後からコミットされることがあるため、透かしより少し前から読み直す。
+    """
+    condition = Q(id__gt=max_id)
+    if watermark is not None:
+        lag = datetime.timedelta(seconds=getattr(settings, 'KAKEIBO_SNAPSHOT_WATERMARK_LAG', 60))
+        condition |= Q(updated_at__gte=watermark - lag)
+    return condition
+
+
+class LedgerSnapshot:
+    """ある世帯の、一つのモデル(支出または収入)の列指向スナップショット"""
+
+    def __init__(self, model, owner_id):
+        self.model = model
+        self.kind = model.__name__
+        self.owner_id = owner_id
+        self.columns = EMPTY_COLUMNS
+        self.archive = []
+        self.archive_mtime = None
+        self.combined = CombinedColumns([])
+        self.max_id = 0
+        self.watermark = None
+        self.loaded = False
+        self.version = None
+        self.generation = None
+        self._lock = threading.Lock()
+
+    def _fetch(self, queryset, category_ids):
+        """クエリセットを列の配列に変換する。新しいカテゴリはcategory_idsの末尾に追加される"""
+        codes = {category_id: code for code, category_id in enumerate(category_ids)}
+
+        def category_code(category_id):
+            if category_id not in codes:
+                codes[category_id] = len(category_ids)
+                category_ids.append(category_id)
+            return codes[category_id]
+
+        rows = list(queryset.order_by('id').values_list('id', 'date', 'price', 'category_id', 'updated_at',
+                                                        'deleted_at'))
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        days = np.fromiter((to_day(row[1]) for row in rows), dtype=np.int32, count=len(rows))
+        prices = np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows))
+        categories = np.fromiter((category_code(row[3]) for row in rows), dtype=np.int16, count=len(rows))
+        deleted = np.fromiter((row[5] is not None for row in rows), dtype=bool, count=len(rows))
+        watermark = max((row[4] for row in rows), default=None)
+        return ids, days, prices, categories, deleted, watermark
+
+    def _live_queryset(self, manager=None):
+        """凍結済みの年はアーカイブから読むため、データベースからは未凍結の年だけを取り出す"""
+        manager = manager or self.model.objects
+        return manager.filter(archive.live_filter(self.kind, self.owner_id))
+
+    def _load(self):
+        self.archive_mtime = archive.manifest_mtime()
+        self.archive = archive.load_archive(self.kind, self.owner_id)
+        category_ids = []
+        ids, days, prices, categories, _, self.watermark = self._fetch(self._live_queryset(), category_ids)
+        self.columns = LedgerColumns(ids, days, prices, categories, category_ids)
+
+    def _merge(self):
+        """前回の取り込み以降に追加・更新・ゴミ箱への移動・復元された行を反映する"""
+        condition = changed_since(self.max_id, self.watermark)
+        current = self.columns
+        category_ids = list(current.category_ids)
+        # ゴミ箱に移された行を取り除くため、削除済みの行も含めて読む
+        ids, days, prices, categories, deleted, watermark = self._fetch(
+            self._live_queryset(self.model.all_objects).filter(condition), category_ids)
+        if not len(ids):
+            return
+
+        # idは昇順に並んでいるので、既存行の位置は二分探索で求まる
+        positions = np.searchsorted(current.ids, ids)
+        exists = positions < len(current.ids)
+        exists[exists] = current.ids[positions[exists]] == ids[exists]
+        updated = exists & ~deleted
+        removed = positions[exists & deleted]
+        added = ~exists & ~deleted
+
+        # 参照中の列は書き換えず、新しい配列を作って差し替える
+        new_ids = np.concatenate([current.ids, ids[added]])
+        new_days = np.concatenate([current.days, days[added]])
+        new_prices = np.concatenate([current.prices, prices[added]])
+        new_categories = np.concatenate([current.categories, categories[added]])
+        new_days[positions[updated]] = days[updated]
+        new_prices[positions[updated]] = prices[updated]
+        new_categories[positions[updated]] = categories[updated]
+
+        keep = np.ones(len(new_ids), dtype=bool)
+        keep[removed] = False
+        # 復元された行は既存のidの間に入るため、idの昇順に並べ直す
+        order = np.argsort(new_ids, kind='stable') if added.any() and ids[added][0] < self.max_id else None
+        if order is not None:
+            order = order[keep[order]]
+        elif removed.size:
+            order = keep
+        if order is not None:
+            new_ids, new_days, new_prices, new_categories = (
+                new_ids[order], new_days[order], new_prices[order], new_categories[order])
+        self.columns = LedgerColumns(new_ids, new_days, new_prices, new_categories, category_ids)
+        self.watermark = max(self.watermark, watermark) if self.watermark else watermark
+
+    def refresh(self):
+        """他の書き込みがあった場合のみ、データベースから差分を取り込み、アーカイブと合わせた最新の列を返す"""
+        version = cache.get(VERSION_KEY.format(owner=self.owner_id, kind=self.kind))
+        generation = cache.get(GENERATION_KEY.format(owner=self.owner_id, kind=self.kind))
+        archive_mtime = archive.manifest_mtime()
+        if self._is_current(version, generation, archive_mtime):
+            return self.combined
+        with self._lock:
+            if self._is_current(version, generation, archive_mtime):
+                return self.combined
+            if not self.loaded or generation != self.generation or archive_mtime != self.archive_mtime:
+                self._load()
+            else:
+                self._merge()
+            self.max_id = int(self.columns.ids[-1]) if len(self.columns) else 0
+            self.loaded = True
+            self.version = version
+            self.generation = generation
+            self.combined = CombinedColumns(self.archive + [self.columns])
+        return self.combined
+
+    def _is_current(self, version, generation, archive_mtime):
+        return (self.loaded
+                and version == self.version
+                and generation == self.generation
+                and archive_mtime == self.archive_mtime)
+
+
+MODELS = {
+    'Payment': Payment,
+    'Income': Income,
+}
+
+# (種類, 世帯のpk) -> スナップショット。世帯の数だけメモリが増えないよう、使われていないものから捨てる
+snapshots = LRU(getattr(settings, 'KAKEIBO_SNAPSHOT_CACHE_SIZE', 256))
+
+
+def get_snapshot(kind, owner_id):
+    """世帯の、最新の状態に更新した台帳の列を返す"""
+    ledger = snapshots.get_or_create((kind, owner_id), lambda: LedgerSnapshot(MODELS[kind], owner_id))
+    return ledger.refresh()
+
+
+def mark_written(kind, owner_id):
+    _bump(VERSION_KEY.format(owner=owner_id, kind=kind))
+
+
+def mark_deleted(kind, owner_id):
+    _bump(GENERATION_KEY.format(owner=owner_id, kind=kind))
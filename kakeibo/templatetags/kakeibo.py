@@ -1,13 +1,64 @@
+from urllib.parse import urlencode
 from django import template
+from django.utils.html import format_html
+from kakeibo.assets import plotly_js_url
 
 register = template.Library()
 
 
+class QueryStringBuilder:
+    """
+    GETパラメータを一度だけ解析し、一部を置き換えたクエリ文字列を作る。
+    置き換えるパラメータより前と後ろの部分は、エンコード済みの文字列としてパラメータ名ごとに使い回す。
+    """
+
+    def __init__(self, query_dict):
+        # (パラメータ名, エンコード済みの "key=value&key=value")
+        self._segments = [(key, urlencode([(key, value) for value in values]))
+                          for key, values in query_dict.lists()]
+        self._parts = {}
+
+    def _split(self, field):
+        """置き換えるパラメータの前後のエンコード済み文字列"""
+        parts = self._parts.get(field)
+        if parts is None:
+            keys = [key for key, _ in self._segments]
+            if field in keys:
+                index = keys.index(field)
+                before = [segment for _, segment in self._segments[:index]]
+                after = [segment for _, segment in self._segments[index + 1:]]
+            else:
+                # 存在しないパラメータは末尾に追加する
+                before = [segment for _, segment in self._segments]
+                after = []
+            parts = self._parts[field] = (''.join(f'{segment}&' for segment in before),
+                                          ''.join(f'&{segment}' for segment in after))
+        return parts
+
+    def replace(self, field, value):
+        before, after = self._split(field)
+        return f'{before}{urlencode([(field, str(value))])}{after}'
+
+
+def get_query_string_builder(request):
+    """リクエストごとに一つのQueryStringBuilderを使い回す"""
+    builder = getattr(request, '_query_string_builder', None)
+    if builder is None:
+        builder = request._query_string_builder = QueryStringBuilder(request.GET)
+    return builder
+
+
 @register.simple_tag
 def url_replace(request, field, value):
     """
     GETパラメータの一部を置き換える。
     """
-    url_dict = request.GET.copy()
-    url_dict[field] = str(value)
-    return url_dict.urlencode()
+    return get_query_string_builder(request).replace(field, value)
+
+
+@register.simple_tag
+def plotly_js():
+    """
+    Plotly.jsを読み込むscriptタグ。グラフのあるページでだけ使う。
+    """
+    return format_html('<script src="{}"></script>', plotly_js_url())
@@ -1,3 +1,1072 @@
-from django.test import TestCase
+import datetime
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.contrib.staticfiles import finders
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+from django.http import QueryDict
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+import numpy as np
+import tablib
+from plotly.offline import get_plotlyjs_version
+from register.models import Household
+from . import anomaly, archive, assets, recurring, reports, urls
+from .admin import PaymentResource
+from .ledger import Cursor, Ledger
+from .templatetags.kakeibo import QueryStringBuilder, get_query_string_builder, url_replace
+from .aggregates import MONTH_SUMMARY_KEY, compute_month_summary, get_month_summary, get_transition_version
+from .budget import budget_status, crossed_thresholds
+from .categorizer import categorizers, suggest_category
+from .columns import from_day
+from .dedupe import find_near_duplicates, find_unfingerprinted
+from .filters import LIST_FILTERS
+from .forecast import month_forecast
+from .lru import LRU
+from .navigation import MONTHS_KEY, month_navigation
+from .precompute import PrecomputeQueue
+from .models import (Payment, PaymentCategory, Income, IncomeCategory, Budget, ReportJob, RecurringRule,
+                     ChangeLog, MonthlyCategorySpend, CategoryStats)
+from .signals import notify_bulk_write
+from .snapshot import LedgerSnapshot, get_snapshot, mark_written, snapshots
 
-# Create your tests here.
+# 遅い環境では環境変数で実行時間の予算を緩める
+TIME_SCALE = float(os.environ.get('KAKEIBO_TEST_TIME_SCALE', 1))
+
+# クエリ数・SELECTで取得した行数・実行時間(ミリ秒)の上限
+Limit = namedtuple('Limit', 'queries rows ms')
+Case = namedtuple('Case', 'name method args data limit')
+
+
+class QueryRecorder:
+    """実行されたSQLを記録する(connection.execute_wrapper に渡す)"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+    def row_counts(self):
+        """各SQLの取得行数。SELECTは同じ条件で件数を数え直し、それ以外は0とする"""
+        counts = []
+        with connection.cursor() as cursor:
+            for sql, params in self.queries:
+                if not sql.lstrip().upper().startswith('SELECT'):
+                    counts.append(0)
+                    continue
+                cursor.execute(f'SELECT COUNT(*) FROM ({sql}) AS counted', params)
+                counts.append(cursor.fetchone()[0])
+        return counts
+
+
+@override_settings(KAKEIBO_PRECOMPUTE_ASYNC=False, KAKEIBO_REPORT_WORKERS=0)
+class ViewBudgetTests(TestCase):
+    """各ビューのクエリ数・取得行数・実行時間が予算内に収まっているか"""
+
+    @classmethod
+    def setUpClass(cls):
+        # 作成したレポートは一時ディレクトリに書き出す
+        report_dir = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(report_dir.cleanup)
+        report_settings = override_settings(KAKEIBO_REPORT_DIR=report_dir.name)
+        report_settings.enable()
+        cls.addClassCleanup(report_settings.disable)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.household = Household.objects.create(name='テスト世帯')
+        cls.user = get_user_model().objects.create_user('tester', household=cls.household)
+        payment_categories = [PaymentCategory.objects.create(owner=cls.household, name=name)
+                              for name in ('食費', '日用品', '交通費', '家賃', '趣味')]
+        income_category = IncomeCategory.objects.create(owner=cls.household, name='給与')
+
+        # 2年分の台帳。一括作成ではpkが設定されないデータベースもあるため、pkを指定する
+        rng = random.Random(0)
+        descriptions = ['スーパー', 'コンビニ', 'ドラッグストア', '電車', '家賃', '本', None]
+        payments = []
+        for pk in range(1, 2001):
+            date = datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randrange(730))
+            price = rng.randrange(100, 10000)
+            description = rng.choice(descriptions)
+            payments.append(Payment(pk=pk, owner=cls.household, date=date, price=price,
+                                    category=rng.choice(payment_categories), description=description,
+                                    fingerprint=Payment.build_fingerprint(date, price, description)))
+        Payment.objects.bulk_create(payments)
+        notify_bulk_write(Payment, payments)
+        incomes = [Income(pk=pk, owner=cls.household, date=datetime.date(2020 + (pk - 1) // 12, (pk - 1) % 12 + 1, 25),
+                          price=300000, category=income_category) for pk in range(1, 25)]
+        Income.objects.bulk_create(incomes)
+        notify_bulk_write(Income, incomes)
+        Budget.objects.bulk_create([Budget(owner=cls.household, category=category, month=datetime.date(2021, 3, 1),
+                                           limit=50000) for category in payment_categories])
+
+        cls.payment = Payment.objects.get(pk=1)
+        cls.income = Income.objects.get(pk=1)
+        cls.payment_category = payment_categories[0]
+        cls.report_job = ReportJob.objects.create(owner=cls.household, kind='monthly', file_format='csv',
+                                                  start_year=2020, end_year=2021)
+        reports.run_job(cls.report_job.pk)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def cases(self):
+        payment = self.payment
+        income = self.income
+        payment_data = {'date': '2021-03-10', 'price': 1200, 'category': self.payment_category.pk,
+                        'description': 'テスト'}
+        income_data = {'date': '2021-03-25', 'price': 300000, 'category': income.category_id}
+        report_job = self.report_job
+        report_data = {'kind': 'annual', 'file_format': 'csv', 'start_year': 2010, 'end_year': 2021}
+        search = {'year': '2021', 'month': '3', 'greater_than': '500', 'key_word': 'スーパー',
+                  'category': self.payment_category.pk, 'page': '1'}
+        return [
+            Case('payment_list', 'get', (), {}, Limit(6, 25, 300)),
+            Case('payment_list', 'get', (), search, Limit(7, 25, 300)),
+            Case('income_list', 'get', (), {}, Limit(6, 20, 300)),
+            Case('income_list', 'get', (), {'year': '2021', 'greater_than': '1000', 'category': income.category_id},
+                 Limit(7, 25, 300)),
+            # 最初のページだけ残高の合計を集計する
+            Case('ledger', 'get', (), {}, Limit(5, 30, 300)),
+            Case('ledger', 'get', (), {'year': '2021', 'greater_than': '500', 'key_word': 'スーパー'}, Limit(5, 30, 300)),
+            Case('ledger', 'get', (), {'after': Cursor(datetime.date(2021, 3, 1), 'payment', 0, 0).dumps()},
+                 Limit(4, 25, 300)),
+            Case('payment_create', 'get', (), {}, Limit(4, 10, 300)),
+            # 支出の書き込みは外れ度の判定(1件)とカテゴリの統計の更新を含む
+            Case('payment_create', 'post', (), payment_data, Limit(13, 10, 300)),
+            # カテゴリが空欄の場合は、自動分類のために支出を全件学習する
+            Case('payment_create', 'post', (), {**payment_data, 'category': ''}, Limit(14, 2010, 500)),
+            Case('income_create', 'get', (), {}, Limit(4, 10, 300)),
+            Case('income_create', 'post', (), income_data, Limit(7, 10, 300)),
+            Case('payment_update', 'get', (payment.pk,), {}, Limit(5, 10, 300)),
+            Case('payment_update', 'post', (payment.pk,), payment_data, Limit(15, 10, 300)),
+            Case('income_update', 'get', (income.pk,), {}, Limit(5, 10, 300)),
+            Case('income_update', 'post', (income.pk,), income_data, Limit(9, 10, 300)),
+            Case('payment_delete', 'get', (payment.pk,), {}, Limit(4, 10, 300)),
+            Case('payment_delete', 'post', (payment.pk,), {}, Limit(11, 10, 300)),
+            Case('income_delete', 'get', (income.pk,), {}, Limit(4, 10, 300)),
+            Case('income_delete', 'post', (income.pk,), {}, Limit(9, 10, 300)),
+            Case('trash', 'get', (), {}, Limit(5, 110, 300)),
+            Case('payment_restore', 'post', (payment.pk,), {}, Limit(12, 10, 300)),
+            Case('income_restore', 'post', (income.pk,), {}, Limit(10, 10, 300)),
+            # ダッシュボードと推移グラフはキャッシュが無い状態ではスナップショットを全件読み込む
+            # (ダッシュボードは支出のある月の一覧と、その月の外れた支出も読む)
+            Case('month_dashboard', 'get', (2021, 3), {}, Limit(7, 2040, 1000)),
+            Case('transition', 'get', (), {}, Limit(7, 2040, 1000)),
+            Case('transition', 'get', (), {'payment_category': self.payment_category.pk,
+                                           'graph_visible': 'Payment'}, Limit(6, 2010, 1000)),
+            Case('budget_status', 'get', (2021, 3), {}, Limit(6, 20, 300)),
+            Case('precompute_status', 'get', (), {}, Limit(2, 2, 300)),
+            Case('report_list', 'get', (), {}, Limit(4, 25, 300)),
+            # 作成はリクエストの外で行うため、登録だけで終わる
+            Case('report_list', 'post', (), report_data, Limit(4, 10, 300)),
+            Case('report_status', 'get', (report_job.pk,), {}, Limit(4, 10, 300)),
+            Case('report_download', 'get', (report_job.pk,), {}, Limit(4, 10, 300)),
+        ]
+
+    def prepare(self, case):
+        """キャッシュやプロセス内のスナップショットが無い、最も遅い状態から計測する"""
+        cache.clear()
+        snapshots.clear()
+        categorizers.clear()
+        if case.name in ('payment_restore', 'income_restore'):
+            self.payment.soft_delete()
+            self.income.soft_delete()
+
+    def measure(self, case):
+        url = reverse(f'kakeibo:{case.name}', args=case.args)
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            started = time.perf_counter()
+            response = getattr(self.client, case.method)(url, case.data)
+            elapsed = (time.perf_counter() - started) * 1000
+        return response, recorder, elapsed
+
+    def report(self, case, recorder, row_counts, elapsed):
+        lines = [f'{case.method.upper()} {case.name}{case.args} {case.data}',
+                 f'クエリ {len(recorder.queries)}件 (上限 {case.limit.queries}) / '
+                 f'取得行数 {sum(row_counts)}行 (上限 {case.limit.rows}) / '
+                 f'{elapsed:.1f}ms (上限 {case.limit.ms * TIME_SCALE:.0f}ms)']
+        for number, ((sql, params), rows) in enumerate(zip(recorder.queries, row_counts), 1):
+            lines.append(f'  {number}. [{rows}行] {sql} {params}')
+        return '\n'.join(lines)
+
+    def test_view_budgets(self):
+        for case in self.cases():
+            with self.subTest(case=f'{case.method} {case.name} {case.data}'), transaction.atomic():
+                self.prepare(case)
+                response, recorder, elapsed = self.measure(case)
+                row_counts = recorder.row_counts()
+                transaction.set_rollback(True)
+
+                self.assertLess(response.status_code, 400)
+                message = self.report(case, recorder, row_counts, elapsed)
+                self.assertLessEqual(len(recorder.queries), case.limit.queries, message)
+                self.assertLessEqual(sum(row_counts), case.limit.rows, message)
+                self.assertLessEqual(elapsed, case.limit.ms * TIME_SCALE, message)
+
+    def test_every_url_has_budget(self):
+        """新しく追加したURLにも予算を宣言させる"""
+        names = {pattern.name for pattern in urls.urlpatterns}
+        self.assertEqual(names - {case.name for case in self.cases()}, set())
+
+
+@override_settings(KAKEIBO_PRECOMPUTE_ASYNC=False)
+class HouseholdTestCase(TestCase):
+    """世帯・利用者・カテゴリを一つずつ用意する"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.household = Household.objects.create(name='テスト世帯')
+        cls.user = get_user_model().objects.create_user('tester', household=cls.household)
+        cls.category = PaymentCategory.objects.create(owner=cls.household, name='交通費')
+        cls.income_category = IncomeCategory.objects.create(owner=cls.household, name='給与')
+
+    def setUp(self):
+        cache.clear()
+        snapshots.clear()
+        categorizers.clear()
+
+    def pay(self, date, price, description=None, category=None):
+        return Payment.objects.create(owner=self.household, date=date, price=price,
+                                      category=category or self.category, description=description)
+
+
+class DuplicateTests(HouseholdTestCase):
+
+    def test_repeated_payments_are_not_duplicates(self):
+        """毎日の同じ金額の支出は、連鎖して一つのグループにならず、候補にもならない"""
+        for day in range(30):
+            self.pay(datetime.date(2021, 4, 1) + datetime.timedelta(days=day), 200, '電車')
+        self.assertEqual(find_near_duplicates(), [])
+
+        call_command('find_duplicates', '--delete', '--yes', stdout=io.StringIO())
+        self.assertEqual(Payment.objects.count(), 30)
+
+    def test_near_duplicate(self):
+        first = self.pay(datetime.date(2021, 5, 10), 3000, 'スーパー')
+        second = self.pay(datetime.date(2021, 5, 12), 3000, 'ｽｰﾊﾟｰ 駅前店')
+        self.pay(datetime.date(2021, 5, 11), 3001, 'スーパー')
+        self.pay(datetime.date(2021, 5, 20), 3000, 'スーパー')
+        self.assertEqual(find_near_duplicates(), [[first.pk, second.pk]])
+
+    def test_group_span_is_limited_to_window(self):
+        """グループの最初の行と比べるため、window_days を超えてつながらない"""
+        payments = [self.pay(datetime.date(2021, 5, day), 800, 'ランチ') for day in (1, 3, 5)]
+        self.assertEqual(find_near_duplicates(window_days=2), [])
+        self.assertEqual(find_near_duplicates(window_days=5), [[payment.pk for payment in payments]])
+
+    def test_blank_description_is_not_a_wildcard(self):
+        self.pay(datetime.date(2021, 5, 10), 1000)
+        self.pay(datetime.date(2021, 5, 11), 1000, 'コンビニ')
+        self.pay(datetime.date(2021, 5, 12), 1000, '')
+        self.assertEqual(find_near_duplicates(), [])
+
+    def test_delete_requires_confirmation(self):
+        original = self.pay(datetime.date(2021, 5, 10), 3000, 'スーパー')
+        duplicate = self.pay(datetime.date(2021, 5, 11), 3000, 'スーパー')
+        with mock.patch('builtins.input', return_value='n'):
+            call_command('find_duplicates', '--delete', stdout=io.StringIO())
+        self.assertEqual(Payment.objects.count(), 2)
+
+        with mock.patch('builtins.input', return_value='y'):
+            call_command('find_duplicates', '--delete', stdout=io.StringIO())
+        self.assertEqual(list(Payment.objects.values_list('pk', flat=True)), [original.pk])
+        self.assertTrue(Payment.all_objects.get(pk=duplicate.pk).deleted_at)
+
+    def test_unfingerprinted_duplicates_are_listed_and_resolved(self):
+        """移行で指紋を付けなかった完全な重複を一覧し、--delete でゴミ箱に移すか指紋を付ける"""
+        original = self.pay(datetime.date(2021, 5, 10), 3000, 'スーパー')
+        duplicate = self.pay(datetime.date(2021, 5, 11), 3000, 'スーパー')
+        alone = self.pay(datetime.date(2021, 6, 1), 500, '本')
+        Payment.objects.filter(pk=duplicate.pk).update(date=original.date, fingerprint=None)
+        Payment.objects.filter(pk=alone.pk).update(fingerprint=None)
+        self.assertEqual(find_unfingerprinted(), [(duplicate.pk, original.pk), (alone.pk, None)])
+
+        out = io.StringIO()
+        call_command('find_duplicates', stdout=out)
+        self.assertIn(f'#{duplicate.pk} ', out.getvalue())
+        self.assertIn(f'#{original.pk} と同じ明細です', out.getvalue())
+
+        call_command('find_duplicates', '--delete', '--yes', stdout=io.StringIO())
+        self.assertEqual(list(Payment.objects.order_by('pk').values_list('pk', flat=True)), [original.pk, alone.pk])
+        self.assertEqual(Payment.objects.get(pk=alone.pk).fingerprint,
+                         Payment.build_fingerprint(alone.date, alone.price, alone.description))
+        self.assertEqual(find_unfingerprinted(), [])
+
+    def test_clean_rejects_exact_duplicate(self):
+        payment = self.pay(datetime.date(2021, 5, 10), 3000, 'スーパー')
+        payment.full_clean()
+        with self.assertRaises(ValidationError):
+            Payment(owner=self.household, date=payment.date, price=3000, category=self.category,
+                    description='ｽｰﾊﾟｰ').full_clean()
+        payment.soft_delete()
+        Payment(owner=self.household, date=payment.date, price=3000, category=self.category,
+                description='スーパー').full_clean()
+
+    def test_admin_reports_duplicate_instead_of_failing(self):
+        admin_user = get_user_model().objects.create_superuser('admin', household=self.household)
+        self.client.force_login(admin_user)
+        self.pay(datetime.date(2021, 5, 10), 3000, 'スーパー')
+        data = {'owner': self.household.pk, 'date': '2021-05-10', 'price': 3000, 'category': self.category.pk,
+                'description': 'スーパー'}
+        response = self.client.post(reverse('admin:kakeibo_payment_add'), data)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '同じ日付・金額・摘要の支出が既に登録されています')
+        self.assertEqual(Payment.objects.count(), 1)
+
+
+class RecurringTests(HouseholdTestCase):
+
+    def test_manual_duplicate_is_not_generated_again(self):
+        """手入力した同じ明細がある期日は作成せず、残りの期日は作成する"""
+        rule = RecurringRule.objects.create(owner=self.household, kind='Payment', day=25, price=80000,
+                                            payment_category=self.category, description='家賃',
+                                            start_date=datetime.date(2021, 1, 1))
+        manual = self.pay(datetime.date(2021, 2, 25), 80000, '家賃')
+
+        self.assertEqual(recurring.generate(until=datetime.date(2021, 3, 31)), {'Payment': 2, 'Income': 0})
+        payments = Payment.objects.order_by('date')
+        self.assertEqual([payment.date.month for payment in payments], [1, 2, 3])
+        self.assertEqual(payments[1].pk, manual.pk)
+        self.assertEqual(ChangeLog.objects.filter(kind='Payment', action='create').count(), 3)
+        spend = MonthlyCategorySpend.objects.get(category=self.category, month=datetime.date(2021, 2, 1))
+        self.assertEqual((spend.total, spend.count), (80000, 1))
+        self.assertEqual(CategoryStats.objects.get(category=self.category).count, 3)
+
+        # 次の実行でも同じ期日で失敗し続けることはない
+        rule.refresh_from_db()
+        self.assertEqual(rule.last_generated, datetime.date(2021, 3, 25))
+        self.assertEqual(recurring.generate(until=datetime.date(2021, 4, 30)), {'Payment': 1, 'Income': 0})
+
+    def test_fingerprint_lookup_is_batched(self):
+        """長期間の作成でも、指紋の照合はバインド変数の上限を超えない件数ずつ行う"""
+        for price in (1000, 2000, 3000):
+            RecurringRule.objects.create(owner=self.household, kind='Payment', day=1, price=price,
+                                         payment_category=self.category, description='定額',
+                                         start_date=datetime.date(2019, 1, 1))
+        self.pay(datetime.date(2021, 6, 1), 3000, '定額')
+
+        with mock.patch.object(recurring, 'LOOKUP_BATCH_SIZE', 10), CaptureQueriesContext(connection) as queries:
+            created = recurring.generate(until=datetime.date(2021, 12, 31))
+        self.assertEqual(created, {'Payment': 3 * 36 - 1, 'Income': 0})
+        lookups = [query['sql'] for query in queries if '"fingerprint" IN' in query['sql']]
+        self.assertEqual(len(lookups), 11)
+        self.assertEqual(Payment.objects.filter(date=datetime.date(2021, 6, 1), price=3000).count(), 1)
+
+
+class ArchiveTests(HouseholdTestCase):
+
+    def setUp(self):
+        super().setUp()
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        archive_settings = override_settings(KAKEIBO_ARCHIVE_DIR=archive_dir.name)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+    def totals(self):
+        columns = get_snapshot('Payment', self.household.pk)
+        return columns.totals_by_month(columns.mask())
+
+    def test_archived_year_is_read_from_archive(self):
+        self.pay(datetime.date(2020, 3, 1), 1000, 'スーパー')
+        self.pay(datetime.date(2020, 3, 2), 2000, 'コンビニ')
+        self.pay(datetime.date(2021, 1, 5), 500, '電車')
+        call_command('archive_ledger', '--year', '2020', stdout=io.StringIO())
+        snapshots.clear()
+
+        self.assertEqual(archive.archived_years('Payment', self.household.pk), [2020])
+        self.assertEqual(self.totals(), (['2020-03', '2021-01'], [3000, 500]))
+        ledger = snapshots[('Payment', self.household.pk)]
+        self.assertEqual(len(ledger.archive[0]), 2)
+        self.assertEqual(list(ledger.columns.ids), [Payment.objects.get(date__year=2021).pk])
+
+    def test_write_in_archived_year_thaws_it(self):
+        payment = self.pay(datetime.date(2020, 3, 1), 1000, 'スーパー')
+        trashed = self.pay(datetime.date(2020, 3, 2), 2000, 'コンビニ')
+        call_command('archive_ledger', '--year', '2020', stdout=io.StringIO())
+        self.assertEqual(self.totals(), (['2020-03'], [3000]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            payment.price = 1500
+            payment.save()
+            trashed.soft_delete()
+        self.assertEqual(archive.archived_years('Payment', self.household.pk), [])
+        self.assertEqual(self.totals(), (['2020-03'], [1500]))
+
+        # 日付を凍結済みの年に移した場合も反映する
+        call_command('archive_ledger', '--year', '2020', stdout=io.StringIO())
+        moved = self.pay(datetime.date(2021, 2, 1), 700, '本')
+        with self.captureOnCommitCallbacks(execute=True):
+            moved.date = datetime.date(2020, 4, 1)
+            moved.save()
+        self.assertEqual(self.totals(), (['2020-03', '2020-04'], [1500, 700]))
+
+    def test_concurrent_thaws_do_not_lose_updates(self):
+        """別の世帯の解除が重なっても、マニフェストに削除済みの年が残らない"""
+        owner_ids = range(1000, 1016)
+        for owner_id in owner_ids:
+            archive.freeze_year(Payment, owner_id, 2020)
+        threads = [threading.Thread(target=archive.thaw_year, args=('Payment', owner_id, 2020))
+                   for owner_id in owner_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for owner_id in owner_ids:
+            self.assertEqual(archive.archived_years('Payment', owner_id), [])
+            self.assertFalse(archive.year_dir('Payment', owner_id, 2020).exists())
+        self.assertEqual(sorted(path.name for path in archive.archive_dir().iterdir()
+                                if path.is_file()), [archive.MANIFEST_NAME, archive.LOCK_NAME])
+
+    def test_write_during_freeze_thaws_after_freezing(self):
+        """凍結中の年への書き込みの解除は、凍結が終わるのを待ってから行う"""
+        self.pay(datetime.date(2020, 3, 1), 1000, 'スーパー')
+        save = np.save
+        waiting = []
+
+        def save_while_writing(*args, **kwargs):
+            if not waiting:
+                # 凍結が行を読んだ後にコミットされた書き込み
+                writer = threading.Thread(target=archive.thaw_dates,
+                                          args=('Payment', self.household.pk, [datetime.date(2020, 5, 1)]))
+                writer.start()
+                writer.join(0.2)
+                self.assertTrue(writer.is_alive())
+                waiting.append(writer)
+            return save(*args, **kwargs)
+
+        with mock.patch.object(np, 'save', save_while_writing):
+            archive.freeze_year(Payment, self.household.pk, 2020)
+        waiting[0].join()
+        self.assertEqual(archive.archived_years('Payment', self.household.pk), [])
+
+    def test_missing_year_files_are_skipped(self):
+        """マニフェストを読んだ後に解除された年は、アーカイブから読まない"""
+        self.pay(datetime.date(2020, 3, 1), 1000, 'スーパー')
+        archive.freeze_year(Payment, self.household.pk, 2020)
+        shutil.rmtree(archive.year_dir('Payment', self.household.pk, 2020))
+        self.assertEqual(archive.load_archive('Payment', self.household.pk), [])
+
+
+class MonthUrlTests(HouseholdTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def test_month_dashboard_rejects_invalid_month(self):
+        for year, month in ((2021, 13), (2021, 0), (0, 1), (9999, 12)):
+            with self.subTest(year=year, month=month):
+                response = self.client.get(reverse('kakeibo:month_dashboard', args=(year, month)))
+                self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get(reverse('kakeibo:month_dashboard', args=(2021, 12))).status_code, 200)
+
+    def test_budget_status_rejects_invalid_month(self):
+        for year, month in ((2021, 13), (2021, 0)):
+            with self.subTest(year=year, month=month):
+                response = self.client.get(reverse('kakeibo:budget_status', args=(year, month)))
+                self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get(reverse('kakeibo:budget_status', args=(2021, 12))).status_code, 200)
+
+
+class CompactHistoryTests(HouseholdTestCase):
+
+    def age_history(self):
+        ChangeLog.objects.update(created_at=timezone.now() - datetime.timedelta(days=400))
+        Payment.all_objects.exclude(deleted_at=None).update(deleted_at=timezone.now() - datetime.timedelta(days=60))
+
+    def actions(self, payment):
+        return list(ChangeLog.objects.filter(kind='Payment', object_id=payment.pk).order_by('id')
+                    .values_list('action', 'changes'))
+
+    def test_updates_are_folded_and_lifecycle_is_kept(self):
+        payment = self.pay(datetime.date(2021, 5, 1), 1000, 'スーパー')
+        for price in (1100, 1200):
+            payment.price = price
+            payment.save()
+        payment.description = 'コンビニ'
+        payment.save()
+        payment.soft_delete()
+        payment.restore()
+        payment.price = 1300
+        payment.save()
+        payment.price = 1200
+        payment.save()
+        self.age_history()
+
+        call_command('compact_history', stdout=io.StringIO())
+        self.assertEqual([action for action, _ in self.actions(payment)], ['create', 'update', 'delete', 'restore'])
+        self.assertEqual(self.actions(payment)[1][1], {'price': [1000, 1200], 'description': ['スーパー', 'コンビニ']})
+        self.assertTrue(Payment.objects.filter(pk=payment.pk).exists())
+
+    def test_purge_is_opt_in_and_recorded(self):
+        payment = self.pay(datetime.date(2021, 5, 1), 1000, 'スーパー')
+        payment.soft_delete()
+        self.age_history()
+
+        call_command('compact_history', stdout=io.StringIO())
+        self.assertTrue(Payment.all_objects.filter(pk=payment.pk).exists())
+
+        call_command('compact_history', '--purge-trash', stdout=io.StringIO())
+        self.assertFalse(Payment.all_objects.filter(pk=payment.pk).exists())
+        self.assertEqual([action for action, _ in self.actions(payment)], ['create', 'delete', 'purge'])
+
+
+class MonthSummaryTests(HouseholdTestCase):
+
+    def test_categories_with_the_same_name_are_added_up(self):
+        other = PaymentCategory.objects.create(owner=self.household, name=self.category.name)
+        self.pay(datetime.date(2021, 5, 1), 1000, 'バス')
+        self.pay(datetime.date(2021, 5, 2), 500, '電車', category=other)
+        summary = compute_month_summary(self.household.pk, 2021, 5)
+        self.assertEqual(summary['table_set'], {'交通費': 1500})
+        self.assertEqual(summary['total_payment'], 1500)
+
+
+class AssetTests(SimpleTestCase):
+
+    def test_plotly_bundle_matches_installed_plotly(self):
+        """plotlyを更新したら、同梱のPlotly.jsも同じバージョンに置き換える"""
+        self.assertEqual(assets.PLOTLY_VERSION, get_plotlyjs_version())
+        path = finders.find(assets.PLOTLY_BUNDLE)
+        self.assertIsNotNone(path)
+        with open(path, 'rb') as f:
+            self.assertIn(f'plotly.js v{assets.PLOTLY_VERSION}'.encode(), f.read(200))
+        self.assertEqual(assets.plotly_js_url(), f'/static/{assets.PLOTLY_BUNDLE}')
+
+    def test_collected_bundle_has_hashed_name(self):
+        """collectstatic後は、README.md の設定例で長期間キャッシュされるハッシュ付きの名前で参照する"""
+        with tempfile.TemporaryDirectory() as static_root, override_settings(STATIC_ROOT=static_root):
+            call_command('collectstatic', '--noinput', verbosity=0)
+            self.assertRegex(assets.plotly_js_url(),
+                             r'^/static/kakeibo/vendor/plotly-2\.35\.2\.min\.[0-9a-f]{12}\.js$')
+
+
+class LRUTests(SimpleTestCase):
+
+    def test_least_recently_used_is_dropped(self):
+        lru = LRU(2)
+        first = lru.get_or_create(1, object)
+        lru.get_or_create(2, object)
+        self.assertIs(lru.get_or_create(1, object), first)
+        lru.get_or_create(3, object)
+        self.assertEqual((1 in lru, 2 in lru, 3 in lru, len(lru)), (True, False, True, 2))
+
+
+class RecurringRuleTests(HouseholdTestCase):
+
+    def test_category_of_another_household_is_rejected(self):
+        other = Household.objects.create(name='別の世帯')
+        rule = RecurringRule(owner=other, kind='Payment', day=25, price=80000, payment_category=self.category,
+                             start_date=datetime.date(2021, 1, 1))
+        with self.assertRaises(ValidationError) as raised:
+            rule.full_clean()
+        self.assertIn('payment_category', raised.exception.message_dict)
+
+        rule.owner = self.household
+        rule.full_clean()
+
+
+class HouseholdAdminTests(HouseholdTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = Household.objects.create(name='別の世帯')
+        cls.other_category = PaymentCategory.objects.create(owner=cls.other, name='別の食費')
+        cls.staff = get_user_model().objects.create_user('staff', household=cls.household, is_staff=True)
+        cls.staff.user_permissions.set(Permission.objects.filter(content_type__app_label='kakeibo'))
+
+    def test_category_of_another_household_is_rejected(self):
+        for instance in (Payment(owner=self.household, date=datetime.date(2021, 5, 1), price=100,
+                                 category=self.other_category),
+                         Income(owner=self.household, date=datetime.date(2021, 5, 1), price=100,
+                                category=IncomeCategory.objects.create(owner=self.other, name='別の給与')),
+                         Budget(owner=self.household, month=datetime.date(2021, 5, 1), limit=100,
+                                category=self.other_category)):
+            with self.subTest(model=type(instance).__name__):
+                with self.assertRaises(ValidationError) as raised:
+                    instance.full_clean()
+                self.assertIn('category', raised.exception.message_dict)
+
+    def test_staff_sees_only_own_household(self):
+        own = self.pay(datetime.date(2021, 5, 1), 100, '自分の世帯')
+        other = Payment.objects.create(owner=self.other, date=datetime.date(2021, 5, 1), price=200,
+                                       category=self.other_category, description='別の世帯')
+        self.client.force_login(self.staff)
+
+        response = self.client.get(reverse('admin:kakeibo_payment_changelist'))
+        self.assertContains(response, '自分の世帯')
+        self.assertNotContains(response, '別の世帯')
+        response = self.client.get(reverse('admin:kakeibo_payment_change', args=(other.pk,)))
+        self.assertNotEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('admin:kakeibo_payment_change', args=(own.pk,))).status_code, 200)
+
+        form = self.client.get(reverse('admin:kakeibo_payment_add')).context['adminform'].form
+        self.assertEqual(list(form.fields['category'].queryset), [self.category])
+        self.assertEqual(list(form.fields['owner'].queryset), [self.household])
+
+    def test_import_rejects_other_households(self):
+        dataset = tablib.Dataset(headers=['owner', 'date', 'price', 'category', 'description'])
+        dataset.append([self.other.pk, '2021-05-01', 100, self.other_category.pk, '別の世帯'])
+        dataset.append(['', '2021-05-02', 200, self.other_category.pk, '別の世帯のカテゴリ'])
+        dataset.append(['', '2021-05-03', 300, self.category.pk, '自分の世帯'])
+        result = PaymentResource(owner=self.household, restrict_owner=True).import_data(dataset)
+        self.assertEqual([row.import_type for row in result.rows], ['invalid', 'invalid', 'new'])
+        self.assertEqual(list(Payment.objects.values_list('description', flat=True)), ['自分の世帯'])
+
+
+class MonthNavigationTests(HouseholdTestCase):
+
+    def test_months_with_data(self):
+        for date in (datetime.date(2020, 11, 5), datetime.date(2021, 1, 5), datetime.date(2021, 3, 5)):
+            self.pay(date, 1000, f'支出{date}')
+        nav = month_navigation(self.household.pk, 2021, 1)
+        self.assertEqual((nav.has_data, nav.prev, nav.next, nav.first, nav.last),
+                         (True, (2020, 11), (2021, 3), (2020, 11), (2021, 3)))
+        nav = month_navigation(self.household.pk, 2021, 2)
+        self.assertEqual((nav.has_data, nav.prev, nav.next), (False, (2021, 1), (2021, 3)))
+        nav = month_navigation(None, 2021, 2)
+        self.assertEqual((nav.has_data, nav.prev, nav.next, nav.first), (False, None, None, None))
+
+    def test_navbar_links_to_current_month(self):
+        """ナビゲーションは共通コンテクストの month_nav で今月へリンクし、支出のある月は読まない"""
+        self.client.force_login(self.user)
+        today = timezone.localdate()
+        current = reverse('kakeibo:month_dashboard', args=(today.year, today.month))
+        response = self.client.get(reverse('kakeibo:payment_list'))
+        self.assertEqual(response.context['month_nav'].current, (today.year, today.month))
+        self.assertContains(response, f'href="{current}"')
+        self.assertContains(response, f'href="{reverse("kakeibo:budget_status", args=(today.year, today.month))}"')
+        self.assertIsNone(cache.get(MONTHS_KEY.format(owner=self.household.pk)))
+
+        # 過去の月のページでも、ナビゲーションは今月を指す
+        self.pay(datetime.date(2021, 3, 5), 1000, '支出')
+        response = self.client.get(reverse('kakeibo:month_dashboard', args=(2021, 3)))
+        self.assertContains(response, f'href="{current}"')
+
+
+class LedgerTests(HouseholdTestCase):
+
+    def test_cursor_pagination_walks_every_row_once(self):
+        rng = random.Random(0)
+        for day in range(40):
+            date = datetime.date(2021, 1, 1) + datetime.timedelta(days=rng.randrange(20))
+            self.pay(date, rng.randrange(100, 1000), f'支出{day}')
+            if day % 4 == 0:
+                Income.objects.create(owner=self.household, date=date, price=5000, category=self.income_category)
+        ledger = Ledger(self.household.pk)
+
+        rows = []
+        cursor = None
+        while True:
+            page = ledger.page(cursor, size=7)
+            rows.extend(page.rows)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+            # カーソルはURLに載せるため、文字列を経由する
+            cursor = Cursor.loads(cursor.dumps())
+
+        expected = sorted([('payment', pk, date, -price) for pk, date, price in
+                           Payment.objects.values_list('pk', 'date', 'price')]
+                          + [('income', pk, date, price) for pk, date, price in
+                             Income.objects.values_list('pk', 'date', 'price')],
+                          key=lambda row: (row[2], row[0], row[1]), reverse=True)
+        self.assertEqual([(row['kind'], row['id'], row['date'], row['amount']) for row in rows], expected)
+        # 各行の残高は、その行までの累計(古い行から足し上げたもの)
+        balance = sum(row[3] for row in expected)
+        for row in rows:
+            self.assertEqual(row['balance'], balance)
+            balance -= row['amount']
+
+    def test_invalid_cursor_is_first_page(self):
+        self.assertIsNone(Cursor.loads('invalid'))
+        self.assertIsNone(Cursor.loads(signing.dumps(['2021-01-01', 'payment'], salt='kakeibo.ledger')))
+
+
+class SnapshotTests(HouseholdTestCase):
+
+    def assertSnapshotMatchesDatabase(self):
+        get_snapshot('Payment', self.household.pk)
+        columns = snapshots[('Payment', self.household.pk)].columns
+        rows = [(int(pk), from_day(day), int(price), columns.category_ids[code])
+                for pk, day, price, code in zip(columns.ids, columns.days, columns.prices, columns.categories)]
+        self.assertEqual(rows, list(Payment.objects.order_by('id').values_list('id', 'date', 'price', 'category_id')))
+
+    def test_incremental_merge_after_writes(self):
+        other = PaymentCategory.objects.create(owner=self.household, name='食費')
+        payments = [self.pay(datetime.date(2021, 5, day), day * 100, f'支出{day}') for day in range(1, 11)]
+        self.assertSnapshotMatchesDatabase()
+        # 推移グラフの事前計算が読む収入のスナップショットも、先に読み込んでおく
+        get_snapshot('Income', self.household.pk)
+
+        def edit(payment, **values):
+            for field, value in values.items():
+                setattr(payment, field, value)
+            payment.save()
+
+        # 追加・更新・ゴミ箱への移動・復元は、全件を読み直さずに差分で取り込む
+        steps = [
+            lambda: edit(payments[0], price=5000),
+            lambda: edit(payments[1], date=datetime.date(2021, 6, 1)),
+            lambda: edit(payments[2], category=other),
+            lambda: payments[3].soft_delete(),
+            lambda: self.pay(datetime.date(2021, 5, 20), 700, '追加'),
+            lambda: payments[3].restore(),
+            lambda: (payments[4].soft_delete(), edit(payments[5], price=1)),
+        ]
+        with mock.patch.object(LedgerSnapshot, '_load', side_effect=AssertionError('全件を読み直した')):
+            for step in steps:
+                with self.captureOnCommitCallbacks(execute=True):
+                    step()
+                self.assertSnapshotMatchesDatabase()
+
+        # 完全な削除は全件を読み直す
+        with self.captureOnCommitCallbacks(execute=True):
+            payments[6].delete()
+        self.assertSnapshotMatchesDatabase()
+
+    def test_update_committed_after_a_newer_one_is_merged(self):
+        """更新日時の古い書き込みが、新しい書き込みの取り込み後にコミットされても取りこぼさない"""
+        late, trashed, newer = [self.pay(datetime.date(2021, 5, day), 1000, f'支出{day}') for day in (1, 2, 3)]
+        self.assertSnapshotMatchesDatabase()
+        with self.captureOnCommitCallbacks(execute=True):
+            newer.price = 3000
+            newer.save()
+        self.assertSnapshotMatchesDatabase()
+
+        stamped = Payment.objects.get(pk=newer.pk).updated_at - datetime.timedelta(seconds=5)
+        Payment.objects.filter(pk=late.pk).update(price=1500, updated_at=stamped)
+        Payment.objects.filter(pk=trashed.pk).update(deleted_at=stamped, updated_at=stamped)
+        mark_written('Payment', self.household.pk)
+        self.assertSnapshotMatchesDatabase()
+
+
+class CategorizerTests(HouseholdTestCase):
+
+    def test_suggests_category_from_learned_keywords(self):
+        food = PaymentCategory.objects.create(owner=self.household, name='食費')
+        for day in range(1, 6):
+            self.pay(datetime.date(2021, 5, day), 1000 + day, f'スーパー ライフ {day}', category=food)
+            self.pay(datetime.date(2021, 5, day), 200 + day, f'電車 {day}')
+            self.pay(datetime.date(2021, 6, day), 300 + day, f'バス {day}')
+        self.assertEqual(suggest_category(self.household.pk, 'ライフ 駅前店'), food.pk)
+        self.assertEqual(suggest_category(self.household.pk, 'ＪＲ電車'), self.category.pk)
+        # キーワードが無い場合は最も件数の多いカテゴリ
+        self.assertEqual(suggest_category(self.household.pk, '不明'), self.category.pk)
+
+    def test_learns_writes_incrementally(self):
+        food = PaymentCategory.objects.create(owner=self.household, name='食費')
+        payment = self.pay(datetime.date(2021, 5, 1), 1000, 'パン屋')
+        self.assertEqual(suggest_category(self.household.pk, 'パン屋'), self.category.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            payment.category = food
+            payment.save()
+        self.assertEqual(suggest_category(self.household.pk, 'パン屋'), food.pk)
+
+    def test_learns_update_committed_after_a_newer_one(self):
+        food = PaymentCategory.objects.create(owner=self.household, name='食費')
+        late = self.pay(datetime.date(2021, 5, 1), 1000, 'パン屋')
+        newer = self.pay(datetime.date(2021, 5, 2), 1000, '本屋')
+        self.assertEqual(suggest_category(self.household.pk, 'パン屋'), self.category.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            newer.price = 2000
+            newer.save()
+        self.assertEqual(suggest_category(self.household.pk, '本屋'), self.category.pk)
+
+        stamped = Payment.objects.get(pk=newer.pk).updated_at - datetime.timedelta(seconds=5)
+        Payment.objects.filter(pk=late.pk).update(category=food, updated_at=stamped)
+        mark_written('Payment', self.household.pk)
+        self.assertEqual(suggest_category(self.household.pk, 'パン屋'), food.pk)
+
+
+class FilterTests(HouseholdTestCase):
+
+    def test_list_filters_match_python_filtering(self):
+        other = PaymentCategory.objects.create(owner=self.household, name='食費')
+        rng = random.Random(0)
+        for pk in range(200):
+            self.pay(datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randrange(730)), rng.randrange(100, 5000),
+                     rng.choice(['スーパー 駅前', 'コンビニ', '電車 定期', '']) + f' {pk}',
+                     category=rng.choice([self.category, other]))
+        conditions = [
+            {},
+            {'year': '2021', 'month': '3'},
+            {'year': '2020'},
+            {'month': '12'},
+            {'greater_than': 1000, 'less_than': 3000},
+            {'key_word': 'スーパー 駅前'},
+            {'category': [other]},
+            {'year': '2021', 'greater_than': 2000, 'key_word': '電車', 'category': [self.category, other]},
+        ]
+        rows = list(Payment.objects.all())
+        for cleaned_data in conditions:
+            with self.subTest(cleaned_data=cleaned_data):
+                def matches(payment):
+                    year = int(cleaned_data.get('year') or 0)
+                    month = int(cleaned_data.get('month') or 0)
+                    categories = cleaned_data.get('category')
+                    return ((not year or payment.date.year == year)
+                            and (not month or payment.date.month == month)
+                            and payment.price >= cleaned_data.get('greater_than', 0)
+                            and payment.price <= cleaned_data.get('less_than', 10 ** 9)
+                            and all(word in payment.description for word in cleaned_data.get('key_word', '').split())
+                            and (not categories or payment.category_id in {category.pk for category in categories}))
+
+                filtered = LIST_FILTERS.apply(Payment.objects.all(), cleaned_data)
+                self.assertEqual(sorted(payment.pk for payment in filtered),
+                                 sorted(payment.pk for payment in rows if matches(payment)))
+
+
+class AnomalyStatsTests(HouseholdTestCase):
+
+    def assertStatsEqual(self, stats, prices):
+        prices = np.array(prices, dtype=float)
+        self.assertEqual(stats[0], len(prices))
+        self.assertAlmostEqual(stats[1], prices.mean() if len(prices) else 0.0)
+        self.assertAlmostEqual(stats[2], ((prices - prices.mean()) ** 2).sum() if len(prices) else 0.0, places=4)
+
+    def test_add_remove_merge(self):
+        rng = random.Random(0)
+        prices = [rng.randrange(100, 10000) for _ in range(50)]
+        stats = anomaly.batch_stats(prices)
+        self.assertStatsEqual(stats, prices)
+        for price in prices[:20]:
+            stats = anomaly.remove(*stats, price)
+        self.assertStatsEqual(stats, prices[20:])
+        self.assertStatsEqual(anomaly.merge(anomaly.batch_stats(prices[:20]), stats), prices)
+        self.assertStatsEqual(anomaly.remove(1, 500.0, 0.0, 500), [])
+
+    def test_category_stats_follow_writes(self):
+        other = PaymentCategory.objects.create(owner=self.household, name='食費')
+        payments = [self.pay(datetime.date(2021, 5, 1) + datetime.timedelta(days=day), 100 * (day + 1), f'支出{day}')
+                    for day in range(12)]
+        payments[0].price = 5000
+        payments[0].save()
+        payments[1].category = other
+        payments[1].save()
+        payments[2].soft_delete()
+        payments[3].delete()
+        payments[2].restore()
+        payments[4].soft_delete()
+
+        for category in (self.category, other):
+            stats = CategoryStats.objects.get(category=category)
+            prices = list(Payment.objects.filter(category=category).values_list('price', flat=True))
+            self.assertStatsEqual((stats.count, stats.mean, stats.m2), prices)
+
+    def test_outlier_is_flagged(self):
+        for day in range(12):
+            self.pay(datetime.date(2021, 5, 1) + datetime.timedelta(days=day), 1000 + day * 10, f'支出{day}')
+        self.assertFalse(self.pay(datetime.date(2021, 5, 20), 1050, '普通').is_anomaly)
+        self.assertTrue(self.pay(datetime.date(2021, 5, 21), 50000, '高額').is_anomaly)
+
+
+class ForecastTests(HouseholdTestCase):
+
+    def test_steady_spending_projects_the_same_amount(self):
+        for month in range(1, 13):
+            self.pay(datetime.date(2020, month, 1), 30000, f'家賃 2020-{month}')
+        for month in range(1, 6):
+            self.pay(datetime.date(2021, month, 1), 30000, f'家賃 2021-{month}')
+        self.pay(datetime.date(2021, 6, 1), 15000, '家賃 2021-6')
+        columns = get_snapshot('Payment', self.household.pk)
+
+        forecast = month_forecast(columns, 2021, 6, today=datetime.date(2021, 6, 15))
+        total = forecast.total
+        # 月の半分で半月分を支出しているので、月末は普段どおりの30000
+        self.assertEqual((total.spent, total.month_end, total.month_low, total.month_high),
+                         (15000, 30000, 30000, 30000))
+        self.assertEqual((total.year_spent, total.year_end), (165000, 360000))
+        self.assertEqual(forecast.month_labels, ['2021-06', '2021-07', '2021-08', '2021-09', '2021-10', '2021-11',
+                                                 '2021-12'])
+        self.assertEqual(forecast.for_category(self.category.pk)[1], [30000] * 7)
+        self.assertEqual(len(forecast.daily_dates), 15)
+
+        self.assertIsNone(month_forecast(columns, 2021, 5, today=datetime.date(2021, 6, 15)))
+
+    def test_band_contains_projection(self):
+        rng = random.Random(0)
+        for month in range(1, 13):
+            for day in range(1, 29, 3):
+                self.pay(datetime.date(2020, month, day), rng.randrange(500, 5000), f'支出 {month}-{day}')
+        self.pay(datetime.date(2021, 1, 2), 3000, '支出 2021')
+        forecast = month_forecast(get_snapshot('Payment', self.household.pk), 2021, 1,
+                                  today=datetime.date(2021, 1, 10))
+        for projection in [*forecast.categories, forecast.total]:
+            self.assertLessEqual(projection.spent, projection.month_low)
+            self.assertLess(projection.month_low, projection.month_end)
+            self.assertLess(projection.month_end, projection.month_high)
+            self.assertLess(projection.year_low, projection.year_end)
+            self.assertLess(projection.year_end, projection.year_high)
+
+
+class PrecomputeTests(HouseholdTestCase):
+
+    def test_queue_debounces_and_survives_failures(self):
+        """同じジョブは最後の登録の分だけ一度実行し、失敗したジョブがあってもワーカーは止まらない"""
+        queue = PrecomputeQueue(delay=0.05)
+        calls = []
+
+        def fail():
+            raise ValueError('失敗')
+
+        for value in range(5):
+            queue.schedule('month', calls.append, value)
+        with self.assertLogs('kakeibo.precompute', 'ERROR'):
+            queue.schedule('failing', fail)
+            deadline = time.monotonic() + 5
+            while queue.processed + queue.failed < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual((calls, queue.processed, queue.failed, queue.depth), ([4], 1, 1, 0))
+
+        queue.schedule('month', calls.append, 5)
+        while queue.processed < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(calls, [4, 5])
+
+    def test_write_refreshes_caches_after_commit(self):
+        """書き込みのコミット後に、影響する月の集計を作り直し、推移グラフのキャッシュを無効にする"""
+        self.pay(datetime.date(2021, 5, 1), 1000, 'スーパー')
+        self.assertEqual(get_month_summary(self.household.pk, 2021, 5)['total_payment'], 1000)
+        version = get_transition_version(self.household.pk)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.pay(datetime.date(2021, 5, 2), 500, 'コンビニ')
+        # コミット前は、古い集計のまま
+        self.assertEqual(cache.get(MONTH_SUMMARY_KEY.format(owner=self.household.pk, year=2021, month=5))
+                         ['total_payment'], 1000)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(cache.get(MONTH_SUMMARY_KEY.format(owner=self.household.pk, year=2021, month=5))
+                         ['total_payment'], 1500)
+        self.assertNotEqual(get_transition_version(self.household.pk), version)
+
+
+class BudgetTests(HouseholdTestCase):
+
+    def assertSpendMatchesDatabase(self):
+        expected = {(row['category_id'], row['month']): (row['total'], row['count']) for row in
+                    Payment.objects.annotate(month=TruncMonth('date')).values('category_id', 'month')
+                    .order_by().annotate(total=Sum('price'), count=Count('id'))}
+        actual = {(spend.category_id, spend.month): (spend.total, spend.count)
+                  for spend in MonthlyCategorySpend.objects.exclude(count=0)}
+        self.assertEqual(actual, expected)
+
+    def test_spend_counters_follow_writes(self):
+        other = PaymentCategory.objects.create(owner=self.household, name='食費')
+        payments = [self.pay(datetime.date(2021, 5, day), 100 * day, f'支出{day}') for day in range(1, 9)]
+        self.assertSpendMatchesDatabase()
+
+        payments[0].price = 5000
+        payments[0].save()
+        payments[1].category = other
+        payments[1].save()
+        payments[2].date = datetime.date(2021, 6, 1)
+        payments[2].save()
+        payments[3].soft_delete()
+        payments[4].soft_delete()
+        payments[4].restore()
+        payments[5].delete()
+        payments[3].delete()
+        bulk = [Payment(pk=1000 + day, owner=self.household, date=datetime.date(2021, 6, day), price=300,
+                        category=other, description=f'一括{day}') for day in range(1, 4)]
+        Payment.objects.bulk_create(bulk)
+        notify_bulk_write(Payment, bulk)
+        self.assertSpendMatchesDatabase()
+
+    def test_budget_status_and_alerts(self):
+        Budget.objects.create(owner=self.household, category=self.category, month=datetime.date(2021, 5, 20),
+                              limit=10000)
+        self.pay(datetime.date(2021, 5, 1), 7000, 'スーパー')
+        crossing = self.pay(datetime.date(2021, 5, 2), 1500, 'コンビニ')
+        self.assertEqual(crossed_thresholds(crossing), [0.8])
+        crossing = self.pay(datetime.date(2021, 5, 3), 2000, '本')
+        self.assertEqual(crossed_thresholds(crossing), [1.0])
+
+        other = PaymentCategory.objects.create(owner=self.household, name='食費')
+        rows = {row['category']: row for row in budget_status(self.household.pk, 2021, 5)}
+        self.assertEqual((rows[self.category]['spent'], rows[self.category]['remaining'], rows[self.category]['rate']),
+                         (10500, -500, 105))
+        self.assertEqual((rows[other]['limit'], rows[other]['spent'], rows[other]['rate']), (None, 0, None))
+
+
+class QueryStringBuilderTests(SimpleTestCase):
+
+    def test_replace_matches_urlencode(self):
+        """置き換えた結果は、毎回 QueryDict を組み立て直した場合と同じになる"""
+        query = QueryDict('year=2021&month=5&category=1&category=2&key_word=%E9%A7%85+%E5%89%8D&page=3')
+        builder = QueryStringBuilder(query)
+        for field, value in (('page', 4), ('page', 5), ('month', 12), ('key_word', 'a&b=c'), ('sort', '-date')):
+            with self.subTest(field=field, value=value):
+                expected = query.copy()
+                expected[field] = value
+                self.assertEqual(builder.replace(field, value), expected.urlencode())
+        self.assertEqual(QueryStringBuilder(QueryDict('')).replace('page', 2), 'page=2')
+
+    def test_builder_is_shared_within_a_request(self):
+        request = RequestFactory().get('/', {'page': 2, 'year': 2021})
+        self.assertEqual(url_replace(request, 'page', 3), 'page=3&year=2021')
+        self.assertIs(get_query_string_builder(request), get_query_string_builder(request))
+
+
+class SoftDeleteTests(HouseholdTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def test_delete_moves_to_trash_and_restore_brings_back(self):
+        payment = self.pay(datetime.date(2021, 5, 1), 1000, 'スーパー')
+        response = self.client.post(reverse('kakeibo:payment_delete', args=(payment.pk,)))
+        self.assertRedirects(response, reverse('kakeibo:payment_list'), fetch_redirect_response=False)
+        self.assertFalse(Payment.objects.filter(pk=payment.pk).exists())
+        self.assertContains(self.client.get(reverse('kakeibo:trash')), 'スーパー')
+        self.assertEqual(MonthlyCategorySpend.objects.get(category=self.category).count, 0)
+
+        self.client.post(reverse('kakeibo:payment_restore', args=(payment.pk,)))
+        self.assertTrue(Payment.objects.filter(pk=payment.pk).exists())
+        self.assertEqual(MonthlyCategorySpend.objects.get(category=self.category).total, 1000)
+        self.assertEqual(list(ChangeLog.objects.filter(object_id=payment.pk).order_by('id')
+                              .values_list('action', 'user')),
+                         [('create', None), ('delete', self.user.pk), ('restore', self.user.pk)])
+
+    def test_restore_of_a_reentered_payment_is_refused(self):
+        """ゴミ箱に移した後に同じ明細を登録し直した場合は、元に戻さない"""
+        payment = self.pay(datetime.date(2021, 5, 1), 1000, 'スーパー')
+        payment.soft_delete()
+        self.pay(datetime.date(2021, 5, 1), 1000, 'スーパー')
+        response = self.client.post(reverse('kakeibo:payment_restore', args=(payment.pk,)), follow=True)
+        self.assertContains(response, '既に登録されているため')
+        self.assertIsNotNone(Payment.all_objects.get(pk=payment.pk).deleted_at)
+
+    def test_other_households_rows_cannot_be_deleted(self):
+        other = Household.objects.create(name='別の世帯')
+        income = Income.objects.create(owner=other, date=datetime.date(2021, 5, 1), price=1000,
+                                       category=IncomeCategory.objects.create(owner=other, name='給与'))
+        response = self.client.post(reverse('kakeibo:income_delete', args=(income.pk,)))
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(Income.all_objects.get(pk=income.pk).deleted_at)
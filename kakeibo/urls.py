@@ -6,12 +6,21 @@ app_name = 'kakeibo'
 urlpatterns = [
     path('', views.PaymentList.as_view(), name='payment_list'),
     path('income_list/', views.IncomeList.as_view(), name='income_list'),
+    path('ledger/', views.LedgerView.as_view(), name='ledger'),
     path('payment_create/', views.PaymentCreate.as_view(), name='payment_create'),
     path('income_create/', views.IncomeCreate.as_view(), name='income_create'),
     path('payment_update/<int:pk>/', views.PaymentUpdate.as_view(), name='payment_update'),
     path('payment_delete/<int:pk>/', views.PaymentDelete.as_view(), name='payment_delete'),
     path('income_update/<int:pk>/', views.IncomeUpdate.as_view(), name='income_update'),
     path('income_delete/<int:pk>/', views.IncomeDelete.as_view(), name='income_delete'),
+    path('trash/', views.Trash.as_view(), name='trash'),
+    path('payment_restore/<int:pk>/', views.PaymentRestore.as_view(), name='payment_restore'),
+    path('income_restore/<int:pk>/', views.IncomeRestore.as_view(), name='income_restore'),
     path('month/<int:year>/<int:month>/', views.MonthDashboard.as_view(), name='month_dashboard'),
     path('transition/', views.TransitionView.as_view(), name='transition'),
+    path('budget/<int:year>/<int:month>/', views.BudgetStatus.as_view(), name='budget_status'),
+    path('precompute/status/', views.PrecomputeStatus.as_view(), name='precompute_status'),
+    path('reports/', views.ReportList.as_view(), name='report_list'),
+    path('reports/<int:pk>/status/', views.ReportStatus.as_view(), name='report_status'),
+    path('reports/<int:pk>/download/', views.ReportDownload.as_view(), name='report_download'),
 ]
@@ -1,16 +1,68 @@
+import datetime
+from django.conf import settings
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.utils.functional import cached_property
 from django.views import generic
-from .models import Payment, PaymentCategory, Income, IncomeCategory
-from .forms import PaymentSearchForm, IncomeSearchForm, PaymentCreateForm, IncomeCreateForm, TransitionGraphSearchForm
+from .models import Payment, Income, ReportJob
+from .forms import (PaymentSearchForm, IncomeSearchForm, PaymentCreateForm, IncomeCreateForm, TransitionGraphSearchForm,
+                    LedgerSearchForm, ReportJobForm)
 from django.urls import reverse_lazy
 from django.contrib import messages
+from django.db import IntegrityError
 from django.shortcuts import redirect
-import numpy as np
-import pandas as pd
-from django_pandas.io import read_frame
-from .plugin_plotly import GraphGenerator
+from django.http import FileResponse, Http404, JsonResponse
+from .aggregates import get_month_summary, get_transition_plot
+from .budget import budget_status, crossed_thresholds
+from .filters import LIST_FILTERS
+from .ledger import Cursor, Ledger
+from .navigation import month_navigation
+from . import anomaly, compression, filters, precompute, reports
 
 
-class PaymentList(generic.ListView):
+class HouseholdMixin(LoginRequiredMixin):
+    """ログイン中のユーザーの世帯のデータだけを扱う"""
+
+    @cached_property
+    def household(self):
+        return self.request.user.get_household()
+
+    def get_queryset(self):
+        return super().get_queryset().filter(owner=self.household)
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['owner'] = self.household
+        return kwargs
+
+    def get_form(self, form_class=None):
+        form = super().get_form(form_class)
+        # 変更履歴に記録するユーザー
+        form.instance._changed_by = self.request.user
+        return form
+
+
+class MonthMixin:
+    """URLの年・月を扱う"""
+
+    def get_year_month(self):
+        """URLの年・月。存在しない月は404にする(翌月の初日も求められる範囲に限る)"""
+        year = int(self.kwargs.get('year'))
+        month = int(self.kwargs.get('month'))
+        if not (1 <= month <= 12 and datetime.MINYEAR <= year < datetime.MAXYEAR):
+            raise Http404('存在しない月です')
+        return year, month
+
+
+class ExplainMixin:
+    """settings.DEBUG のとき、explain=1 を付けたURLでクエリの実行計画を表示する"""
+
+    def explain(self, queryset):
+        if settings.DEBUG and self.request.GET.get('explain'):
+            return filters.explain(queryset)
+        return None
+
+
+class PaymentList(ExplainMixin, HouseholdMixin, generic.ListView):
     """支出一覧"""
     template_name = 'kakeibo/payment_list.html'
     model = Payment
@@ -18,48 +70,22 @@ class PaymentList(generic.ListView):
     paginate_by = 10
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        self.form = form = PaymentSearchForm(self.request.GET or None)
-
+        queryset = super().get_queryset().select_related('category')
+        self.form = form = PaymentSearchForm(self.request.GET or None, owner=self.household)
         if form.is_valid():
-            year = form.cleaned_data.get('year')
-            # 何も選択されていないときは0の文字列が入るため、除外
-            if year and year != '0':
-                queryset = queryset.filter(date__year=year)
-
-            month = form.cleaned_data.get('month')
-            if month and month != '0':
-                queryset = queryset.filter(date__month=month)
-
-            greater_than = form.cleaned_data.get('greater_than')
-            if greater_than:
-                queryset = queryset.filter(price__gte=greater_than)
-
-            less_than = form.cleaned_data.get('less_than')
-            if less_than:
-                queryset = queryset.filter(price__lte=less_than)
-
-            key_word = form.cleaned_data.get('key_word')
-            if key_word:
-                # 空欄で区切り、順番に絞る、and検索
-                if key_word:
-                    for word in key_word.split():
-                        queryset = queryset.filter(description__icontains=word)
-
-            category = form.cleaned_data.get('category')
-            if category:
-                queryset = queryset.filter(category=category)
+            queryset = LIST_FILTERS.apply(queryset, form.cleaned_data)
 
         return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['search_form'] = self.form
+        context['explain'] = self.explain(context['page_obj'].object_list)
 
         return context
 
 
-class IncomeList(generic.ListView):
+class IncomeList(ExplainMixin, HouseholdMixin, generic.ListView):
     """収入一覧"""
     template_name = 'kakeibo/income_list.html'
     model = Income
@@ -67,28 +93,52 @@ class IncomeList(generic.ListView):
     paginate_by = 10
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        self.form = form = IncomeSearchForm(self.request.GET or None)
-
+        queryset = super().get_queryset().select_related('category')
+        self.form = form = IncomeSearchForm(self.request.GET or None, owner=self.household)
         if form.is_valid():
-            year = form.cleaned_data.get('year')
-            if year and year != '0':
-                queryset = queryset.filter(date__year=year)
-
-            month = form.cleaned_data.get('month')
-            if month and month != '0':
-                queryset = queryset.filter(date__month=month)
+            queryset = LIST_FILTERS.apply(queryset, form.cleaned_data)
 
         return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['search_form'] = self.form
+        context['explain'] = self.explain(context['page_obj'].object_list)
 
         return context
 
 
-class PaymentCreate(generic.CreateView):
+class LedgerView(ExplainMixin, HouseholdMixin, generic.TemplateView):
+    """支出と収入をまとめた入出金の明細"""
+    template_name = 'kakeibo/ledger.html'
+    paginate_by = 20
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        self.form = form = LedgerSearchForm(self.request.GET or None, owner=self.household)
+        context['search_form'] = form
+
+        cleaned_data = form.cleaned_data if form.is_valid() else {}
+        kind = cleaned_data.get('kind')
+        ledger = Ledger(self.household.pk, cleaned_data, kinds=[kind] if kind else None)
+        cursor = Cursor.loads(self.request.GET.get('after', ''))
+        page = ledger.page(cursor, size=self.paginate_by)
+        context['ledger_rows'] = page.rows
+        context['is_first_page'] = cursor is None
+        context['next_cursor'] = page.next_cursor.dumps() if page.next_cursor else None
+        context['explain'] = self.explain(ledger.page_queryset(cursor, self.paginate_by + 1))
+
+        return context
+
+
+def warn_anomaly(request, payment):
+    """普段の金額から大きく外れた支出を登録した場合に知らせる"""
+    if payment.is_anomaly:
+        messages.warning(request, f'{payment.category}の普段の金額から大きく外れています'
+                                  f'(外れ度 {payment.anomaly_score:+.1f})')
+
+
+class PaymentCreate(HouseholdMixin, generic.CreateView):
     """支出登録"""
     template_name = 'kakeibo/register.html'
     model = Payment
@@ -104,15 +154,22 @@ class PaymentCreate(generic.CreateView):
 
     def form_valid(self, form):
         self.object = payment = form.save()
+        auto = '(自動分類)' if form.auto_categorized else ''
         messages.info(self.request,
                       f'支出を登録しました\n'
                       f'日付:{payment.date}\n'
-                      f'カテゴリ:{payment.category}\n'
+                      f'カテゴリ:{payment.category}{auto}\n'
                       f'金額:{payment.price}円')
+        warn_anomaly(self.request, payment)
+        for threshold in crossed_thresholds(payment):
+            if threshold >= 1:
+                messages.warning(self.request, f'{payment.category}の予算を超えました')
+            else:
+                messages.warning(self.request, f'{payment.category}の予算の{threshold:.0%}を超えました')
         return redirect(self.get_success_url())
 
 
-class IncomeCreate(generic.CreateView):
+class IncomeCreate(HouseholdMixin, generic.CreateView):
     """収入登録"""
     template_name = 'kakeibo/register.html'
     model = Income
@@ -136,7 +193,7 @@ class IncomeCreate(generic.CreateView):
         return redirect(self.get_success_url())
 
 
-class PaymentUpdate(generic.UpdateView):
+class PaymentUpdate(HouseholdMixin, generic.UpdateView):
     """支出更新"""
     template_name = 'kakeibo/register.html'
     model = Payment
@@ -157,10 +214,11 @@ class PaymentUpdate(generic.UpdateView):
                       f'日付:{payment.date}\n'
                       f'カテゴリ:{payment.category}\n'
                       f'金額:{payment.price}円')
+        warn_anomaly(self.request, payment)
         return redirect(self.get_success_url())
 
 
-class IncomeUpdate(generic.UpdateView):
+class IncomeUpdate(HouseholdMixin, generic.UpdateView):
     """収入更新"""
     template_name = 'kakeibo/register.html'
     model = Income
@@ -184,11 +242,14 @@ class IncomeUpdate(generic.UpdateView):
         return redirect(self.get_success_url())
 
 
-class PaymentDelete(generic.DeleteView):
+class PaymentDelete(HouseholdMixin, generic.DeleteView):
     """支出削除"""
     template_name = 'kakeibo/delete.html'
     model = Payment
 
+    def get_queryset(self):
+        return super().get_queryset().select_related('category')
+
     def get_success_url(self):
         return reverse_lazy('kakeibo:payment_list')
 
@@ -201,20 +262,23 @@ class PaymentDelete(generic.DeleteView):
     def delete(self, request, *args, **kwargs):
         self.object = payment = self.get_object()
 
-        payment.delete()
+        payment.soft_delete(user=request.user)
         messages.info(self.request,
-                      f'支出を削除しました\n'
+                      f'支出をゴミ箱に移しました(ゴミ箱から元に戻せます)\n'
                       f'日付:{payment.date}\n'
                       f'カテゴリ:{payment.category}\n'
                       f'金額:{payment.price}円')
         return redirect(self.get_success_url())
 
 
-class IncomeDelete(generic.DeleteView):
+class IncomeDelete(HouseholdMixin, generic.DeleteView):
     """収入削除"""
     template_name = 'kakeibo/delete.html'
     model = Income
 
+    def get_queryset(self):
+        return super().get_queryset().select_related('category')
+
     def get_success_url(self):
         return reverse_lazy('kakeibo:income_list')
 
@@ -226,123 +290,175 @@ class IncomeDelete(generic.DeleteView):
 
     def delete(self, request, *args, **kwargs):
         self.object = income = self.get_object()
-        income.delete()
+        income.soft_delete(user=request.user)
         messages.info(self.request,
-                      f'収入を削除しました\n'
+                      f'収入をゴミ箱に移しました(ゴミ箱から元に戻せます)\n'
                       f'日付:{income.date}\n'
                       f'カテゴリ:{income.category}\n'
                       f'金額:{income.price}円')
         return redirect(self.get_success_url())
 
 
-class MonthDashboard(generic.TemplateView):
-    """月間支出ダッシュボード"""
-    template_name = 'kakeibo/month_dashboard.html'
+class Trash(HouseholdMixin, generic.TemplateView):
+    """ゴミ箱。削除した支出・収入の一覧"""
+    template_name = 'kakeibo/trash.html'
+    # 種類ごとに表示する件数
+    limit = 50
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        year = int(self.kwargs.get('year'))
-        month = int(self.kwargs.get('month'))
-        context['year_month'] = f'{year}年{month}月'
+        for name, model in (('payment_list', Payment), ('income_list', Income)):
+            context[name] = (model.all_objects
+                             .filter(owner=self.household, deleted_at__isnull=False)
+                             .select_related('category')
+                             .order_by('-deleted_at')[:self.limit])
+        return context
 
-        if month == 1:
-            prev_year = year - 1
-            prev_month = 12
-        else:
-            prev_year = year
-            prev_month = month - 1
 
-        if month == 12:
-            next_year = year + 1
-            next_month = 1
+class RestoreMixin(HouseholdMixin, generic.detail.SingleObjectMixin):
+    """ゴミ箱の行を元に戻す"""
+    label = None
+
+    def get_queryset(self):
+        return self.model.all_objects.filter(owner=self.household, deleted_at__isnull=False)
+
+    def get_success_url(self):
+        return reverse_lazy('kakeibo:trash')
+
+    def post(self, request, *args, **kwargs):
+        self.object = obj = self.get_object()
+        try:
+            obj.restore(user=request.user)
+        except IntegrityError:
+            messages.warning(self.request, f'同じ{self.label}が既に登録されているため、元に戻せませんでした')
         else:
-            next_year = year
-            next_month = month + 1
-        context['prev_year'] = prev_year
-        context['prev_month'] = prev_month
-        context['next_year'] = next_year
-        context['next_month'] = next_month
+            messages.info(self.request,
+                          f'{self.label}を元に戻しました\n'
+                          f'日付:{obj.date}\n'
+                          f'カテゴリ:{obj.category}\n'
+                          f'金額:{obj.price}円')
+        return redirect(self.get_success_url())
+
 
-        queryset = Payment.objects.filter(date__year=year)
-        queryset = queryset.filter(date__month=month)
-        # 後の工程でエラーになるため、クエリセットが何もない時はcontextを返す
-        if not queryset:
-            return context
+class PaymentRestore(RestoreMixin, generic.View):
+    """支出の復元"""
+    model = Payment
+    label = '支出'
 
-        df = read_frame(queryset,
-                        fieldnames=['date', 'price', 'category'])
 
-        gen = GraphGenerator()
+class IncomeRestore(RestoreMixin, generic.View):
+    """収入の復元"""
+    model = Income
+    label = '収入'
 
-        df_pie = pd.pivot_table(df, index='category', values='price', aggfunc=np.sum)
-        pie_labels = list(df_pie.index.values)
-        pie_values = [val[0] for val in df_pie.values]
-        plot_pie = gen.month_pie(labels=pie_labels, values=pie_values)
-        context['plot_pie'] = plot_pie
 
-        context['table_set'] = df_pie.to_dict()['price']
+class MonthDashboard(HouseholdMixin, MonthMixin, generic.TemplateView):
+    """月間支出ダッシュボード"""
+    template_name = 'kakeibo/month_dashboard.html'
 
-        context['total_payment'] = df['price'].sum()
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        year, month = self.get_year_month()
+        context['year_month'] = f'{year}年{month}月'
+        # 前後の支出のある月へ移動する
+        context['month_nav'] = month_navigation(self.household.pk, year, month)
 
-        df_bar = pd.pivot_table(df, index='date', values='price', aggfunc=np.sum)
-        dates = list(df_bar.index.values)
-        heights = [val[0] for val in df_bar.values]
-        plot_bar = gen.month_daily_bar(x_list=dates, y_list=heights)
-        context['plot_bar'] = plot_bar
+        context.update(get_month_summary(self.household.pk, year, month))
+        compression.attach(self.request, context.get('plot_pie'), context.get('plot_bar'))
+        context['anomalies'] = anomaly.month_anomalies(self.household.pk, year, month)
 
         return context
 
 
-class TransitionView(generic.TemplateView):
+class TransitionView(HouseholdMixin, generic.TemplateView):
     """月毎の収支推移"""
     template_name = 'kakeibo/transition.html'
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        payment_queryset = Payment.objects.all()
-        income_queryset = Income.objects.all()
-        self.form = form = TransitionGraphSearchForm(self.request.GET or None)
+        self.form = form = TransitionGraphSearchForm(self.request.GET or None, owner=self.household)
         context['search_form'] = self.form
 
+        payment_category = None
+        income_category = None
         graph_visible = None
-        months_payment = None
-        payments = None
-        months_income = None
-        incomes = None
 
         if form.is_valid():
             payment_category = form.cleaned_data.get('payment_category')
-            if payment_category:
-                payment_queryset = payment_queryset.filter(category=payment_category)
             income_category = form.cleaned_data.get('income_category')
-            if income_category:
-                income_queryset = income_queryset.filter(category=income_category)
-
             graph_visible = form.cleaned_data.get('graph_visible')
 
-        # forms.pyで表示グラフ名を定義
-        if not graph_visible or graph_visible == 'Payment':
-            payment_df = read_frame(payment_queryset,
-                                    fieldnames=['date', 'price'])
-            payment_df['date'] = pd.to_datetime(payment_df['date'])
-            payment_df['month'] = payment_df['date'].dt.strftime('%Y-%m')
-            payment_df = pd.pivot_table(payment_df, index='month', values='price', aggfunc=np.sum)
-            months_payment = list(payment_df.index.values)
-            payments = [y[0] for y in payment_df.values]
-
-        if not graph_visible or graph_visible == 'Income':
-            income_df = read_frame(income_queryset,
-                                   fieldnames=['date', 'price'])
-            income_df['date'] = pd.to_datetime(income_df['date'])
-            income_df['month'] = income_df['date'].dt.strftime('%Y-%m')
-            income_df = pd.pivot_table(income_df, index='month', values='price', aggfunc=np.sum)
-            months_income = list(income_df.index.values)
-            incomes = [y[0] for y in income_df.values]
-
-        gen = GraphGenerator()
-        context['transition_plot'] = gen.transition_plot(x_list_payment=months_payment,
-                                                         y_list_payment=payments,
-                                                         x_list_income=months_income,
-                                                         y_list_income=incomes)
+        context['transition_plot'] = get_transition_plot(self.household.pk,
+                                                         payment_category=payment_category,
+                                                         income_category=income_category,
+                                                         graph_visible=graph_visible)
+        compression.attach(self.request, context['transition_plot'])
+
+        return context
+
+
+class BudgetStatus(HouseholdMixin, MonthMixin, generic.TemplateView):
+    """月間予算の消化状況"""
+    template_name = 'kakeibo/budget_status.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        year, month = self.get_year_month()
+        context['year_month'] = f'{year}年{month}月'
+        context['budget_rows'] = rows = budget_status(self.household.pk, year, month)
+        context['total_limit'] = sum(row['limit'] or 0 for row in rows)
+        context['total_spent'] = sum(row['spent'] for row in rows)
+
+        return context
 
+
+class PrecomputeStatus(LoginRequiredMixin, generic.View):
+    """事前計算キューの状態(待機ジョブ数・遅延)"""
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(precompute.queue.stats())
+
+
+class ReportList(HouseholdMixin, generic.CreateView):
+    """集計レポートの作成依頼と、作成済みのレポートの一覧"""
+    model = ReportJob
+    form_class = ReportJobForm
+    template_name = 'kakeibo/reports.html'
+    success_url = reverse_lazy('kakeibo:report_list')
+    # 一覧に表示する件数
+    limit = 20
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['job_list'] = self.get_queryset().order_by('-created_at')[:self.limit]
         return context
+
+    def form_valid(self, form):
+        form.instance.user = self.request.user
+        response = super().form_valid(form)
+        reports.submit(self.object)
+        messages.info(self.request, f'レポートの作成を受け付けました\n{self.object}')
+        return response
+
+
+class ReportStatus(HouseholdMixin, generic.detail.BaseDetailView):
+    """レポートの作成状況(進捗の問い合わせ用)"""
+    model = ReportJob
+
+    def render_to_response(self, context):
+        return JsonResponse(reports.job_status(self.object))
+
+
+class ReportDownload(HouseholdMixin, generic.detail.BaseDetailView):
+    """作成済みのレポートのダウンロード"""
+    model = ReportJob
+
+    def render_to_response(self, context):
+        job = self.object
+        if job.status != 'done':
+            raise Http404('レポートはまだ作成されていません')
+        try:
+            file = open(reports.report_path(job), 'rb')
+        except FileNotFoundError:
+            raise Http404('レポートのファイルが見つかりません')
+        return FileResponse(file, as_attachment=True, filename=job.download_name())
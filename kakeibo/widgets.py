@@ -12,3 +12,16 @@ class CustomRadioSelect(forms.RadioSelect):
             self.attrs['class'] += ' custom-radio'
         else:
             self.attrs['class'] = 'custom-radio'
+
+
+class CustomCheckboxSelectMultiple(forms.CheckboxSelectMultiple):
+    """カスタムチェックボックス。CustomRadioSelectと同じ見た目で、複数選択できる"""
+    template_name = 'kakeibo/widgets/custom_radio.html'
+    option_template_name = 'kakeibo/widgets/custom_radio_option.html'
+
+    def __init__(self, attrs=None, choices=()):
+        super().__init__(attrs, choices)
+        if 'class' in self.attrs:
+            self.attrs['class'] += ' custom-radio'
+        else:
+            self.attrs['class'] = 'custom-radio'
@@ -31,6 +31,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'kakeibo.middleware.CompressionMiddleware',  # add
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -107,6 +108,12 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# add
+# collectstatic の出力先。本番ではWebサーバーから配信する
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+# ファイル名に内容のハッシュを付け、長期間キャッシュできるようにする
+STATICFILES_STORAGE = 'kakeibo.assets.StaticFilesStorage'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -117,3 +124,50 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # add
 NUMBER_GROUPING = 3
+
+# add
+# 集計のキャッシュと、書き込みを知らせるバージョンはワーカープロセス間で共有する必要があるため、
+# プロセスごとのメモリ(LocMemCache)ではなくファイルに置く。複数のホストで動かす場合はmemcachedなどにする
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
+# add
+# 書き込み後のダッシュボード再計算をバックグラウンドで行うか
+KAKEIBO_PRECOMPUTE_ASYNC = True
+# 連続した書き込みをまとめるための待ち時間(秒)
+KAKEIBO_PRECOMPUTE_DELAY = 1.0
+# 凍結済みの年の台帳アーカイブの保存先
+KAKEIBO_ARCHIVE_DIR = BASE_DIR / 'archive'
+# プロセス内に保持するスナップショット(世帯ごとの支出・収入)と、カテゴリの推定器の数の上限
+KAKEIBO_SNAPSHOT_CACHE_SIZE = 256
+KAKEIBO_CATEGORIZER_CACHE_SIZE = 128
+# スナップショットの差分の取り込みで読み直す、透かしより前の秒数。最も長い書き込みのトランザクションより長くする
+KAKEIBO_SNAPSHOT_WATERMARK_LAG = 60
+
+# add
+LOGIN_URL = 'register:login'
+LOGIN_REDIRECT_URL = 'kakeibo:payment_list'
+LOGOUT_REDIRECT_URL = 'register:login'
+
+# add
+# この大きさ(バイト)未満のレスポンスは圧縮しない
+KAKEIBO_COMPRESS_MIN_SIZE = 1024
+
+# add
+# 集計レポートの出力先と、Webのプロセス内でレポートを作成するスレッド数
+# 0の場合は managementコマンド run_reports で作成する
+KAKEIBO_REPORT_DIR = BASE_DIR / 'reports'
+KAKEIBO_REPORT_WORKERS = 2
+
+# add
+# カテゴリの平均から標準偏差の何倍離れた支出を外れ値とするか
+KAKEIBO_ANOMALY_Z = 3.0
+# 外れ値の判定に必要な、カテゴリの支出の件数
+KAKEIBO_ANOMALY_MIN_COUNT = 10
@@ -3,5 +3,6 @@ from django.urls import path, include
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('register/', include('register.urls')),
     path('', include('kakeibo.urls')),
 ]
@@ -1,3 +1,17 @@
 from django.contrib import admin
+from django.contrib.auth.admin import UserAdmin
+from .models import User, Household
 
-# Register your models here.
+
+class CustomUserAdmin(UserAdmin):
+    list_display = UserAdmin.list_display + ('household',)
+    list_filter = UserAdmin.list_filter + ('household',)
+    fieldsets = UserAdmin.fieldsets + (('世帯', {'fields': ('household',)}),)
+
+
+class HouseholdAdmin(admin.ModelAdmin):
+    list_display = ['name']
+
+
+admin.site.register(User, CustomUserAdmin)
+admin.site.register(Household, HouseholdAdmin)
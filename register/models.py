@@ -2,5 +2,21 @@ from django.db import models
 from django.contrib.auth.models import AbstractUser
 
 
+class Household(models.Model):
+    """世帯。家計簿のデータはすべて世帯ごとに分かれる"""
+    name = models.CharField('世帯名', max_length=64)
+
+    def __str__(self):
+        return self.name
+
+
 class User(AbstractUser):
-    pass
+    household = models.ForeignKey(Household, on_delete=models.PROTECT, null=True, blank=True,
+                                  related_name='members', verbose_name='世帯')
+
+    def get_household(self):
+        """所属する世帯。まだ無ければ作成して所属させる"""
+        if self.household_id is None:
+            self.household = Household.objects.create(name=f'{self.get_username()}の世帯')
+            self.save(update_fields=['household'])
+        return self.household